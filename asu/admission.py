@@ -0,0 +1,170 @@
+import json
+import logging
+import shutil
+from time import time
+
+from podman import PodmanClient
+from rq.utils import parse_timeout
+
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.util import get_redis_client
+
+log = logging.getLogger("rq.worker")
+
+MB = 1024 * 1024
+
+
+def get_resource_key(build_request: BuildRequest) -> str:
+    return f"resources:{build_request.target}"
+
+
+def get_workspace_estimate(build_request: BuildRequest) -> int:
+    """Return the expected size of a build's images in bytes.
+
+    Images are written to the tmpfs workspace of the build container and
+    then copied to `public_path`, so they take both memory and disk space.
+    Targets without finished builds use `build_workspace_mb`.
+    """
+    estimate = get_redis_client().get(get_resource_key(build_request))
+    return int(estimate) if estimate else settings.build_workspace_mb * MB
+
+
+def record_workspace_size(build_request: BuildRequest, size: int) -> None:
+    """Learn the size of a finished build's images for its target.
+
+    The estimate follows larger builds at once and smaller ones slowly, so
+    it errs on the side of caution.
+    """
+    rc = get_redis_client()
+    key = get_resource_key(build_request)
+    estimate = rc.get(key)
+    if estimate:
+        size = max(size, int(0.8 * int(estimate) + 0.2 * size))
+    rc.set(key, size, ex=parse_timeout(settings.build_ttl))
+
+
+class Admission:
+    """Admission control of builds by the free resources of a podman host.
+
+    Before a worker starts a build it checks that free memory on the podman
+    host and free disk space in `public_path` fit the build, leaving
+    `host_memory_reserve_mb` and `host_disk_reserve_mb` untouched.  A build
+    needs `build_memory_mb` of memory plus its images, estimated per target
+    from earlier builds, in memory and on disk.
+
+    Admitted builds reserve their estimate in a Redis hash per podman host
+    until they end or `job_timeout` passes, so builds starting at the same
+    time on other workers of the host are accounted for.  Free memory
+    only reflects builds once they are running, so the memory reserved by
+    builds started within `build_memory_ramp` is subtracted from it, and
+    older builds are taken as already using their memory.  Reservations
+    are not reduced as builds grow, which overestimates their usage.
+
+    A build is always admitted to a host without reservations, as waiting
+    would not free any resources for it.
+    """
+
+    def __init__(self, podman: PodmanClient):
+        self.podman = podman
+        self.sampled_at: float = time()
+        self.host: dict = podman.info()["host"]
+        self.rc = get_redis_client()
+        self.key = f"admission:{self.host['hostname']}"
+
+    def reserved(self, since: float = 0.0) -> tuple[int, int, int]:
+        """Return the resources reserved by running builds.
+
+        Args:
+            since: count the memory of builds started after this time only,
+                their disk space is always counted
+
+        Returns:
+            tuple: number of builds, their memory and disk space
+        """
+        builds: int = 0
+        memory: int = 0
+        disk: int = 0
+        now = time()
+        for job_id, value in self.rc.hgetall(self.key).items():
+            reservation = json.loads(value)
+            if reservation["expires"] < now:
+                self.rc.hdel(self.key, job_id)
+                continue
+            builds += 1
+            if reservation.get("started", now) >= since:
+                memory += reservation["memory"]
+            disk += reservation["disk"]
+        return builds, memory, disk
+
+    def admit(self, job_id: str, build_request: BuildRequest) -> bool:
+        """Reserve the resources of a build if the host has room for it.
+
+        Returns:
+            bool: whether the build may start
+        """
+        disk = get_workspace_estimate(build_request)
+        memory = disk + settings.build_memory_mb * MB
+        ramp = parse_timeout(settings.build_memory_ramp)
+        builds, reserved_memory, reserved_disk = self.reserved(self.sampled_at - ramp)
+        if builds and not self.fits(
+            job_id, memory, disk, reserved_memory, reserved_disk
+        ):
+            return False
+
+        self.rc.hset(
+            self.key,
+            job_id,
+            json.dumps(
+                {
+                    "memory": memory,
+                    "disk": disk,
+                    "started": time(),
+                    "expires": time() + parse_timeout(settings.job_timeout),
+                }
+            ),
+        )
+        return True
+
+    def fits(
+        self,
+        job_id: str,
+        memory: int,
+        disk: int,
+        reserved_memory: int,
+        reserved_disk: int,
+    ) -> bool:
+        """Return whether a build fits next to the reserved resources."""
+        # Not every podman version reports free memory.
+        mem_free = self.host.get("memFree")
+        if isinstance(mem_free, int):
+            available = (
+                mem_free - reserved_memory - settings.host_memory_reserve_mb * MB
+            )
+            if memory > available:
+                log.info(
+                    f"Not enough memory for {job_id}: needs {memory // MB} MB, "
+                    f"{max(available, 0) // MB} MB available"
+                )
+                return False
+
+        public_path = settings.public_path
+        while not public_path.exists():
+            public_path = public_path.parent
+
+        available = (
+            shutil.disk_usage(public_path).free
+            - reserved_disk
+            - settings.host_disk_reserve_mb * MB
+        )
+        if disk > available:
+            log.info(
+                f"Not enough disk space for {job_id}: needs {disk // MB} MB, "
+                f"{max(available, 0) // MB} MB available"
+            )
+            return False
+
+        return True
+
+    def release(self, job_id: str) -> None:
+        self.rc.hdel(self.key, job_id)
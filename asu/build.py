@@ -1,61 +1,78 @@
 import datetime
 import json
 import logging
-import re
 import shutil
 import tarfile
 from io import BytesIO
 from os import getenv
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 from time import perf_counter
 
 from rq import get_current_job
 from podman import errors
 from rq.utils import parse_timeout
 
+from asu.admission import record_workspace_size
 from asu.build_request import BuildRequest
 from asu.config import settings
+from asu.imagebuilders import (
+    ImageBuilderCache,
+    get_image_key,
+    load_info,
+    load_manifest,
+    pull_image,
+    save_info,
+    save_manifest,
+)
+from asu.package_cache import PackageCache
 from asu.package_changes import apply_package_changes
+from asu.pool import WORKSPACE, ContainerPool
 from asu.repositories import (
     merge_repositories,
     validate_repos,
 )
-from asu.store import LocalStore, get_store
+from asu.signing import sign_images
+from asu.store import (
+    LocalStore,
+    get_artifact_hash,
+    get_store,
+    link_artifact,
+    save_artifact,
+)
 from asu.util import (
+    BuildLog,
+    JobMeta,
+    StageTimer,
+    add_stage_timings,
     add_timestamp,
     add_build_event,
     check_manifest,
-    check_package_errors,
+    copy_from_container,
     diff_packages,
     error_log,
     fingerprint_pubkey_usign,
+    format_package_errors,
     get_branch,
     get_container_version_tag,
+    get_image_tag,
     get_packages_hash,
     get_podman,
     get_request_hash,
+    get_revision,
     is_snapshot_build,
+    parse_info,
     parse_manifest,
+    parse_package_errors,
     report_error,
     run_cmd,
+    save_package_errors,
+    stage_slot,
 )
 
 log = logging.getLogger("rq.worker")
 
 
-def _cleanup_container(container):
-    """Kill and remove a container with its volumes."""
-    try:
-        container.kill()
-    except Exception:
-        pass
-    try:
-        container.remove(v=True, force=True)
-    except Exception as e:
-        log.warning(f"Failed to remove container {container.id[:12]}: {e}")
-
-
 def _make_tar(files: dict[str, str | bytes]) -> bytes:
     """Create an in-memory tar archive from a dict of {path: content}.
 
@@ -76,54 +93,61 @@ def _make_tar(files: dict[str, str | bytes]) -> bytes:
     return buf.getvalue()
 
 
-def _detect_apk_mode(container) -> bool:
-    """Detect whether the ImageBuilder uses apk or opkg.
+# Prints the package manager of the ImageBuilder, then its repositories.
+REPOSITORIES_PROBE = (
+    "if [ -f repositories ]; then echo apk; cat repositories; "
+    "else echo opkg; cat repositories.conf; fi"
+)
+
 
-    Checks for the presence of /builder/repositories (apk) vs
-    /builder/repositories.conf (opkg) inside the running container.
+def _read_repositories(container) -> tuple[bool, str]:
+    """Return whether the ImageBuilder uses apk, and its repositories.
+
+    apk ImageBuilders ship /builder/repositories, opkg ones
+    /builder/repositories.conf; a single exec answers both questions.
     """
-    rc, _, _ = run_cmd(container, ["test", "-f", "/builder/repositories"])
-    return rc == 0
+    _, stdout, _ = run_cmd(container, ["sh", "-c", REPOSITORIES_PROBE])
+    mode, _, content = stdout.partition("\n")
+    return mode == "apk", content
 
 
 def inject_files(container, build_request, job=None):
     """Copy keys, repositories, and defaults into a running container.
 
-    Uses put_archive to inject files directly — no bind mounts needed,
-    so there are no host-path dependencies.
+    All files are computed on the worker, including the repository URL
+    rewrite for `cache_url`, and uploaded with a single put_archive, so
+    there are no host-path dependencies and at most one exec round trip.
     """
-    if build_request.repository_keys:
-        files = {}
-        for i, key in enumerate(build_request.repository_keys):
-            if key.strip().startswith("-----BEGIN"):
-                files[f"keys/custom-{i}.pem"] = key
-            else:
-                fingerprint = fingerprint_pubkey_usign(key)
-                files[f"keys/{fingerprint}"] = (
-                    f"untrusted comment: {fingerprint}\n{key}"
-                )
-        if files:
-            container.put_archive("/builder/", _make_tar(files))
+    files: dict[str, Union[str, bytes]] = {}
 
-    if build_request.repositories:
-        allowed = validate_repos(build_request.repositories)
-        apk_mode = _detect_apk_mode(container)
+    for i, key in enumerate(build_request.repository_keys):
+        if key.strip().startswith("-----BEGIN"):
+            files[f"keys/custom-{i}.pem"] = key
+        else:
+            fingerprint = fingerprint_pubkey_usign(key)
+            files[f"keys/{fingerprint}"] = f"untrusted comment: {fingerprint}\n{key}"
+
+    if build_request.repositories or settings.cache_url:
+        apk_mode, base = _read_repositories(container)
         repo_file = "repositories" if apk_mode else "repositories.conf"
 
-        base = ""
-        if build_request.repositories_mode == "append":
-            _, base, _ = run_cmd(container, ["cat", repo_file])
+        extra_repos: dict[str, str] = {}
+        if build_request.repositories:
+            extra_repos = validate_repos(build_request.repositories)
+            if build_request.repositories_mode != "append":
+                base = ""
 
-        merged = merge_repositories(base, allowed, apk_mode)
-        container.put_archive("/builder/", _make_tar({repo_file: merged}))
+        # Only rewriting for the cache must not drop unreadable feeds.
+        if base or build_request.repositories:
+            files[repo_file] = merge_repositories(
+                base, extra_repos, apk_mode, settings.cache_url
+            )
 
     if build_request.defaults:
-        container.put_archive(
-            "/builder/",
-            _make_tar(
-                {"asu-files/etc/uci-defaults/99-asu-defaults": build_request.defaults}
-            ),
-        )
+        files["asu-files/etc/uci-defaults/99-asu-defaults"] = build_request.defaults
+
+    if files:
+        container.put_archive("/builder/", _make_tar(files))
 
 
 def _build(build_request: BuildRequest, job=None):
@@ -136,6 +160,7 @@ def _build(build_request: BuildRequest, job=None):
     """
 
     build_start: float = perf_counter()
+    timer = StageTimer()
 
     request_hash = get_request_hash(build_request)
 
@@ -147,7 +172,13 @@ def _build(build_request: BuildRequest, job=None):
     job.meta["detail"] = "init"
     job.meta["imagebuilder_status"] = "init"
     job.meta["request"] = build_request
-    job.save_meta()
+    meta = JobMeta(job)
+    meta.save(force=True)
+
+    build_log: Optional[BuildLog] = None
+    if settings.build_log_lines:
+        build_log = BuildLog(job.id)
+        build_log.clear()
 
     log.debug(f"Building {build_request}")
 
@@ -162,7 +193,7 @@ def _build(build_request: BuildRequest, job=None):
 
     environment: dict[str, str] = {}
 
-    image = f"{settings.base_container}:{build_request.target.replace('/', '-')}-{container_version_tag}"
+    image = f"{settings.base_container}:{get_image_tag(build_request.version, build_request.target)}"
 
     if is_snapshot_build(build_request.version):
         environment.update(
@@ -175,69 +206,129 @@ def _build(build_request: BuildRequest, job=None):
         )
 
     job.meta["imagebuilder_status"] = "container_setup"
-    job.save_meta()
-
-    log.info(f"Pulling {image}...")
-    try:
-        podman.images.pull(image)
-    except errors.ImageNotFound:
-        report_error(
-            job,
-            f"Image not found: {image}. If this version was just released, please try again in a few hours as it may take some time to become fully available.",
-        )
-    log.info(f"Pulling {image}... done")
-
-    mounts: list[dict[str, Union[str, bool]]] = [
-        {"type": "tmpfs", "target": f"/builder/{request_hash}"},
-    ]
-
-    container = podman.containers.create(
-        image,
-        command=["sleep", str(parse_timeout(settings.job_timeout))],
-        mounts=mounts,
-        cap_drop=["all"],
-        no_new_privileges=True,
-        privileged=False,
-        network_mode="bridge",
-        networks={"asu-build": {}},
-        environment=environment,
-        image_volume_mode="ignore",
-    )
-    try:
-        container.start()
+    meta.save()
 
+    imagebuilder_cache = ImageBuilderCache(podman)
+    revision: str = ""
+    cached_image: Optional[str] = None
+    with timer("pull"), stage_slot("network"):
         if is_snapshot_build(build_request.version):
-            log.info("Running setup.sh for ImageBuilder")
-            returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-                container, ["sh", "setup.sh"]
-            )
-            if returncode:
-                report_error(job, f"Could not set up ImageBuilder ({returncode=})")
-
-        inject_files(container, build_request, job)
+            revision = get_revision(build_request.version, build_request.target)
+            log.debug(f"Upstream revision: {revision}")
+            cached_image = imagebuilder_cache.get(image, revision)
+
+        if not cached_image:
+            try:
+                pull_image(podman, image)
+            except errors.ImageNotFound:
+                report_error(
+                    job,
+                    f"Image not found: {image}. If this version was just released, please try again in a few hours as it may take some time to become fully available.",
+                )
 
-        # If a caching proxy is configured, rewrite repository URLs
-        # from https://host/path to http://cache/host/path
-        if settings.cache_url:
-            cache_host = settings.cache_url.rstrip("/")
-            repo_file = (
-                "repositories" if _detect_apk_mode(container) else "repositories.conf"
-            )
-            run_cmd(
-                container,
-                ["sed", "-i", f"s|https://|{cache_host}/|g", repo_file],
+    pool = ContainerPool(podman)
+    package_cache = PackageCache(podman, build_request)
+    pool_key: str = f"{image}@{revision}" if revision else image
+    if build_request.repositories:
+        # Their containers run without the package cache and are kept apart.
+        pool_key += "+repositories"
+
+    with timer("container"):
+        # Without a known revision a pooled snapshot container may predate
+        # the requested one.
+        container = None
+        if revision or not (
+            is_snapshot_build(build_request.version) and build_request.version_code
+        ):
+            container = pool.acquire(pool_key, job)
+
+        ready: bool = container is not None
+
+        if container is None:
+            mounts: list[dict[str, Union[str, bool]]] = [
+                {"type": "tmpfs", "target": WORKSPACE},
+            ]
+
+            container = podman.containers.create(
+                cached_image or image,
+                command=[
+                    "sleep",
+                    str(
+                        pool.ttl
+                        if pool.enabled
+                        else parse_timeout(settings.job_timeout)
+                    ),
+                ],
+                mounts=mounts,
+                volumes=package_cache.volumes(),
+                labels=pool.labels(job),
+                cap_drop=["all"],
+                no_new_privileges=True,
+                privileged=False,
+                network_mode="bridge",
+                networks={"asu-build": {}},
+                environment=environment,
+                image_volume_mode="ignore",
             )
-
-        returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-            container, ["make", "info"]
-        )
+    try:
+        if not ready:
+            with timer("container"):
+                container.start()
+                package_cache.prepare(container)
+
+            if is_snapshot_build(build_request.version) and not cached_image:
+                with timer("setup"), stage_slot("network"):
+                    log.info("Running setup.sh for ImageBuilder")
+                    returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
+                        container, ["sh", "setup.sh"], build_log=build_log
+                    )
+                    if returncode:
+                        report_error(
+                            job, f"Could not set up ImageBuilder ({returncode=})"
+                        )
+
+                    imagebuilder_cache.store(container, image, revision)
+
+            if pool.enabled:
+                with timer("container"):
+                    pool.snapshot(container)
+            ready = True
+
+        with timer("inject"):
+            inject_files(container, build_request, job)
+
+        # Snapshot records can only be shared once the revision is known.
+        image_key: str = ""
+        if revision or not is_snapshot_build(build_request.version):
+            image_key = get_image_key(container, revision)
+
+        info: Optional[dict] = load_info(image_key) if image_key else None
+        if info is None:
+            with timer("info"):
+                returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
+                    container, ["make", "info"]
+                )
+            info = parse_info(job.meta["stdout"])
+            if image_key and (not revision or info["revision"] == revision):
+                save_info(image_key, info)
+        else:
+            log.debug(f"Using cached ImageBuilder info for {image_key}")
 
         job.meta["imagebuilder_status"] = "validate_revision"
-        job.save_meta()
+        meta.save()
 
-        version_code = re.search('Current Revision: "(r.+)"', job.meta["stdout"]).group(
-            1
-        )
+        version_code = info["revision"]
+        if not version_code:
+            report_error(job, "Could not determine ImageBuilder revision")
+
+        if revision and version_code != revision:
+            # Upstream changed between the revision lookup and setup.sh, so
+            # neither the cached image nor this container match the tag.
+            # Records of this build belong to the revision it reports.
+            log.warning(f"Revision {version_code} does not match {revision}")
+            imagebuilder_cache.remove(image, revision)
+            ready = False
+            image_key = get_image_key(container, version_code)
 
         if requested := build_request.version_code:
             if version_code != requested:
@@ -246,20 +337,13 @@ def _build(build_request: BuildRequest, job=None):
                     f"Received incorrect version {version_code} (requested {requested})",
                 )
 
-        default_packages = set(
-            re.search(r"Default Packages: (.*)\n", job.meta["stdout"]).group(1).split()
-        )
+        default_packages = set(info["default_packages"])
         log.debug(f"Default packages: {default_packages}")
 
-        profile_packages = set(
-            re.search(
-                r"{}:\n    .+\n    Packages: (.*?)\n".format(build_request.profile),
-                job.meta["stdout"],
-                re.MULTILINE,
-            )
-            .group(1)
-            .split()
-        )
+        if build_request.profile not in info["profiles"]:
+            report_error(job, f"Profile {build_request.profile} not in ImageBuilder")
+
+        profile_packages = set(info["profiles"][build_request.profile])
 
         apply_package_changes(build_request)
 
@@ -283,25 +367,47 @@ def _build(build_request: BuildRequest, job=None):
             log.debug(f"Diffed packages: {build_cmd_packages}")
 
         job.meta["imagebuilder_status"] = "validate_manifest"
-        job.save_meta()
-
-        returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-            container,
-            [
-                "make",
-                "manifest",
-                f"PROFILE={build_request.profile}",
-                f"PACKAGES={' '.join(build_cmd_packages)}",
-                "STRIP_ABI=1",
-            ],
-        )
+        meta.save()
 
-        job.save_meta()
+        # Custom repositories change independently of the ImageBuilder.
+        manifest_cacheable: bool = bool(image_key) and not build_request.repositories
 
-        if returncode:
-            report_error(job, check_package_errors(job.meta["stderr"]))
+        manifest: Optional[dict[str, str]] = None
+        if manifest_cacheable:
+            manifest = load_manifest(
+                image_key, build_request.profile, build_cmd_packages
+            )
+
+        if manifest is None:
+            with timer("manifest"), stage_slot("network"):
+                returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
+                    container,
+                    [
+                        "make",
+                        "manifest",
+                        f"PROFILE={build_request.profile}",
+                        f"PACKAGES={' '.join(build_cmd_packages)}",
+                        "STRIP_ABI=1",
+                    ],
+                    build_log=build_log,
+                )
+
+            meta.save()
+
+            if returncode:
+                missing, conflicts = parse_package_errors(job.meta["stderr"])
+                if not build_request.repositories:
+                    save_package_errors(build_request, version_code, missing, conflicts)
+                report_error(job, format_package_errors(missing, conflicts))
+
+            manifest = parse_manifest(job.meta["stdout"])
+            if manifest_cacheable:
+                save_manifest(
+                    image_key, build_request.profile, build_cmd_packages, manifest
+                )
+        else:
+            log.debug("Using cached manifest")
 
-        manifest: dict[str, str] = parse_manifest(job.meta["stdout"])
         log.debug(f"Manifest: {manifest}")
 
         # Check if all requested packages are in the manifest
@@ -311,13 +417,31 @@ def _build(build_request: BuildRequest, job=None):
         packages_hash: str = get_packages_hash(manifest.keys())
         log.debug(f"Packages Hash: {packages_hash}")
 
+        # Custom repositories may ship other packages under the same names
+        # and versions, so only builds from upstream feeds are shared.
+        artifact_hash: str = ""
+        if not build_request.repositories:
+            artifact_hash = get_artifact_hash(build_request, version_code, manifest)
+
+        if artifact_hash:
+            with timer("link"):
+                json_content = link_artifact(artifact_hash, request_hash)
+
+            if json_content is not None:
+                if not isinstance(get_store(), LocalStore):
+                    shutil.rmtree(bin_dir, ignore_errors=True)
+
+                json_content["bin_dir"] = request_hash
+                json_content["build_cmd_packages"] = build_cmd_packages
+                return _finish(meta, build_request, json_content, build_start, timer)
+
         job.meta["build_cmd"] = [
             "make",
             "image",
             f"PROFILE={build_request.profile}",
             f"PACKAGES={' '.join(build_cmd_packages)}",
             f"EXTRA_IMAGE_NAME={packages_hash[:12]}",
-            f"BIN_DIR=/builder/{request_hash}",
+            f"BIN_DIR={WORKSPACE}/{request_hash}",
         ]
 
         if build_request.defaults:
@@ -339,17 +463,38 @@ def _build(build_request: BuildRequest, job=None):
         log.debug("Build command: %s", job.meta["build_cmd"])
 
         job.meta["imagebuilder_status"] = "building_image"
-        job.save_meta()
+        meta.save()
 
-        returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-            container,
-            job.meta["build_cmd"],
-            copy=["/builder/" + request_hash, bin_dir.parent],
-        )
+        with timer("packages"):
+            package_cache.fetch(container, image_key, manifest)
+
+        with timer("image"), stage_slot("cpu"):
+            returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
+                container, job.meta["build_cmd"], build_log=build_log
+            )
+
+        # A failed build is reported below from its output, there is
+        # nothing to copy.
+        if not returncode:
+            with timer("copy"):
+                copy_from_container(
+                    container, f"{WORKSPACE}/{request_hash}", bin_dir.parent
+                )
+                record_workspace_size(
+                    build_request,
+                    sum(f.stat().st_size for f in bin_dir.rglob("*") if f.is_file()),
+                )
+
+            with timer("packages"):
+                package_cache.store(container, image_key)
     finally:
-        _cleanup_container(container)
+        with timer("release"):
+            if ready:
+                pool.release(container, pool_key)
+            else:
+                pool.discard(container)
 
-    job.save_meta()
+    meta.save()
 
     if any(err in job.meta["stderr"] for err in ["is too big", "out of space?"]):
         report_error(job, "Selected packages exceed device storage")
@@ -384,74 +529,24 @@ def _build(build_request: BuildRequest, job=None):
 
     log.info(f"Signing images: {images}")
 
-    # job.meta["imagebuilder_status"] = "signing_images"
-    job.save_meta()
-
     build_key = getenv("BUILD_KEY") or str(Path.cwd() / "key-build")
 
     if Path(build_key).is_file():
         log.info(f"Signing images with key {build_key}")
-        container = podman.containers.create(
-            image,
-            mounts=[
-                {
-                    "type": "bind",
-                    "source": build_key,
-                    "target": "/builder/key-build",
-                    "read_only": True,
-                },
-                {
-                    "type": "bind",
-                    "source": build_key + ".ucert",
-                    "target": "/builder/key-build.ucert",
-                    "read_only": True,
-                },
-                {
-                    "type": "bind",
-                    "source": str(bin_dir),
-                    "target": "/work",
-                    "read_only": False,
-                },
-            ],
-            user="root",
-            working_dir="/work",
-            environment={
-                "IMAGES_TO_SIGN": " ".join(images),
-                "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/builder/staging_dir/host/bin",
-            },
-            image_volume_mode="ignore",
-        )
         try:
-            container.start()
-            returncode, job.meta["stdout"], job.meta["stderr"] = run_cmd(
-                container,
-                [
-                    "bash",
-                    "-c",
-                    (
-                        "env;"
-                        "for IMAGE in $IMAGES_TO_SIGN; do "
-                        "touch ${IMAGE}.test;"
-                        'fwtool -t -s /dev/null "$IMAGE" && echo "sign entfern";'
-                        'cp "/builder/key-build.ucert" "$IMAGE.ucert" && echo "moved";'
-                        'usign -S -m "$IMAGE" -s "/builder/key-build" -x "$IMAGE.sig"  && echo "usign";'
-                        'ucert -A -c "$IMAGE.ucert" -x "$IMAGE.sig" && echo "ucert";'
-                        'fwtool -S "$IMAGE.ucert" "$IMAGE" && echo "fwtool";'
-                        "done"
-                    ),
-                ],
-            )
-        finally:
-            _cleanup_container(container)
-        job.save_meta()
+            with timer("sign"), stage_slot("cpu"):
+                sign_images([bin_dir / i for i in images], Path(build_key))
+        except (OSError, ValueError) as e:
+            report_error(job, f"Failed to sign images: {e}")
     else:
         log.warning("No build key found, skipping signing")
 
-    store = get_store()
-    store.upload_dir(bin_dir, request_hash)
+    with timer("upload"), stage_slot("network"):
+        store = get_store()
+        store.upload_dir(bin_dir, request_hash)
 
-    if not isinstance(store, LocalStore):
-        shutil.rmtree(bin_dir, ignore_errors=True)
+        if not isinstance(store, LocalStore):
+            shutil.rmtree(bin_dir, ignore_errors=True)
 
     json_content.update({"manifest": manifest})
     json_content.update(json_content["profiles"][build_request.profile])
@@ -464,6 +559,22 @@ def _build(build_request: BuildRequest, job=None):
     ).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
     json_content["detail"] = "done"
 
+    if artifact_hash:
+        save_artifact(artifact_hash, request_hash, json_content)
+
+    return _finish(meta, build_request, json_content, build_start, timer)
+
+
+def _finish(
+    meta: JobMeta,
+    build_request: BuildRequest,
+    json_content: dict,
+    build_start: float,
+    timer: StageTimer,
+) -> dict:
+    """Log the stats of a finished build and mark its job done."""
+    json_content["timings"] = timer.rounded()
+
     log.debug("JSON content %s", json_content)
 
     add_timestamp(
@@ -488,9 +599,10 @@ def _build(build_request: BuildRequest, job=None):
         },
         build_duration,
     )
+    add_stage_timings(build_request, timer.durations)
 
-    job.meta["imagebuilder_status"] = "done"
-    job.save_meta()
+    meta.job.meta["imagebuilder_status"] = "done"
+    meta.save()
 
     return json_content
 
@@ -77,6 +77,8 @@ class Settings(BaseSettings):
     public_path: Path = Path("/public")
     redis_url: str = "redis://localhost:6379"
     upstream_url: str = "https://downloads.openwrt.org"
+    upstream_cache_mb: int = 64  # upstream bodies kept for revalidation, 0 disables
+    metadata_refresh_interval: str = "5m"  # background upstream polling, 0 disables
     cache_url: str = ""
     allow_defaults: bool = False
     async_queue: bool = True
@@ -115,6 +117,31 @@ class Settings(BaseSettings):
     build_failure_ttl: str = "1h"
     max_pending_jobs: int = 200
     job_timeout: str = "10m"
+    image_pull_ttl: str = "10m"  # skip registry pulls of fresher images
+    container_pool_size: int = 2  # idle containers kept per image, 0 disables
+    container_pool_ttl: str = "1h"
+    container_pool_idle: str = "15m"
+    container_reap_interval: str = "5m"  # sweep for containers of dead jobs
+    imagebuilder_cache_revisions: int = 2  # per snapshot image, 0 disables
+    imagebuilder_info_ttl: str = "7d"
+    manifest_cache_ttl: str = "1h"  # package feeds change within a revision
+    build_log_lines: int = 200  # output tail kept per running job, 0 disables
+    package_cache_volume: str = "asu-package-cache"  # empty disables
+    package_cache_size_mb: int = 10240
+    build_session_size: int = 4  # queued builds of one image run back to back
+    worker_concurrency: int = 4  # builds per ConcurrentWorker process
+    worker_network_slots: int = 4  # concurrent pulls, manifests and uploads
+    worker_cpu_slots: int = 2  # concurrent make image and signing
+    admission_control: bool = True  # defer builds the podman host has no room for
+    build_memory_mb: int = 1024  # per build, besides its images in tmpfs
+    build_workspace_mb: int = 256  # image size estimate for new targets
+    host_memory_reserve_mb: int = 1024
+    host_disk_reserve_mb: int = 2048
+    build_memory_ramp: str = "2m"  # until a build's memory shows as used
+    builder_backend: str = "podman"  # "podman" or "simulated"
+    simulated_imagebuilder: Path = Path(__file__).parent / "simulated_imagebuilder"
+    simulated_latency: dict[str, float] = {}  # seconds per stage, e.g. "image"
+    simulated_failure_rate: float = 0.0
 
 
 settings = Settings()
@@ -0,0 +1,228 @@
+import json
+import logging
+from time import sleep, time
+from typing import Optional
+from uuid import uuid4
+
+from podman import PodmanClient, errors
+from podman.domain.containers import Container
+from redis import Redis
+from redis.exceptions import WatchError
+from rq.utils import parse_timeout
+
+from asu.config import settings
+from asu.util import get_podman_host, get_redis_client, get_str_hash
+
+log = logging.getLogger("rq.worker")
+
+
+def pull_image(podman: PodmanClient, image: str) -> None:
+    """Pull an image unless it was pulled recently on the same podman host.
+
+    The time and image ID of the last pull are recorded per podman host and
+    tag.  Within `image_pull_ttl` the registry round trip is skipped.  A
+    Redis lock makes sure only one worker per podman host pulls a tag, so
+    workers starting the same image after a release wait for that pull
+    instead of each pulling it themselves.
+
+    Raises:
+        ImageNotFound: when the registry does not have the image
+    """
+    rc = get_redis_client()
+    key = f"image:pull:{get_podman_host(podman)}:{image}"
+    ttl = parse_timeout(settings.image_pull_ttl)
+
+    def fresh() -> bool:
+        pulled_at = rc.hget(key, "pulled_at")
+        return (
+            pulled_at is not None
+            and time() - float(pulled_at) < ttl
+            and podman.images.exists(image)
+        )
+
+    if fresh():
+        log.info(f"Pulled {image} recently, skipping pull")
+        return
+
+    # Single flight: wait for a pull of the same tag by another worker.  The
+    # lock holds a token of its owner, so only the owner releases it, not
+    # a worker whose lock expired and was taken over.
+    lock = f"{key}:lock"
+    token = uuid4().hex
+    timeout = parse_timeout(settings.job_timeout)
+    deadline = time() + timeout
+    while not rc.set(lock, token, nx=True, ex=timeout):
+        if time() > deadline:
+            log.warning(f"Timed out waiting for a pull of {image}, pulling")
+            token = ""
+            break
+        sleep(1)
+        if fresh():
+            log.info(f"Pulled {image} by another worker, skipping pull")
+            return
+
+    try:
+        log.info(f"Pulling {image}...")
+        pulled = podman.images.pull(image)
+        rc.hset(key, mapping={"pulled_at": time(), "id": pulled.id})
+        rc.expire(key, ttl)
+        log.info(f"Pulling {image}... done")
+    finally:
+        if token:
+            release_lock(rc, lock, token)
+
+
+def release_lock(rc: Redis, lock: str, token: str) -> None:
+    """Delete a lock if it still holds `token`."""
+    with rc.pipeline() as pipeline:
+        while True:
+            try:
+                pipeline.watch(lock)
+                if pipeline.get(lock) != token:
+                    return
+                pipeline.multi()
+                pipeline.delete(lock)
+                pipeline.execute()
+                return
+            except WatchError:
+                continue  # The lock changed, check its owner again.
+
+
+class ImageBuilderCache:
+    """Cache of set up snapshot ImageBuilders on the podman host.
+
+    Snapshot containers only ship `setup.sh`, which downloads, verifies and
+    extracts the ImageBuilder of the current upstream revision.  Once that
+    succeeded the container is committed to a local image tagged with the
+    upstream revision.  Later jobs for the same revision start from that
+    image, whose layers are shared read-only between containers, and skip
+    `setup.sh` entirely.
+
+    Only the newest `imagebuilder_cache_revisions` images are kept per
+    ImageBuilder image.
+    """
+
+    REPOSITORY = "localhost/asu-imagebuilder"
+    LABEL_IMAGE = "asu.imagebuilder"
+    LABEL_REVISION = "asu.revision"
+
+    def __init__(self, podman: PodmanClient):
+        self.podman = podman
+        self.revisions = settings.imagebuilder_cache_revisions
+
+    @property
+    def enabled(self) -> bool:
+        return self.revisions > 0
+
+    def tag(self, image: str, revision: str) -> str:
+        return f"{image.rsplit(':', 1)[1]}-{revision}"
+
+    def get(self, image: str, revision: str) -> Optional[str]:
+        """Return the cached image for `image` at `revision`, if any."""
+        if not (self.enabled and revision):
+            return None
+
+        cached = f"{self.REPOSITORY}:{self.tag(image, revision)}"
+        if not self.podman.images.exists(cached):
+            return None
+
+        log.info(f"Using cached ImageBuilder {cached}")
+        return cached
+
+    def store(self, container: Container, image: str, revision: str) -> None:
+        """Commit a freshly set up container and evict older revisions."""
+        if not (self.enabled and revision):
+            return
+
+        tag = self.tag(image, revision)
+        log.info(f"Caching ImageBuilder {self.REPOSITORY}:{tag}")
+        try:
+            container.commit(
+                repository=self.REPOSITORY,
+                tag=tag,
+                changes=[
+                    f"LABEL {self.LABEL_IMAGE}={image}",
+                    f"LABEL {self.LABEL_REVISION}={revision}",
+                ],
+            )
+        except errors.APIError as e:
+            log.warning(f"Failed to cache ImageBuilder {tag}: {e}")
+            return
+
+        self.evict(image)
+
+    def remove(self, image: str, revision: str) -> None:
+        """Drop a cached image, e.g. when its revision turned out wrong."""
+        try:
+            self.podman.images.remove(f"{self.REPOSITORY}:{self.tag(image, revision)}")
+        except errors.APIError as e:
+            log.warning(f"Failed to remove cached ImageBuilder: {e}")
+
+    def evict(self, image: str) -> None:
+        cached = sorted(
+            self.podman.images.list(filters={"label": f"{self.LABEL_IMAGE}={image}"}),
+            key=lambda i: i.attrs.get("Created", 0),
+            reverse=True,
+        )
+        for old in cached[self.revisions :]:
+            log.info(f"Evicting cached ImageBuilder {old.tags}")
+            try:
+                old.remove()
+            except errors.APIError as e:
+                # Still used by a running (e.g. pooled) container.
+                log.debug(f"Failed to evict cached ImageBuilder: {e}")
+
+
+def get_image_key(container: Container, revision: str = "") -> str:
+    """Return the key of a container's ImageBuilder for cached records.
+
+    Snapshot containers that ran `setup.sh` share the image of the base
+    container for every revision, so the revision is part of their key.
+    """
+    image_id = container.attrs["Image"]
+    return f"{image_id}:{revision}" if revision else image_id
+
+
+def _load(key: str) -> Optional[dict]:
+    value = get_redis_client().get(key)
+    return json.loads(value) if value else None
+
+
+def _save(key: str, value: dict, ttl: str) -> None:
+    get_redis_client().set(key, json.dumps(value), ex=parse_timeout(ttl))
+
+
+def load_info(image_key: str) -> Optional[dict]:
+    """Return a cached `make info` record, see `asu.util.parse_info`."""
+    return _load(f"imagebuilder:info:{image_key}")
+
+
+def save_info(image_key: str, info: dict) -> None:
+    _save(f"imagebuilder:info:{image_key}", info, settings.imagebuilder_info_ttl)
+
+
+def get_manifest_key(image_key: str, profile: str, packages: list[str]) -> str:
+    """Return the key of a resolved manifest.
+
+    The package list is hashed as passed to `make manifest`, since order
+    and `-` prefixes change what the package manager resolves.
+    """
+    return (
+        f"imagebuilder:manifest:{image_key}:"
+        f"{get_str_hash(profile + ' ' + ' '.join(packages))}"
+    )
+
+
+def load_manifest(image_key: str, profile: str, packages: list[str]) -> Optional[dict]:
+    """Return a cached manifest, see `asu.util.parse_manifest`."""
+    return _load(get_manifest_key(image_key, profile, packages))
+
+
+def save_manifest(
+    image_key: str, profile: str, packages: list[str], manifest: dict[str, str]
+) -> None:
+    _save(
+        get_manifest_key(image_key, profile, packages),
+        manifest,
+        settings.manifest_cache_ttl,
+    )
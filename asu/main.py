@@ -1,5 +1,6 @@
+import asyncio
 import logging
-from collections import defaultdict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 from typing import Union
@@ -8,27 +9,49 @@ from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from rq.utils import parse_timeout
 
 from asu import __version__
 from asu.config import settings
 from asu.routers import api, stats
 from asu.store import LocalStore, get_store
 from asu.util import (
-    client_get,
+    async_client_get,
+    close_async_http_client,
     get_branch,
+    init_metadata,
     is_post_kmod_split_build,
     parse_feeds_conf,
     parse_kernel_version,
     parse_packages_file,
+    refresh_metadata_forever,
     reload_targets,
     reload_versions,
+    sync_metadata,
 )
 
 logging.basicConfig(encoding="utf-8", level=settings.log_level)
 
 base_path = Path(__file__).resolve().parent
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start with the metadata of other API processes, if there is any.
+    await sync_metadata(app, force=True)
+    if not app.versions:
+        await reload_versions(app)
+    logging.info(f"Found {len(app.versions)} versions")
+    if parse_timeout(settings.metadata_refresh_interval):
+        app.refresher = asyncio.create_task(refresh_metadata_forever(app))
+    yield
+    if app.refresher is not None:
+        app.refresher.cancel()
+        app.refresher = None
+    await close_async_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(api.router, prefix="/api/v1")
 app.include_router(stats.router, prefix="/api/v1")
 
@@ -38,13 +61,14 @@ app.mount("/static", StaticFiles(directory=base_path / "static"), name="static")
 
 templates = Jinja2Templates(directory=base_path / "templates")
 
-app.latest = []
-app.versions = []
-reload_versions(app)
-logging.info(f"Found {len(app.versions)} versions")
+init_metadata(app)
+app.refresher = None  # keeps the metadata current while the app runs
 
-app.targets = defaultdict(list)
-app.profiles = defaultdict(lambda: defaultdict(dict))
+
+@app.middleware("http")
+async def sync_metadata_middleware(request: Request, call_next):
+    await sync_metadata(app)
+    return await call_next(request)
 
 
 @app.api_route("/store/{path:path}", methods=["GET", "HEAD"])
@@ -96,13 +120,13 @@ def stats_page(request: Request):
 
 
 @app.get("/json/v1/{path:path}/index.json")
-def json_v1_target_index(path: str) -> dict[str, Union[str, dict[str, str]]]:
+async def json_v1_target_index(path: str) -> dict[str, Union[str, dict[str, str]]]:
     base_path: str = f"{settings.upstream_url}/{path}"
-    base_packages: dict[str, str] = parse_packages_file(f"{base_path}/packages")
+    base_packages: dict[str, str] = await parse_packages_file(f"{base_path}/packages")
     if is_post_kmod_split_build(path):
-        kmods_directory: str = parse_kernel_version(f"{base_path}/profiles.json")
+        kmods_directory: str = await parse_kernel_version(f"{base_path}/profiles.json")
         if kmods_directory:
-            kmod_packages: dict[str, str] = parse_packages_file(
+            kmod_packages: dict[str, str] = await parse_packages_file(
                 f"{base_path}/kmods/{kmods_directory}"
             )
             base_packages["packages"].update(kmod_packages.get("packages", {}))
@@ -110,20 +134,22 @@ def json_v1_target_index(path: str) -> dict[str, Union[str, dict[str, str]]]:
 
 
 @app.get("/json/v1/{path:path}/{arch:path}-index.json")
-def json_v1_arch_index(path: str, arch: str):
+async def json_v1_arch_index(path: str, arch: str):
     feed_url: str = f"{settings.upstream_url}/{path}/{arch}"
-    feeds: list[str] = parse_feeds_conf(feed_url)
+    feeds: list[str] = await parse_feeds_conf(feed_url)
     packages: dict[str, str] = {}
     for feed in feeds:
-        packages.update(parse_packages_file(f"{feed_url}/{feed}").get("packages", {}))
+        index = await parse_packages_file(f"{feed_url}/{feed}")
+        packages.update(index.get("packages", {}))
     return packages
 
 
 @app.get("/json/v1/{path:path}/targets/{target:path}/{profile:path}.json")
-def json_v1_profile(path: str, target: str, profile: str):
-    metadata: dict = client_get(
+async def json_v1_profile(path: str, target: str, profile: str):
+    response = await async_client_get(
         f"{settings.upstream_url}/{path}/targets/{target}/profiles.json"
-    ).json()
+    )
+    metadata: dict = response.json()
     profiles: dict = metadata.pop("profiles", {})
     if profile not in profiles:
         return {}
@@ -138,19 +164,21 @@ def json_v1_profile(path: str, target: str, profile: str):
     }
 
 
-def generate_latest():
-    reload_versions(app)  # Do a reload in case .versions.json has updated.
+async def generate_latest():
+    if app.refresher is None:
+        await reload_versions(app)  # Do a reload in case .versions.json has updated.
     return app.latest
 
 
 @app.get("/json/v1/latest.json")
-def json_v1_latest():
-    latest = generate_latest()
+async def json_v1_latest():
+    latest = await generate_latest()
     return {"latest": latest}
 
 
-def generate_branches():
-    reload_versions(app)  # Do a reload in case .versions.json has updated.
+async def generate_branches():
+    if app.refresher is None:
+        await reload_versions(app)  # Do a reload in case .versions.json has updated.
     branches = dict(**settings.branches)
 
     for branch in branches:
@@ -163,8 +191,8 @@ def generate_branches():
 
     for branch in branches:
         version = branches[branch]["versions"][0]
-        if not app.targets[version]:
-            reload_targets(app, version)
+        if not await app.targets.load(version):
+            await reload_targets(app, version)
 
         branches[branch]["targets"] = app.targets[version]
 
@@ -172,15 +200,16 @@ def generate_branches():
 
 
 @app.get("/json/v1/branches.json")
-def json_v1_branches():
-    return list(generate_branches().values())
+async def json_v1_branches():
+    branches = await generate_branches()
+    return list(branches.values())
 
 
 @app.get("/json/v1/overview.json")
-def json_v1_overview():
+async def json_v1_overview():
     overview = {
-        "latest": generate_latest(),
-        "branches": generate_branches(),
+        "latest": await generate_latest(),
+        "branches": await generate_branches(),
         "upstream_url": settings.upstream_url,
         "server": {
             "version": __version__,
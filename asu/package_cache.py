@@ -0,0 +1,180 @@
+import logging
+import shlex
+
+from podman import PodmanClient
+from podman.domain.containers import Container
+from rq.utils import parse_timeout
+
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.util import get_podman_host, get_redis_client, run_cmd
+
+log = logging.getLogger("rq.worker")
+
+PACKAGE_CACHE = "/cache/packages"
+
+INDEXES = """
+indexes=$(find tmp dl -type f \\( -name Packages -o -name Packages.gz \\
+    -o -name '*.adb' -o -name 'APKINDEX*.tar.gz' \\) 2>/dev/null | sort)
+"""
+
+# Packages are stored below the key of the ImageBuilder, with the hash of
+# the package indexes they were resolved from in `.index`.  Builds that
+# fetched the indexes (`make manifest`) only use files of the same hash;
+# builds that did not (cached manifest, cleaned pooled container) trust them
+# as long as the manifest cache would, as both assume unchanged feeds.
+#
+# Files are matched on name and version, with anything in between, as the
+# ImageBuilder saves packages under their ABI versioned name, which the
+# manifest strips.
+FETCH_SCRIPT = (
+    INDEXES
+    + """
+dir={cache}/{key}
+[ -f "$dir/.index" ] || exit 0
+if [ -n "$indexes" ]; then
+    index=$(cat $indexes repositories repositories.conf 2>/dev/null | sha256sum)
+    [ "${{index%% *}}" = "$(cat "$dir/.index")" ] || exit 0
+elif [ -n "$(find "$dir/.index" -mmin +{ttl})" ]; then
+    exit 0
+fi
+mkdir -p dl
+for package in {packages}; do
+    name=${{package%%/*}}
+    version=${{package#*/}}
+    for file in "$dir/$name"*[_-]"$version"[_.]*; do
+        [ -f "$file" ] || continue
+        cp "$file" dl/ && touch -c "$file"
+    done
+done
+true
+"""
+)
+
+# Runs after `make image`, which fetched the package indexes in any case.
+# Files of other indexes may carry other checksums under the same names and
+# are dropped.  Files are copied to a temporary name and renamed, so
+# concurrent writers of the same package never expose a partial file.
+STORE_SCRIPT = (
+    INDEXES
+    + """
+[ -n "$indexes" ] || exit 0
+index=$(cat $indexes repositories repositories.conf 2>/dev/null | sha256sum)
+index=${{index%% *}}
+dir={cache}/{key}
+mkdir -p "$dir"
+if [ "$(cat "$dir/.index" 2>/dev/null)" != "$index" ]; then
+    find "$dir" -type f -delete
+fi
+for file in dl/*.ipk dl/*.apk; do
+    [ -f "$file" ] || continue
+    name=${{file##*/}}
+    [ -e "$dir/$name" ] && continue
+    cp "$file" "$dir/.$name.$$" && mv -f "$dir/.$name.$$" "$dir/$name"
+done
+echo "$index" > "$dir/.index.$$" && mv -f "$dir/.index.$$" "$dir/.index"
+"""
+)
+
+# Removes least recently used files until the cache fits into its size.
+EVICT_SCRIPT = """
+size=$(du -sk {cache} | cut -f1)
+[ "$size" -le {limit} ] && exit 0
+find {cache} -type f -printf '%T@ %k %p\\n' | sort -n | \
+while read -r _ kb file; do
+    [ "$size" -le {limit} ] && break
+    rm -f "$file" && size=$((size - kb))
+done
+find {cache} -mindepth 1 -type d -empty -delete
+true
+"""
+
+
+class PackageCache:
+    """Package download cache shared by the build containers of a host.
+
+    A named podman volume is mounted into every build container.  Package
+    files downloaded by `make image` are stored in it below the key of the
+    ImageBuilder, together with the hash of the package indexes they were
+    resolved from, and are copied into the ImageBuilder's download directory
+    before later builds, turning downloads into local reads.
+
+    Builds from custom repositories run in containers without the volume.
+
+    The cache is bounded to `package_cache_size_mb`, evicting the least
+    recently used files at most once per `EVICT_INTERVAL` per podman host.
+    """
+
+    EVICT_INTERVAL = 300
+
+    def __init__(self, podman: PodmanClient, build_request: BuildRequest):
+        self.podman = podman
+        # Packages of custom repositories run their scripts in the container
+        # and must never reach the files of other builds.
+        self.volume = (
+            "" if build_request.repositories else settings.package_cache_volume
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.volume)
+
+    def volumes(self) -> dict[str, dict[str, str]]:
+        """Volumes to create build containers with."""
+        if not self.enabled:
+            return {}
+        return {self.volume: {"bind": PACKAGE_CACHE, "mode": "rw"}}
+
+    def prepare(self, container: Container) -> None:
+        """Allow the build user to write a freshly created volume."""
+        if self.enabled:
+            container.exec_run(["chmod", "1777", PACKAGE_CACHE], user="root")
+
+    def fetch(self, container: Container, key: str, manifest: dict[str, str]) -> None:
+        """Copy cached package files of a manifest into the container.
+
+        Args:
+            key: `get_image_key` of the container, empty if not shareable
+        """
+        if not (self.enabled and key):
+            return
+
+        packages = " ".join(
+            shlex.quote(f"{name}/{version}")
+            for name, version in sorted(manifest.items())
+        )
+        script = FETCH_SCRIPT.format(
+            cache=PACKAGE_CACHE,
+            key=shlex.quote(key),
+            packages=packages,
+            ttl=parse_timeout(settings.manifest_cache_ttl) // 60,
+        )
+        returncode, _, stderr = run_cmd(container, ["sh", "-c", script])
+        if returncode:
+            log.warning(f"Failed to fetch cached packages: {stderr}")
+
+    def store(self, container: Container, key: str) -> None:
+        """Store the package files the container downloaded."""
+        if not (self.enabled and key):
+            return
+
+        script = STORE_SCRIPT.format(cache=PACKAGE_CACHE, key=shlex.quote(key))
+        returncode, _, stderr = run_cmd(container, ["sh", "-c", script])
+        if returncode:
+            log.warning(f"Failed to store packages in cache: {stderr}")
+            return
+
+        self.evict(container)
+
+    def evict(self, container: Container) -> None:
+        key = f"package-cache:evicted:{get_podman_host(self.podman)}"
+        if not get_redis_client().set(key, 1, nx=True, ex=self.EVICT_INTERVAL):
+            return
+
+        limit = settings.package_cache_size_mb * 1024
+        returncode, _, stderr = run_cmd(
+            container,
+            ["sh", "-c", EVICT_SCRIPT.format(cache=PACKAGE_CACHE, limit=limit)],
+        )
+        if returncode:
+            log.warning(f"Failed to evict packages from cache: {stderr}")
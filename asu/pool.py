@@ -0,0 +1,331 @@
+import logging
+from time import time
+from typing import Optional
+
+from podman import PodmanClient, errors
+from podman.domain.containers import Container
+from redis.exceptions import WatchError
+from rq.job import Job, JobStatus
+from rq.utils import parse_timeout
+from rq.worker import Worker
+
+from asu.config import settings
+from asu.util import fetch_job, get_podman_host, get_redis_client, run_cmd
+
+log = logging.getLogger("rq.worker")
+
+# Files an ImageBuilder job may modify inside /builder, restored on reset.
+PRISTINE_FILES = ["repositories", "repositories.conf", "keys"]
+
+WORKSPACE = "/builder/workspace"
+
+
+def cleanup_container(container: Container) -> None:
+    """Kill and remove a container with its volumes."""
+    try:
+        container.kill()
+    except Exception:
+        pass
+    try:
+        container.remove(v=True, force=True)
+    except Exception as e:
+        log.warning(f"Failed to remove container {container.id[:12]}: {e}")
+
+
+class ContainerPool:
+    """Warm pool of started ImageBuilder containers.
+
+    RQ runs every job in a forked work horse, so the pool can not live in
+    process memory.  Idle containers keep running on the podman host and
+    are tracked in a Redis sorted set, one per podman host, with members
+    `<image> <container id>` scored by the time they were last released.
+    Claiming a container is an atomic ZREM, so concurrent workers never
+    share one.
+
+    Pooled containers run `sleep` for `container_pool_ttl` only, or
+    `job_timeout` if that is longer, which bounds both the staleness of
+    snapshot ImageBuilders and the lifetime of containers leaked by killed
+    work horses.
+
+    Build containers are labeled with the job and worker that created
+    them, and containers taken from the pool are recorded with the job and
+    worker using them in a Redis hash next to the pool.  `reap` removes
+    the containers whose job is no longer running.
+    """
+
+    LABEL_EXPIRES = "asu.pool.expires"
+    LABEL_JOB = "asu.job"
+    LABEL_WORKER = "asu.worker"
+
+    def __init__(self, podman: PodmanClient):
+        self.podman = podman
+        self.rc = get_redis_client()
+        self.key = f"pool:{get_podman_host(podman)}"
+        self.owners_key = f"{self.key}:owners"
+        self.size = settings.container_pool_size
+        # A container must outlive any build started in it.
+        self.ttl = max(
+            parse_timeout(settings.container_pool_ttl),
+            parse_timeout(settings.job_timeout),
+        )
+        self.idle = parse_timeout(settings.container_pool_idle)
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def labels(self, job: Optional[Job] = None) -> dict[str, str]:
+        """Labels for a container that may later be released to the pool."""
+        labels = {self.LABEL_EXPIRES: str(int(time()) + self.ttl)}
+        if job is not None:
+            labels[self.LABEL_JOB] = job.id
+            labels[self.LABEL_WORKER] = job.worker_name or ""
+        return labels
+
+    def usable(self, container: Container) -> bool:
+        """Check a container can still run a full job before it expires."""
+        expires = int(container.labels.get(self.LABEL_EXPIRES, 0))
+        return expires - time() > parse_timeout(settings.job_timeout)
+
+    def acquire(self, image: str, job: Optional[Job] = None) -> Optional[Container]:
+        """Claim the most recently used idle container for `image`.
+
+        Args:
+            image: pool key of the ImageBuilder image
+            job: job the container is claimed for, recorded for `reap`
+
+        Returns:
+            Container: running container, or None if the pool has none
+        """
+        if not self.enabled:
+            return None
+
+        self.evict()
+
+        for member in self.rc.zrevrange(self.key, 0, -1):
+            member_image, container_id = member.rsplit(" ", 1)
+            if member_image != image:
+                continue
+            if not self.claim(member, job):
+                continue  # Claimed by another worker.
+
+            try:
+                container = self.podman.containers.get(container_id)
+            except errors.NotFound:
+                self.rc.hdel(self.owners_key, container_id)
+                continue
+
+            if container.status == "running" and self.usable(container):
+                log.info(f"Reusing pooled container {container_id[:12]}")
+                return container
+
+            self.discard(container)
+
+        return None
+
+    def claim(self, member: str, job: Optional[Job]) -> bool:
+        """Remove a member from the pool and record its new owner.
+
+        Both happen in one transaction, so `reap` always finds a container
+        either pooled or owned.
+
+        Returns:
+            bool: whether the member was still pooled and is now ours
+        """
+        container_id = member.rsplit(" ", 1)[1]
+        with self.rc.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(self.key)
+                    if pipeline.zscore(self.key, member) is None:
+                        return False
+                    pipeline.multi()
+                    pipeline.zrem(self.key, member)
+                    if job is not None:
+                        pipeline.hset(
+                            self.owners_key,
+                            container_id,
+                            f"{job.id} {job.worker_name or ''}",
+                        )
+                    pipeline.execute()
+                    return True
+                except WatchError:
+                    continue  # The pool changed, check the member again.
+
+    def discard(self, container: Container) -> None:
+        """Remove a container that is not returned to the pool."""
+        cleanup_container(container)
+        self.rc.hdel(self.owners_key, container.id)
+
+    def snapshot(self, container: Container) -> None:
+        """Save the files a job may modify so `reset` can restore them."""
+        run_cmd(
+            container,
+            [
+                "sh",
+                "-c",
+                "mkdir -p .asu-pristine && "
+                f"for f in {' '.join(PRISTINE_FILES)}; do "
+                '[ -e "$f" ] && cp -a "$f" .asu-pristine/; '
+                "done; true",
+            ],
+        )
+
+    def reset(self, container: Container) -> bool:
+        """Return a used container to the state `snapshot` recorded."""
+        returncode, _, stderr = run_cmd(
+            container,
+            [
+                "sh",
+                "-c",
+                f"rm -rf {WORKSPACE}/* asu-files {' '.join(PRISTINE_FILES)} && "
+                "cp -a .asu-pristine/. . && "
+                "make clean",
+            ],
+        )
+        if returncode:
+            log.warning(f"Failed to reset container {container.id[:12]}: {stderr}")
+        return returncode == 0
+
+    def release(self, container: Container, image: str) -> None:
+        """Reset and return a container to the pool, or remove it."""
+        try:
+            keep = self.enabled and self.usable(container) and self.reset(container)
+        except Exception as e:
+            log.warning(f"Failed to reset container {container.id[:12]}: {e}")
+            keep = False
+
+        if not keep:
+            self.discard(container)
+            return
+
+        pipeline = self.rc.pipeline()
+        pipeline.zadd(self.key, {f"{image} {container.id}": time()})
+        pipeline.hdel(self.owners_key, container.id)
+        pipeline.execute()
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove idle containers that are expired or over the pool size.
+
+        Members are walked from most to least recently used, so the oldest
+        containers of an image are the ones evicted.
+        """
+        now = time()
+        kept: dict[str, int] = {}
+        for member, score in self.rc.zrevrange(self.key, 0, -1, withscores=True):
+            image, container_id = member.rsplit(" ", 1)
+            if now - score < self.idle and kept.get(image, 0) < self.size:
+                kept[image] = kept.get(image, 0) + 1
+                continue
+
+            if not self.rc.zrem(self.key, member):
+                continue
+
+            log.info(f"Evicting pooled container {container_id[:12]} ({image})")
+            try:
+                cleanup_container(self.podman.containers.get(container_id))
+            except errors.NotFound:
+                pass
+
+    def running(self, job_id: str, worker_name: str) -> bool:
+        """Check a job is running on a worker that is still alive."""
+        job = fetch_job(job_id)
+        if job is None or job.get_status() != JobStatus.STARTED:
+            return False
+        if not worker_name:
+            return True
+        return bool(
+            job.connection.exists(Worker.redis_worker_namespace_prefix + worker_name)
+        )
+
+    def kill(self, job_id: str) -> int:
+        """Remove the build containers of a job that is still running.
+
+        Used when a job timed out in a thread, which can not be interrupted
+        while it waits for an exec, unlike a work horse.
+
+        Returns:
+            int: number of removed containers
+        """
+        pipeline = self.rc.pipeline()
+        pipeline.zrange(self.key, 0, -1)
+        pipeline.hgetall(self.owners_key)
+        pooled, owners = pipeline.execute()
+        pooled_ids = {member.rsplit(" ", 1)[1] for member in pooled}
+
+        containers = self.podman.containers.list(
+            all=True, filters={"label": [self.LABEL_JOB]}
+        )
+
+        killed: int = 0
+        for container in containers:
+            if container.id in pooled_ids:
+                continue
+
+            owner = owners.get(container.id)
+            if owner:
+                owner_job = owner.partition(" ")[0]
+            else:
+                owner_job = container.labels.get(self.LABEL_JOB, "")
+
+            if owner_job == job_id:
+                log.info(f"Killing container {container.id[:12]} of job {job_id}")
+                self.discard(container)
+                killed += 1
+        return killed
+
+    def reap(self, force: bool = False) -> int:
+        """Remove build containers whose job is no longer running.
+
+        Killed work horses, OOM kills and reboots leave build containers
+        behind that hold their tmpfs workspace until `sleep` ends.  Runs at
+        most once per `container_reap_interval` per podman host, unless
+        forced like on worker startup.
+
+        Args:
+            force: sweep even if another worker did recently
+
+        Returns:
+            int: number of removed containers
+        """
+        interval = parse_timeout(settings.container_reap_interval)
+        if not force and not self.rc.set(f"{self.key}:reaped", 1, nx=True, ex=interval):
+            return 0
+
+        # Containers move between both on acquire and release, so they are
+        # read together, and before listing so new containers are labeled.
+        pipeline = self.rc.pipeline()
+        pipeline.zrange(self.key, 0, -1)
+        pipeline.hgetall(self.owners_key)
+        pooled, owners = pipeline.execute()
+        pooled_ids = {member.rsplit(" ", 1)[1] for member in pooled}
+
+        containers = self.podman.containers.list(
+            all=True, filters={"label": [self.LABEL_JOB]}
+        )
+
+        reaped: int = 0
+        for container in containers:
+            if container.id in pooled_ids:
+                continue  # Expired by `evict`.
+
+            owner = owners.get(container.id)
+            if owner:
+                job_id, _, worker_name = owner.partition(" ")
+            else:
+                job_id = container.labels.get(self.LABEL_JOB, "")
+                worker_name = container.labels.get(self.LABEL_WORKER, "")
+
+            if self.running(job_id, worker_name):
+                continue
+
+            log.info(f"Reaping container {container.id[:12]} of job {job_id}")
+            self.discard(container)
+            reaped += 1
+
+        # Forget owners of containers removed without `discard`.
+        if stale := set(owners) - {container.id for container in containers}:
+            self.rc.hdel(self.owners_key, *stale)
+
+        return reaped
@@ -24,12 +24,18 @@ def is_repo_allowed(repo_url: str, allow_list: list[str]) -> bool:
 
 
 def merge_repositories(
-    base_content: str, extra_repos: dict[str, str], apk_mode: bool
+    base_content: str,
+    extra_repos: dict[str, str],
+    apk_mode: bool,
+    cache_url: str = "",
 ) -> str:
     """Append extra repositories to existing content.
 
     For opkg (repositories.conf): entries are `src/gz <name> <url>`.
     For apk (repositories): entries are plain URLs, one per line.
+
+    With a caching proxy, repository URLs are rewritten from
+    https://host/path to <cache_url>/host/path.
     """
     lines = [line for line in base_content.splitlines() if line.strip()]
 
@@ -39,7 +45,13 @@ def merge_repositories(
         else:
             lines.append(f"src/gz {name} {url}")
 
-    if not apk_mode:
+    if cache_url:
+        cache_host = cache_url.rstrip("/")
+        lines = [line.replace("https://", f"{cache_host}/") for line in lines]
+
+    # Replaced feeds lose the local feed and signature check, so add them
+    # back. A rewrite for the cache alone leaves the file as it is.
+    if extra_repos and not apk_mode:
         if not any("src imagebuilder file:packages" in line for line in lines):
             lines.append("src imagebuilder file:packages")
         if not any("option check_signature" in line for line in lines):
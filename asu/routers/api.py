@@ -1,7 +1,8 @@
 import logging
-from typing import Union
+from typing import Optional, Union
 
 from fastapi import APIRouter, Header, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import RedirectResponse, Response
 from rq.job import Job
 
@@ -12,9 +13,15 @@ from asu.repositories import is_repo_allowed
 from asu.util import (
     add_timestamp,
     add_build_event,
-    client_get,
+    async_client_get,
     get_branch,
-    get_queue,
+    fetch_job,
+    get_build_log,
+    get_job_meta,
+    get_package_errors,
+    get_build_queue,
+    get_image_tag,
+    get_queue_length,
     get_request_hash,
     reload_profiles,
     reload_targets,
@@ -34,7 +41,7 @@ def get_distros() -> list:
 
 
 @router.get("/revision/{version}/{target}/{subtarget}")
-def api_v1_revision(
+async def api_v1_revision(
     version: str, target: str, subtarget: str, response: Response, request: Request
 ):
     branch_data = get_branch(version)
@@ -45,7 +52,7 @@ def api_v1_revision(
             "status": 400,
         }
     version_path = branch_data["path"].format(version=version)
-    req = client_get(
+    req = await async_client_get(
         settings.upstream_url
         + f"/{version_path}/targets/{target}/{subtarget}/profiles.json"
     )
@@ -75,7 +82,7 @@ def validation_failure(detail: str) -> tuple[dict[str, Union[str, int]], int]:
     return {"detail": detail, "status": 400}, 400
 
 
-def validate_request(
+async def validate_request(
     app,
     build_request: BuildRequest,
 ) -> tuple[dict[str, Union[str, int]], int]:
@@ -108,7 +115,7 @@ def validate_request(
         return validation_failure(f"Unsupported branch: {build_request.version}")
 
     if build_request.version not in app.versions:
-        reload_versions(app)
+        await reload_versions(app)
         if build_request.version not in app.versions:
             return validation_failure(f"Unsupported version: {build_request.version}")
 
@@ -117,8 +124,8 @@ def validate_request(
         for x in (build_request.packages_versions.keys() or build_request.packages)
     ]
 
-    if build_request.target not in app.targets[build_request.version]:
-        reload_targets(app, build_request.version)
+    if build_request.target not in await app.targets.load(build_request.version):
+        await reload_targets(app, build_request.version)
         if build_request.target not in app.targets[build_request.version]:
             return validation_failure(
                 f"Unsupported target: {build_request.target}. The requested "
@@ -137,8 +144,9 @@ def validate_request(
             return True
         return False
 
+    await app.profiles.load(build_request.version, build_request.target)
     if not valid_profile(build_request.profile, build_request):
-        reload_profiles(app, build_request.version, build_request.target)
+        await reload_profiles(app, build_request.version, build_request.target)
         if not valid_profile(build_request.profile, build_request):
             return validation_failure(
                 f"Unsupported profile: {build_request.profile}. The requested "
@@ -149,17 +157,21 @@ def validate_request(
     build_request.profile = app.profiles[build_request.version][build_request.target][
         build_request.profile
     ]
+
+    # Requests failing like an earlier build need no container to find out,
+    # and fail with the status of that build.
+    if error := await get_package_errors(build_request):
+        logging.info(f"Known package error {error = }")
+        return {"detail": f"Error: {error}", "status": 500}, 500
+
     return ({}, None)
 
 
 def return_job_v1(job: Job) -> tuple[dict, int, dict]:
-    response: dict = job.get_meta()
+    response: dict = get_job_meta(job)
     imagebuilder_status: str = "done"
     queue_position: int = 0
 
-    if job.meta:
-        response.update(job.meta)
-
     if job.is_failed:
         error_message: str = job.latest_result().exc_string
         if "stderr" in response:
@@ -176,7 +188,7 @@ def return_job_v1(job: Job) -> tuple[dict, int, dict]:
         imagebuilder_status = "queued"
 
     elif job.is_started:
-        response.update(status=202, detail="started")
+        response.update(status=202, detail="started", log=get_build_log(job.id))
         imagebuilder_status = response.get("imagebuilder_status", "init")
 
     elif job.is_finished:
@@ -197,7 +209,7 @@ def return_job_v1(job: Job) -> tuple[dict, int, dict]:
 @router.head("/build/{request_hash}")
 @router.get("/build/{request_hash}")
 def api_v1_build_get(request: Request, request_hash: str, response: Response) -> dict:
-    job: Job = get_queue().fetch_job(request_hash)
+    job: Job = fetch_job(request_hash)
     if not job:
         response.status_code = 404
         return {
@@ -213,28 +225,13 @@ def api_v1_build_get(request: Request, request_hash: str, response: Response) ->
     return content
 
 
-@router.post("/build")
-def api_v1_build_post(
-    build_request: BuildRequest,
-    response: Response,
-    request: Request,
-    user_agent: str = Header(None),
-):
-    # Sanitize the profile in case the client did not (bug in older LuCI app).
-    build_request.profile = build_request.profile.replace(",", "_")
-
+def find_build(
+    build_request: BuildRequest, request_hash: str, user_agent: str
+) -> Optional[Job]:
+    """Count a build request and return the job building it, if any."""
     add_build_event("requests")
 
-    request_hash: str = get_request_hash(build_request)
-    job: Job = get_queue().fetch_job(request_hash)
-    status: int = 200
-    if build_request.defaults:
-        result_ttl = settings.build_defaults_ttl
-    elif build_request.packages_versions:
-        result_ttl = settings.build_ttl
-    else:
-        result_ttl = settings.build_ttl_unversioned
-    failure_ttl: str = settings.build_failure_ttl
+    job: Job = fetch_job(request_hash)
 
     if build_request.client:
         client = build_request.client
@@ -250,34 +247,74 @@ def api_v1_build_post(
 
     if job is None:
         add_build_event("cache-misses")
+    elif job.is_finished:
+        add_build_event("cache-hits")
 
-        content, status = validate_request(request.app, build_request)
-        if content:
-            response.status_code = status
-            return content
+    return job
+
+
+def enqueue_build(
+    build_request: BuildRequest, request_hash: str
+) -> tuple[dict, int, dict]:
+    """Queue a validated build request, unless the server is overloaded."""
+    if build_request.defaults:
+        result_ttl = settings.build_defaults_ttl
+    elif build_request.packages_versions:
+        result_ttl = settings.build_ttl
+    else:
+        result_ttl = settings.build_ttl_unversioned
+    failure_ttl: str = settings.build_failure_ttl
 
-        job_queue_length = len(get_queue())
-        if job_queue_length > settings.max_pending_jobs:
-            response.status_code = 529
-            return {
+    job_queue_length = get_queue_length()
+    if job_queue_length > settings.max_pending_jobs:
+        return (
+            {
                 "status": 529,  # "Site is overloaded"
                 "title": "Server overloaded",
                 "detail": f"server overload, queue contains too many build requests: {job_queue_length}",
-            }
-
-        job = get_queue().enqueue(
-            build,
-            build_request,
-            job_id=request_hash,
-            result_ttl=result_ttl,
-            failure_ttl=failure_ttl,
-            job_timeout=settings.job_timeout,
+            },
+            529,
+            {},
+        )
+
+    image_tag: str = get_image_tag(build_request.version, build_request.target)
+    job = get_build_queue(image_tag).enqueue(
+        build,
+        build_request,
+        job_id=request_hash,
+        result_ttl=result_ttl,
+        failure_ttl=failure_ttl,
+        job_timeout=settings.job_timeout,
+    )
+    return return_job_v1(job)
+
+
+@router.post("/build")
+async def api_v1_build_post(
+    build_request: BuildRequest,
+    response: Response,
+    request: Request,
+    user_agent: str = Header(None),
+):
+    # Sanitize the profile in case the client did not (bug in older LuCI app).
+    build_request.profile = build_request.profile.replace(",", "_")
+
+    # Redis and RQ block, so they run in the thread pool and only the
+    # upstream requests of the validation wait on the event loop.
+    request_hash: str = get_request_hash(build_request)
+    job = await run_in_threadpool(find_build, build_request, request_hash, user_agent)
+    if job is None:
+        content, status = await validate_request(request.app, build_request)
+        if content:
+            response.status_code = status
+            return content
+
+        content, status, headers = await run_in_threadpool(
+            enqueue_build, build_request, request_hash
         )
     else:
-        if job.is_finished:
-            add_build_event("cache-hits")
+        content, status, headers = await run_in_threadpool(return_job_v1, job)
 
-    content, status, headers = return_job_v1(job)
     response.headers.update(headers)
     response.status_code = status
 
@@ -292,5 +329,5 @@ def api_v1_builder_stats():
         queue_length: Number of jobs currently in build queue
     """
     return {
-        "queue_length": len(get_queue()),
+        "queue_length": get_queue_length(),
     }
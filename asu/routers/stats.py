@@ -3,7 +3,7 @@ from datetime import datetime as dt, timedelta, UTC
 from fastapi import APIRouter
 from fastapi.responses import PlainTextResponse
 
-from asu.util import error_log, get_queue, get_redis_ts
+from asu.util import error_log, get_queue_length, get_redis_ts
 
 router = APIRouter()
 
@@ -49,7 +49,7 @@ def get_stats_summary() -> dict:
         builds_24h = int(sum(v for _, v in result))
 
     return {
-        "queue_length": len(get_queue()),
+        "queue_length": get_queue_length(),
         "builds_24h": builds_24h,
     }
 
@@ -189,6 +189,54 @@ def get_top_packages(branch: str = None, n: int = 30) -> dict:
     }
 
 
+@router.get("/build-stages")
+def get_build_stages(version: str = None, target: str = None) -> dict:
+    """Return the average duration of each build stage in seconds.
+
+    Args:
+        version: only include builds of this version
+        target: only include builds of this target
+    """
+    start, stop, stamps, labels = start_stop(N_DAYS, DAY_MS)
+
+    filters = ["stats=stages"]
+    if version:
+        filters.append(f"version={version}")
+    if target:
+        filters.append(f"target={target}")
+
+    range_options = dict(
+        filters=filters,
+        with_labels=True,
+        from_time=start,
+        to_time=stop,
+        bucket_size_msec=N_DAYS * DAY_MS,
+    )
+
+    ts = get_redis_ts()
+    totals: dict[str, list[float]] = {}
+    for aggregation, index in [("sum", 0), ("count", 1)]:
+        for row in ts.mrange(aggregation_type=aggregation, **range_options):
+            for data in row.values():
+                stage = data[0]["stage"]
+                totals.setdefault(stage, [0.0, 0.0])
+                totals[stage][index] += sum(v for _, v in data[1])
+
+    return {
+        "stages": {
+            stage: {
+                "average": round(total / count / 1000, 3),
+                "builds": int(count),
+            }
+            for stage, (total, count) in sorted(totals.items())
+            if count
+        },
+        "version": version,
+        "target": target,
+        "days": N_DAYS,
+    }
+
+
 @router.get("/build-errors", response_class=PlainTextResponse)
 def get_build_errors(n: int = 100) -> str:
     """Return a summary of recent build errors.
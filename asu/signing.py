@@ -0,0 +1,129 @@
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from asu.util import sign_usign_chunks
+
+# fwtool image trailer: magic, crc32, type, padding, size
+FWIMAGE_MAGIC = 0x46577830  # "FWx0"
+FWIMAGE_TRAILER = struct.Struct("!II B3x I")
+FWIMAGE_SIGNATURE = 0
+
+# ucert certificate attribute holding a usign signature
+CERT_ATTR_SIGNATURE = 0
+
+SIGNATURE_MAXLEN = 1024
+
+# Images are signed in chunks of this size, so they never are in memory.
+CHUNK_SIZE = 1 << 20
+
+
+def fwtool_crc32(data: bytes, crc: int = 0xFFFFFFFF) -> int:
+    """fwtool chains a CRC32 starting at ~0 without the final inversion."""
+    return zlib.crc32(data, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def read_chunks(image: BinaryIO, size: int) -> Iterator[bytes]:
+    """Read the first `size` bytes of an image in chunks."""
+    image.seek(0)
+    while size > 0:
+        chunk = image.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Image changed while signing")
+        size -= len(chunk)
+        yield chunk
+
+
+def fwtool_strip_signature(image: BinaryIO) -> int:
+    """Return the size of an image without a trailing signature block.
+
+    Like `fwtool -t -s /dev/null`, without modifying the image.
+    """
+    size = image.seek(0, os.SEEK_END)
+    if size < FWIMAGE_TRAILER.size:
+        return size
+
+    image.seek(size - FWIMAGE_TRAILER.size)
+    magic, crc32, data_type, block_size = FWIMAGE_TRAILER.unpack(
+        image.read(FWIMAGE_TRAILER.size)
+    )
+    if magic != FWIMAGE_MAGIC or data_type != FWIMAGE_SIGNATURE or block_size > size:
+        return size
+
+    crc = 0xFFFFFFFF
+    for chunk in read_chunks(image, size - FWIMAGE_TRAILER.size):
+        crc = fwtool_crc32(chunk, crc)
+    if crc != crc32:
+        return size
+
+    return size - block_size
+
+
+def fwtool_signature_block(crc: int, signature: bytes) -> bytes:
+    """Return the signature block of an image, like `fwtool -S`.
+
+    Args:
+        crc: `fwtool_crc32` of the image the block is appended to
+    """
+    if len(signature) > SIGNATURE_MAXLEN:
+        raise ValueError(f"Signature exceeds {SIGNATURE_MAXLEN} bytes")
+
+    return signature + FWIMAGE_TRAILER.pack(
+        FWIMAGE_MAGIC,
+        fwtool_crc32(signature, crc),
+        FWIMAGE_SIGNATURE,
+        len(signature) + FWIMAGE_TRAILER.size,
+    )
+
+
+def blob_attr(attr_id: int, data: bytes) -> bytes:
+    """Encode a libubox blob attribute padded to 4 bytes."""
+    header = struct.pack("!I", (attr_id << 24) | (len(data) + 4))
+    return header + data + b"\0" * (-len(data) % 4)
+
+
+def ucert_append(cert: bytes, signature: str) -> bytes:
+    """Append a usign signature to a certificate, like `ucert -A`."""
+    return cert + blob_attr(0, blob_attr(CERT_ATTR_SIGNATURE, signature.encode()))
+
+
+def sign_image(image_path: Path, sec_key: str, cert: bytes) -> None:
+    """Sign an image and append the certificate as fwtool metadata.
+
+    Mirrors `append-metadata` of the OpenWrt build system and leaves the
+    `.sig` and `.ucert` files next to the image.  The image is read in
+    chunks and the signed one replaces it by a rename.
+    """
+    tmp_path = image_path.with_name(f".{image_path.name}.tmp")
+    try:
+        with image_path.open("rb") as image:
+            size = fwtool_strip_signature(image)
+            signature = sign_usign_chunks(lambda: read_chunks(image, size), sec_key)
+            image_cert = ucert_append(cert, signature)
+
+            crc = 0xFFFFFFFF
+            with tmp_path.open("wb") as signed:
+                for chunk in read_chunks(image, size):
+                    crc = fwtool_crc32(chunk, crc)
+                    signed.write(chunk)
+                signed.write(fwtool_signature_block(crc, image_cert))
+
+        image_path.with_name(image_path.name + ".sig").write_text(signature)
+        image_path.with_name(image_path.name + ".ucert").write_bytes(image_cert)
+        tmp_path.replace(image_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def sign_images(images: list[Path], build_key: Path) -> None:
+    """Sign images in parallel using `build_key` and `build_key.ucert`."""
+    sec_key = build_key.read_text()
+    cert_file = build_key.with_name(build_key.name + ".ucert")
+    cert = cert_file.read_bytes() if cert_file.is_file() else b""
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        # Consume all results so a failure of any image is raised here.
+        list(executor.map(lambda i: sign_image(i, sec_key, cert), images))
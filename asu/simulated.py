@@ -0,0 +1,317 @@
+"""Simulated builder backend for load tests.
+
+With `builder_backend = "simulated"`, `asu.util.get_podman` returns a
+`SimulatedPodmanClient` instead of a `PodmanClient`.  It implements the
+parts of the podman API that builds use, keeping images, containers and
+container files in memory, so the API, Redis, workers and store can be
+benchmarked end to end without podman or ImageBuilders.
+
+Containers answer `make info`, `make manifest` and `make image` from the
+`.info`, `.manifest`, `profiles.json` and `.bin` files of a fake
+ImageBuilder in `simulated_imagebuilder`, by default the one shipped in
+`asu/simulated_imagebuilder`, after the latency configured in
+`simulated_latency`.  Any other command succeeds without output.
+
+Failures are deterministic: a stage fails if the hash of its command falls
+below `simulated_failure_rate`, so a repeated request fails again.
+
+State is kept per process, so every process is a podman host of its own.
+RQ work horses are forked per job and lose it, so run the
+`asu.worker.ConcurrentWorker` to simulate pools and sessions.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import struct
+import tarfile
+import threading
+from io import BytesIO
+from itertools import count
+from pathlib import Path, PurePosixPath
+from time import sleep, time
+from typing import Optional
+
+from podman import errors
+
+from asu.config import settings
+
+STAGES = ["pull", "setup", "info", "manifest", "image"]
+
+_ids = count(1)
+
+
+def get_stage(command: list[str]) -> str:
+    """Return the build stage a container command simulates, if any."""
+    if command == ["sh", "setup.sh"]:
+        return "setup"
+    if command[:1] == ["make"] and len(command) > 1 and command[1] in STAGES:
+        return command[1]
+    return ""
+
+
+def simulate(stage: str, command: list[str]) -> bool:
+    """Wait for the latency of a stage and return whether it fails."""
+    if not stage:
+        return False
+
+    sleep(settings.simulated_latency.get(stage, 0))
+    digest = hashlib.sha256(" ".join(command).encode()).digest()
+    return int.from_bytes(digest[:4], "big") / 2**32 < settings.simulated_failure_rate
+
+
+def imagebuilder_file(pattern: str) -> Path:
+    """Return the file of the fake ImageBuilder matching a glob pattern."""
+    for path in sorted(settings.simulated_imagebuilder.glob(pattern)):
+        return path
+    raise FileNotFoundError(
+        f"No {pattern} in simulated_imagebuilder {settings.simulated_imagebuilder}"
+    )
+
+
+def labels_match(labels: dict[str, str], filters: list[str]) -> bool:
+    """Check labels against podman `label=` filters, `key` or `key=value`."""
+    for label in filters:
+        key, sep, value = label.partition("=")
+        if key not in labels or (sep and labels[key] != value):
+            return False
+    return True
+
+
+def _label_filters(filters: dict) -> list[str]:
+    labels = filters.get("label", [])
+    return [labels] if isinstance(labels, str) else labels
+
+
+class _Response:
+    def __init__(self, data: dict = {}, raw: bytes = b""):
+        self.data = data
+        self.raw = BytesIO(raw)
+
+    def json(self) -> dict:
+        return self.data
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class _APIClient:
+    """Exec session endpoints of the podman API, see `asu.util.exec_stream`."""
+
+    def __init__(self, container: "SimulatedContainer"):
+        self.container = container
+        self.sessions: dict[str, dict] = {}
+
+    def post(self, path: str, data: str = "", stream: bool = False) -> _Response:
+        if path.endswith("/exec"):
+            exec_id = f"exec{next(_ids)}"
+            self.sessions[exec_id] = json.loads(data)
+            return _Response({"Id": exec_id})
+
+        session = self.sessions[path.split("/")[2]]
+        returncode, output = self.container.exec_run(session["Cmd"])
+        session["ExitCode"] = returncode
+
+        # Multiplexed like the attached output of podman.
+        frames = b""
+        for stream_id, data in enumerate(output, start=1):
+            if data:
+                frames += struct.pack(">BxxxL", stream_id, len(data)) + data
+        return _Response(raw=frames)
+
+    def get(self, path: str) -> _Response:
+        session = self.sessions.pop(path.split("/")[2])
+        return _Response({"ExitCode": session["ExitCode"]})
+
+
+class SimulatedImage:
+    def __init__(self, manager: "SimulatedImages", name: str, labels: dict = {}):
+        self.manager = manager
+        self.id = hashlib.sha256(f"{name}{next(_ids)}".encode()).hexdigest()
+        self.tags = [name]
+        self.labels = labels
+        self.attrs = {"Created": time(), "Labels": labels}
+
+    def remove(self) -> None:
+        self.manager.remove(self.tags[0])
+
+
+class SimulatedImages:
+    def __init__(self):
+        self.images: dict[str, SimulatedImage] = {}
+
+    def exists(self, name: str) -> bool:
+        return name in self.images
+
+    def pull(self, name: str) -> SimulatedImage:
+        if simulate("pull", ["pull", name]):
+            raise errors.ImageNotFound(f"Simulated failure pulling {name}")
+        self.images[name] = SimulatedImage(self, name)
+        return self.images[name]
+
+    def list(self, filters: dict = {}) -> list[SimulatedImage]:
+        labels = _label_filters(filters)
+        return [i for i in self.images.values() if labels_match(i.labels, labels)]
+
+    def remove(self, name: str) -> None:
+        if self.images.pop(name, None) is None:
+            raise errors.ImageNotFound(f"No such image {name}")
+
+
+class SimulatedContainer:
+    def __init__(self, podman: "SimulatedPodmanClient", image: str, **kwargs):
+        self.podman = podman
+        self.id = hashlib.sha256(f"container{next(_ids)}".encode()).hexdigest()
+        self.labels: dict[str, str] = kwargs.get("labels") or {}
+        self.status = "created"
+        self.attrs = {"Image": podman.images.images[image].id}
+        self.files: dict[str, bytes] = {}
+        self.client = _APIClient(self)
+
+    def start(self) -> None:
+        self.status = "running"
+
+    def kill(self) -> None:
+        self.status = "exited"
+
+    def remove(self, v: bool = False, force: bool = False) -> None:
+        self.podman.containers.containers.pop(self.id, None)
+        self.files.clear()
+
+    def commit(self, repository: str, tag: str, changes: list[str] = []) -> None:
+        labels = dict(
+            change.removeprefix("LABEL ").split("=", 1)
+            for change in changes
+            if change.startswith("LABEL ")
+        )
+        images = self.podman.images
+        name = f"{repository}:{tag}"
+        images.images[name] = SimulatedImage(images, name, labels)
+
+    def exec_run(
+        self, command: list[str], demux: bool = True, user: Optional[str] = None
+    ) -> tuple[int, tuple[bytes, bytes]]:
+        stage = get_stage(command)
+        if simulate(stage, command):
+            return 1, (b"", f"Simulated failure of {stage}\n".encode())
+
+        variables = dict(a.split("=", 1) for a in command[2:] if "=" in a)
+        if stage == "info":
+            return 0, (imagebuilder_file("*.info").read_bytes(), b"")
+        if stage == "manifest":
+            return 0, (self.make_manifest(variables).encode(), b"")
+        if stage == "image":
+            self.make_image(variables)
+            return 0, (b"Building images...\n", b"")
+        if command[:2] == ["test", "-f"]:
+            return int(command[2] not in self.files), (b"", b"")
+        return 0, (b"", b"")
+
+    def make_manifest(self, variables: dict[str, str]) -> str:
+        """Return the fixture manifest with the requested packages added."""
+        manifest = imagebuilder_file("*.manifest")
+        packages = dict(
+            line.split(" - ", 1) for line in manifest.read_text().splitlines()
+        )
+        for package in variables.get("PACKAGES", "").split():
+            if package.startswith("-"):
+                packages.pop(package[1:], None)
+            else:
+                packages.setdefault(package, "1.0")
+        return "".join(f"{name} - {version}\n" for name, version in packages.items())
+
+    def make_image(self, variables: dict[str, str]) -> None:
+        """Write images and a profiles.json for the profile to `BIN_DIR`."""
+        bin_dir = PurePosixPath(variables["BIN_DIR"])
+        profile = variables["PROFILE"]
+        profiles = json.loads(imagebuilder_file("profiles.json").read_text())
+        template = next(iter(profiles["profiles"].values()))
+
+        prefix = f"{template['image_prefix']}-{variables.get('EXTRA_IMAGE_NAME', '')}"
+        firmware = imagebuilder_file("*.bin").read_bytes()
+        images = []
+        for image in template["images"]:
+            name = f"{prefix}-{image['type']}.bin"
+            self.files[str(bin_dir / name)] = firmware
+            images.append(
+                {**image, "name": name, "sha256": hashlib.sha256(firmware).hexdigest()}
+            )
+
+        profiles["profiles"] = {
+            profile: {**template, "image_prefix": prefix, "images": images}
+        }
+        self.files[str(bin_dir / "profiles.json")] = json.dumps(profiles).encode()
+
+    def put_archive(self, path: str, data: bytes) -> bool:
+        with tarfile.open(fileobj=BytesIO(data)) as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    content = tar.extractfile(member).read()
+                    self.files[str(PurePosixPath(path) / member.name)] = content
+        return True
+
+    def get_archive(self, path: str) -> tuple[list[bytes], dict]:
+        root = PurePosixPath(path)
+        buf = BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for name, content in sorted(self.files.items()):
+                if not PurePosixPath(name).is_relative_to(root):
+                    continue
+                member = tarfile.TarInfo(
+                    str(root.name / PurePosixPath(name).relative_to(root))
+                )
+                member.size = len(content)
+                tar.addfile(member, BytesIO(content))
+        return [buf.getvalue()], {"name": root.name}
+
+
+class SimulatedContainers:
+    def __init__(self, podman: "SimulatedPodmanClient"):
+        self.podman = podman
+        self.containers: dict[str, SimulatedContainer] = {}
+
+    def create(self, image: str, **kwargs) -> SimulatedContainer:
+        if not self.podman.images.exists(image):
+            raise errors.ImageNotFound(f"No such image {image}")
+        container = SimulatedContainer(self.podman, image, **kwargs)
+        self.containers[container.id] = container
+        return container
+
+    def get(self, container_id: str) -> SimulatedContainer:
+        if container_id not in self.containers:
+            raise errors.NotFound(f"No such container {container_id}")
+        return self.containers[container_id]
+
+    def list(self, all: bool = False, filters: dict = {}) -> list[SimulatedContainer]:
+        labels = _label_filters(filters)
+        return [
+            c
+            for c in self.containers.values()
+            if (all or c.status == "running") and labels_match(c.labels, labels)
+        ]
+
+
+class SimulatedPodmanClient:
+    """In-memory stand-in for `podman.PodmanClient`, one per process."""
+
+    _shared: Optional["SimulatedPodmanClient"] = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.images = SimulatedImages()
+        self.containers = SimulatedContainers(self)
+        self.hostname = f"simulated-{socket.gethostname()}-{os.getpid()}"
+
+    @classmethod
+    def shared(cls) -> "SimulatedPodmanClient":
+        with cls._lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def info(self) -> dict:
+        return {"host": {"hostname": self.hostname}}
+
+    def version(self) -> dict:
+        return {"Version": "simulated"}
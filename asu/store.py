@@ -1,18 +1,42 @@
+import fcntl
+import json
 import logging
 import mimetypes
+import shutil
 from pathlib import Path
-from typing import Protocol
+from typing import Optional, Protocol
 
 import boto3
+from rq.utils import parse_timeout
 
+from asu.build_request import BuildRequest
 from asu.config import settings
+from asu.util import get_manifest_hash, get_redis_client, get_str_hash
 
 log = logging.getLogger("rq.worker")
 
+# fcntl.FICLONE is only exported from Python 3.12 on.
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+
+def clone_file(src: Path, dest: Path) -> None:
+    """Copy `src` to `dest`, sharing its blocks where the filesystem can.
+
+    Unlike a hard link the copy is a separate inode, so rewriting either
+    file in place leaves the other alone.
+    """
+    try:
+        with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
 
 class Store(Protocol):
     def upload_file(self, local_path: Path, key: str) -> None: ...
     def upload_dir(self, local_dir: Path, prefix: str) -> None: ...
+    def link_dir(self, src_prefix: str, dest_prefix: str) -> int: ...
     def get_url(self, key: str) -> str: ...
     def exists(self, key: str) -> bool: ...
 
@@ -26,8 +50,6 @@ class LocalStore:
         dest = self.base / key
         dest.parent.mkdir(parents=True, exist_ok=True)
         if local_path.resolve() != dest.resolve():
-            import shutil
-
             shutil.copy2(local_path, dest)
 
     def upload_dir(self, local_dir: Path, prefix: str) -> None:
@@ -36,6 +58,27 @@ class LocalStore:
                 key = f"{prefix}/{path.relative_to(local_dir)}"
                 self.upload_file(path, key)
 
+    def link_dir(self, src_prefix: str, dest_prefix: str) -> int:
+        """Copy all files below `src_prefix` to `dest_prefix`.
+
+        Files are reflinked where the filesystem supports it. They are not
+        hard linked, as rebuilds extract and sign images in place.
+
+        Returns:
+            int: number of files copied, 0 if `src_prefix` is gone
+        """
+        src_dir = self.base / src_prefix
+        count = 0
+        for path in src_dir.rglob("*"):
+            if not path.is_file():
+                continue
+            dest = self.base / dest_prefix / path.relative_to(src_dir)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            dest.unlink(missing_ok=True)
+            clone_file(path, dest)
+            count += 1
+        return count
+
     def get_url(self, key: str) -> str:
         return f"/store/{key}"
 
@@ -78,6 +121,28 @@ class S3Store:
                 key = f"{prefix}/{path.relative_to(local_dir)}"
                 self.upload_file(path, key)
 
+    def link_dir(self, src_prefix: str, dest_prefix: str) -> int:
+        """Copy all objects below `src_prefix` to `dest_prefix` server side.
+
+        Returns:
+            int: number of objects copied, 0 if `src_prefix` is gone
+        """
+        count = 0
+        paginator = self._client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self._bucket, Prefix=f"store/{src_prefix}/"
+        ):
+            for obj in page.get("Contents", []):
+                key = obj["Key"].removeprefix(f"store/{src_prefix}/")
+                self._client.copy_object(
+                    Bucket=self._bucket,
+                    Key=f"store/{dest_prefix}/{key}",
+                    CopySource={"Bucket": self._bucket, "Key": obj["Key"]},
+                )
+                count += 1
+        log.debug(f"Copied {count} objects from {src_prefix} to {dest_prefix}")
+        return count
+
     def get_url(self, key: str) -> str:
         if settings.s3_public_url:
             return f"{settings.s3_public_url.rstrip('/')}/store/{key}"
@@ -99,3 +164,76 @@ def get_store() -> Store:
     if settings.store_backend == "s3":
         return S3Store()
     return LocalStore()
+
+
+def get_artifact_hash(
+    build_request: BuildRequest, revision: str, manifest: dict[str, str]
+) -> str:
+    """Return the hash of the firmware a request resolves to.
+
+    Unlike the request hash, it is computed from the resolved manifest, so
+    requests that differ only in package order, `+` prefixes or
+    `diff_packages` but install the same packages share it.
+
+    Args:
+        build_request: request being built
+        revision: revision of the ImageBuilder, as reported by `make info`
+        manifest: resolved manifest of `make manifest`
+
+    Returns:
+        str: hash of the artifacts
+    """
+    return get_str_hash(
+        "".join(
+            [
+                build_request.distro,
+                build_request.version,
+                revision,
+                build_request.target,
+                build_request.profile,
+                get_manifest_hash(manifest),
+                get_str_hash(build_request.defaults),
+                str(build_request.rootfs_size_mb),
+                build_request.filesystem or "",
+            ]
+        )
+    )
+
+
+def save_artifact(artifact_hash: str, request_hash: str, result: dict) -> None:
+    """Record the artifacts and job result of a finished build."""
+    get_redis_client().set(
+        f"artifact:{artifact_hash}",
+        json.dumps({"request_hash": request_hash, "result": result}),
+        ex=parse_timeout(settings.build_ttl),
+    )
+
+
+def link_artifact(artifact_hash: str, request_hash: str) -> Optional[dict]:
+    """Link the artifacts of an earlier identical build to `request_hash`.
+
+    Returns:
+        dict: job result of the earlier build, or None if there is none or
+        its artifacts are gone from the store
+    """
+    rc = get_redis_client()
+    key = f"artifact:{artifact_hash}"
+    value = rc.get(key)
+    if not value:
+        return None
+
+    artifact = json.loads(value)
+    store = get_store()
+    if artifact["request_hash"] == request_hash:
+        # Same request again after its job result expired.
+        found = store.exists(f"{request_hash}/profiles.json")
+    else:
+        found = store.link_dir(artifact["request_hash"], request_hash) > 0
+
+    if not found:
+        log.info(f"Artifacts of {artifact['request_hash']} are gone")
+        rc.delete(key)
+        return None
+
+    log.info(f"Reusing artifacts of {artifact['request_hash']} for {request_hash}")
+    return artifact["result"]
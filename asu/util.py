@@ -4,26 +4,55 @@ import hashlib
 import json
 import logging
 import struct
+import threading
+from collections import OrderedDict
+from asyncio import (
+    AbstractEventLoop,
+    Future,
+    Semaphore,
+    ensure_future,
+    gather,
+    get_running_loop,
+    shield,
+    sleep as async_sleep,
+)
+from contextlib import contextmanager
+from functools import wraps
+from copy import copy, deepcopy
 from datetime import datetime, UTC
 from os import getgid, getuid
 from pathlib import Path
-from re import match, findall, sub, DOTALL, MULTILINE
-from tarfile import TarFile
-from io import BytesIO
-from typing import Optional
+from re import match, findall, search, sub, DOTALL, MULTILINE
+import tarfile
+from tarfile import TarInfo, data_filter
+from io import BufferedReader, RawIOBase
+from time import perf_counter, time
+from typing import Awaitable, Callable, Iterable, Iterator, Optional, TypeVar
+from weakref import WeakKeyDictionary
 
 import nacl.signing
+from nacl.bindings import (
+    crypto_core_ed25519_scalar_add,
+    crypto_core_ed25519_scalar_mul,
+    crypto_core_ed25519_scalar_reduce,
+    crypto_scalarmult_ed25519_base_noclamp,
+)
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 import httpx
 from httpx import Response
 from podman import PodmanClient
+from podman.api import stream_frames
 from podman.domain.containers import Container
 from rq import Queue
+from rq.exceptions import NoSuchJobError
 from rq.job import Job
+from rq.utils import as_text, parse_timeout
 
 import redis
 from asu.build_request import BuildRequest
 from asu.config import settings
+from asu.simulated import SimulatedPodmanClient
 
 log: logging.Logger = logging.getLogger("rq.worker")
 log.propagate = False  # Suppress duplicate log messages.
@@ -31,6 +60,19 @@ log.propagate = False  # Suppress duplicate log messages.
 # Create a shared HTTP client
 _http_client = httpx.Client()
 
+# Connections of an async client are bound to the event loop that opened
+# them, so the API shares one client per loop.
+_async_http_clients: WeakKeyDictionary[AbstractEventLoop, httpx.AsyncClient] = (
+    WeakKeyDictionary()
+)
+
+# Runs of `single_flight` functions in progress, per event loop.
+_in_flight: WeakKeyDictionary[AbstractEventLoop, dict[tuple, Future]] = (
+    WeakKeyDictionary()
+)
+
+T = TypeVar("T")
+
 
 def get_redis_client(unicode: bool = True) -> redis.client.Redis:
     return redis.from_url(settings.redis_url, decode_responses=unicode)
@@ -40,8 +82,118 @@ def get_redis_ts():
     return get_redis_client().ts()
 
 
+def get_validator(response: Response) -> str:
+    """Return the `ETag` or else `Last-Modified` header of a response."""
+    return response.headers.get("etag") or response.headers.get("last-modified", "")
+
+
+class HTTPCache:
+    """Upstream responses kept for conditional requests.
+
+    Successful responses with an `ETag` or `Last-Modified` header are kept
+    and revalidated with `If-None-Match` and `If-Modified-Since`.  When
+    upstream answers 304 Not Modified, a copy of the kept response is
+    returned with `from_cache` set, so callers can skip parsing it again.
+    Every other response has `from_cache` unset and replaces the kept one.
+
+    Bodies are kept up to `upstream_cache_mb`, least recently used first
+    out.  The cache is shared by all threads and event loops of a process.
+    """
+
+    def __init__(self):
+        self.responses: OrderedDict[str, Response] = OrderedDict()
+        self.size: int = 0
+        self.lock = threading.Lock()
+
+    def headers(self, url: str) -> dict[str, str]:
+        """Return the headers to revalidate a kept response with."""
+        with self.lock:
+            cached = self.responses.get(url)
+
+        headers: dict[str, str] = {}
+        if cached is None:
+            return headers
+        if etag := cached.headers.get("etag"):
+            headers["If-None-Match"] = etag
+        if last_modified := cached.headers.get("last-modified"):
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def update(self, url: str, response: Response) -> Response:
+        """Keep a fresh response, or return the kept one if unmodified."""
+        with self.lock:
+            cached = self.responses.pop(url, None)
+            if cached is not None:
+                self.size -= len(cached.content)
+
+            if response.status_code == 304 and cached is not None:
+                response = copy(cached)
+                response.from_cache = True
+            else:
+                response.from_cache = False
+                if response.status_code != 200 or not get_validator(response):
+                    return response
+                cached = response
+
+            self.responses[url] = cached
+            self.size += len(cached.content)
+            while self.size > settings.upstream_cache_mb * 1024 * 1024:
+                _, evicted = self.responses.popitem(last=False)
+                self.size -= len(evicted.content)
+
+        return response
+
+
+http_cache = HTTPCache()
+
+
 def client_get(url: str) -> Response:
-    return _http_client.get(url)
+    return http_cache.update(
+        url, _http_client.get(url, headers=http_cache.headers(url))
+    )
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Return the shared async HTTP client of the running event loop."""
+    loop = get_running_loop()
+    if loop not in _async_http_clients:
+        _async_http_clients[loop] = httpx.AsyncClient()
+    return _async_http_clients[loop]
+
+
+async def close_async_http_client() -> None:
+    client = _async_http_clients.pop(get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def single_flight(
+    func: Callable[..., Awaitable[T]],
+) -> Callable[..., Awaitable[T]]:
+    """Share one run of a coroutine function among concurrent callers.
+
+    Calls with the same positional arguments while a run is in progress
+    await its result, or exception, instead of starting their own.  A
+    caller being cancelled does not cancel the run for the others.
+    """
+
+    @wraps(func)
+    async def wrapper(*args):
+        in_flight = _in_flight.setdefault(get_running_loop(), {})
+        key = (func.__name__, *args)
+        if key not in in_flight:
+            in_flight[key] = ensure_future(func(*args))
+            in_flight[key].add_done_callback(lambda _: in_flight.pop(key, None))
+        return await shield(in_flight[key])
+
+    return wrapper
+
+
+@single_flight
+async def async_client_get(url: str) -> Response:
+    """Fetch from upstream without blocking the event loop of the API."""
+    response = await get_async_http_client().get(url, headers=http_cache.headers(url))
+    return http_cache.update(url, response)
 
 
 def add_timestamp(key: str, labels: dict[str, str] = {}, value: int = 1) -> None:
@@ -80,13 +232,147 @@ def add_build_event(event: str) -> None:
     add_timestamp(key, {"stats": "summary"})
 
 
-def get_queue() -> Queue:
+class StageTimer:
+    """Accumulate the wall clock time spent in the stages of a build.
+
+    Use an instance as context manager factory, `with timer("pull"): ...`.
+    A stage entered more than once adds up, and a stage that raised still
+    records the time it took.
+    """
+
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, stage: str) -> Iterator[None]:
+        start: float = perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage] = (
+                self.durations.get(stage, 0.0) + perf_counter() - start
+            )
+
+    def rounded(self) -> dict[str, float]:
+        """Return the durations in seconds, rounded to milliseconds."""
+        return {stage: round(d, 3) for stage, d in self.durations.items()}
+
+
+_stage_slots: dict[str, threading.BoundedSemaphore] = {}
+_stage_slots_lock = threading.Lock()
+
+
+@contextmanager
+def stage_slot(kind: str) -> Iterator[None]:
+    """Limit how many builds of this process run a kind of stage at once.
+
+    Only matters for workers running several builds in threads, see
+    `asu.worker.ConcurrentWorker`; forked work horses run one build each.
+
+    Args:
+        kind: "network" for stages waiting on downloads and uploads, "cpu"
+            for stages compressing or signing images
+    """
+    with _stage_slots_lock:
+        if kind not in _stage_slots:
+            slots = {
+                "network": settings.worker_network_slots,
+                "cpu": settings.worker_cpu_slots,
+            }[kind]
+            _stage_slots[kind] = threading.BoundedSemaphore(max(slots, 1))
+        semaphore = _stage_slots[kind]
+
+    with semaphore:
+        yield
+
+
+def add_stage_timings(build_request: BuildRequest, durations: dict[str, float]) -> None:
+    """Log the duration of each build stage in milliseconds.
+
+    The series are keyed by version and target, since those decide which
+    ImageBuilder runs, and labeled "stats=stages" for `/stats/build-stages`.
+    """
+    for stage, duration in durations.items():
+        add_timestamp(
+            f"stats:stages:{build_request.version}:{build_request.target}:{stage}",
+            {
+                "stats": "stages",
+                "version": build_request.version,
+                "target": build_request.target,
+                "stage": stage,
+            },
+            round(duration * 1000),
+        )
+
+
+IMAGE_QUEUE_PREFIX = "build:"
+
+# Seconds a worker's advertisement of a cached image stays valid.
+AFFINITY_TTL = 180
+
+
+def get_queue(name: str = "default") -> Queue:
     """Return the current queue
 
+    Args:
+        name (str): name of the queue, the shared queue by default
+
     Returns:
         Queue: The current RQ work queue
     """
-    return Queue(connection=get_redis_client(False), is_async=settings.async_queue)
+    return Queue(
+        name, connection=get_redis_client(False), is_async=settings.async_queue
+    )
+
+
+def get_image_queue_name(image_tag: str) -> str:
+    return f"{IMAGE_QUEUE_PREFIX}{image_tag}"
+
+
+def get_affinity_key(image_tag: str) -> str:
+    return f"affinity:{image_tag}"
+
+
+def get_build_queue(image_tag: str) -> Queue:
+    """Return the queue a build using the ImageBuilder `image_tag` goes to.
+
+    Workers advertise the ImageBuilder images they have locally, see
+    `asu.worker.AffinityWorker`.  Builds go to the queue of their image as
+    long as it is shorter than the number of workers listening on it, so
+    they never wait longer than one build for a warm worker.  Otherwise
+    they go to the shared queue, which every worker listens on.
+    """
+    workers: int = get_redis_client().zcount(
+        get_affinity_key(image_tag), time() - AFFINITY_TTL, "+inf"
+    )
+    if workers:
+        queue = get_queue(get_image_queue_name(image_tag))
+        if len(queue) < workers:
+            return queue
+    return get_queue()
+
+
+def get_queues() -> list[Queue]:
+    """Return the shared queue and all image queues."""
+    queue = get_queue()
+    return [queue] + [
+        q
+        for q in Queue.all(connection=queue.connection)
+        if q.name.startswith(IMAGE_QUEUE_PREFIX)
+    ]
+
+
+def get_queue_length() -> int:
+    """Return the number of queued builds on all queues."""
+    return sum(len(queue) for queue in get_queues())
+
+
+def fetch_job(job_id: str) -> Optional[Job]:
+    """Return a build job regardless of the queue it was enqueued on."""
+    try:
+        return Job.fetch(job_id, connection=get_queue().connection)
+    except NoSuchJobError:
+        return None
 
 
 def get_branch(version_or_branch: str) -> dict[str, str]:
@@ -252,6 +538,79 @@ def verify_usign(sig_file: Path, msg_file: Path, pub_key: str) -> bool:
         return False
 
 
+def _read_usign_key(sec_key: str) -> tuple[bytes, bytes, bytes]:
+    """Return algorithm, key number and Ed25519 secret key of a usign key."""
+    pkalg, _kdfalg, kdfrounds, _salt, _checksum, keynum, seckey = struct.unpack(
+        "!2s2sI16s8s8s64s", base64.b64decode(sec_key.splitlines()[-1])
+    )
+    if kdfrounds:
+        raise ValueError("Encrypted usign keys are not supported")
+    return pkalg, keynum, seckey
+
+
+def _format_usign_signature(pkalg: bytes, keynum: bytes, sig: bytes) -> str:
+    fingerprint = "".join(format(x, "02x") for x in keynum)
+    sig_b64 = base64.b64encode(struct.pack("!2s8s64s", pkalg, keynum, sig)).decode()
+    return f"untrusted comment: signed by key {fingerprint}\n{sig_b64}\n"
+
+
+def sign_usign(msg: bytes, sec_key: str) -> str:
+    """Create a signify/usign signature, like `usign -S`
+
+    This implementation uses pynacl
+
+    Args:
+        msg (bytes): message to be signed
+        sec_key (str): content of an unencrypted usign secret key file
+
+    Returns:
+        str: content of the signature file
+    """
+    pkalg, keynum, seckey = _read_usign_key(sec_key)
+    signing_key = nacl.signing.SigningKey(seckey[:32])
+    return _format_usign_signature(pkalg, keynum, signing_key.sign(msg).signature)
+
+
+def sign_usign_chunks(read: Callable[[], Iterable[bytes]], sec_key: str) -> str:
+    """Create a signify/usign signature of a message read in chunks
+
+    Ed25519 (RFC 8032) hashes the message twice, so `read` is called twice
+    to iterate over the message.  Unlike `sign_usign` the message is never
+    held in memory as a whole.
+
+    Args:
+        read (Callable): returns an iterator over the chunks of the message
+        sec_key (str): content of an unencrypted usign secret key file
+
+    Returns:
+        str: content of the signature file
+    """
+    pkalg, keynum, seckey = _read_usign_key(sec_key)
+    digest = hashlib.sha512(seckey[:32]).digest()
+    scalar = bytearray(digest[:32])
+    scalar[0] &= 248
+    scalar[31] = (scalar[31] & 127) | 64
+
+    hasher = hashlib.sha512(digest[32:])
+    for chunk in read():
+        hasher.update(chunk)
+    r = crypto_core_ed25519_scalar_reduce(hasher.digest())
+    point = crypto_scalarmult_ed25519_base_noclamp(r)
+
+    hasher = hashlib.sha512(point + seckey[32:])
+    for chunk in read():
+        hasher.update(chunk)
+    k = crypto_core_ed25519_scalar_reduce(hasher.digest())
+    a = crypto_core_ed25519_scalar_reduce(bytes(scalar) + bytes(32))
+    s = crypto_core_ed25519_scalar_add(r, crypto_core_ed25519_scalar_mul(k, a))
+    return _format_usign_signature(pkalg, keynum, point + s)
+
+
+def get_image_tag(version: str, target: str) -> str:
+    """Return the tag of the ImageBuilder image for a version and target."""
+    return f"{target.replace('/', '-')}-{get_container_version_tag(version)}"
+
+
 def get_container_version_tag(input_version: str) -> str:
     if match(r"^\d+\.\d+\.\d+(-rc\d+)?$", input_version):
         log.debug("Version is a release version")
@@ -274,12 +633,20 @@ def _find_podman_socket() -> str:
 
 
 def get_podman() -> PodmanClient:
+    if settings.builder_backend == "simulated":
+        return SimulatedPodmanClient.shared()
+
     return PodmanClient(
         base_url=_find_podman_socket(),
         identity=settings.container_identity,
     )
 
 
+def get_podman_host(podman: PodmanClient) -> str:
+    """Return the hostname of the podman service, shared by its workers."""
+    return podman.info()["host"]["hostname"]
+
+
 def diff_packages(
     requested_packages: list[str], default_packages: set[str]
 ) -> list[str]:
@@ -298,13 +665,223 @@ def diff_packages(
     )
 
 
+class IterStream(RawIOBase):
+    """Read-only file object over an iterable of byte chunks.
+
+    Allows consuming a streamed HTTP response, like the one returned by
+    `Container.get_archive`, without joining it in memory first.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class JobMeta:
+    """Writer of a build job's meta that only writes changed fields.
+
+    RQ's `Job.save_meta` serializes and rewrites the whole meta on every
+    call, including the build request and the output of the last command.
+    Here every field is stored in its own `meta:<name>` field of the job
+    hash instead, and `save` writes the fields that changed since the last
+    write in a single HSET.
+
+    Changed status fields are written right away.  Other changes are held
+    back for up to `SAVE_INTERVAL` seconds, so they are merged with later
+    ones, unless saved with `force`.  Read the meta with `get_job_meta`.
+    """
+
+    PREFIX = "meta:"
+    STATUS_FIELDS = ["detail", "imagebuilder_status"]
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.saved: dict = {}
+        self.saved_at: float = 0.0
+
+    def changed(self) -> dict:
+        return {
+            name: value
+            for name, value in self.job.meta.items()
+            if name not in self.saved or self.saved[name] != value
+        }
+
+    def save(self, force: bool = False) -> None:
+        changed = self.changed()
+        if not changed:
+            return
+
+        if not (
+            force
+            or any(name in changed for name in self.STATUS_FIELDS)
+            or time() - self.saved_at >= self.SAVE_INTERVAL
+        ):
+            return
+
+        self.job.connection.hset(
+            self.job.key,
+            mapping={
+                self.PREFIX + name: self.job.serializer.dumps(value)
+                for name, value in changed.items()
+            },
+        )
+        # Copies, since lists like the build command are changed in place.
+        self.saved.update(deepcopy(changed))
+        self.saved_at = time()
+
+
+def get_job_meta(job: Job) -> dict:
+    """Return the meta of a job, including the fields `JobMeta` wrote."""
+    meta: dict = {}
+    fields: dict = {}
+    for key, value in job.connection.hgetall(job.key).items():
+        key = as_text(key)
+        if key == "meta":
+            meta = job.serializer.loads(value)
+        elif key.startswith(JobMeta.PREFIX):
+            fields[key.removeprefix(JobMeta.PREFIX)] = job.serializer.loads(value)
+
+    job.meta = {**meta, **fields}
+    return job.meta
+
+
+class BuildLog:
+    """Bounded tail of the output of a running build, kept in Redis.
+
+    Output lines are appended to the capped list `build-log:<job id>` and
+    published on the channel of the same name, so status polls can return
+    the latest lines without the worker rewriting the job meta.  Lines are
+    batched into one pipelined round trip per `FLUSH_INTERVAL` seconds.
+    """
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, job_id: str):
+        self.rc = get_redis_client()
+        self.key = get_build_log_key(job_id)
+        self.size = settings.build_log_lines
+        self.ttl = parse_timeout(settings.job_timeout)
+        self._partial = b""
+        self._lines: list[str] = []
+        self._flushed = perf_counter()
+
+    def clear(self) -> None:
+        self.rc.delete(self.key)
+
+    def write(self, data: bytes) -> None:
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        self._lines.extend(line.decode("utf-8", errors="replace") for line in lines)
+        if perf_counter() - self._flushed >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered complete lines."""
+        self._flushed = perf_counter()
+        if not self._lines:
+            return
+
+        pipeline = self.rc.pipeline(transaction=False)
+        pipeline.rpush(self.key, *self._lines)
+        pipeline.ltrim(self.key, -self.size, -1)
+        pipeline.expire(self.key, self.ttl)
+        pipeline.publish(self.key, "\n".join(self._lines))
+        pipeline.execute()
+        self._lines = []
+
+    def close(self) -> None:
+        """Write all buffered output, including an unterminated last line."""
+        if self._partial:
+            self._lines.append(self._partial.decode("utf-8", errors="replace"))
+            self._partial = b""
+        self.flush()
+
+
+def get_build_log_key(job_id: str) -> str:
+    return f"build-log:{job_id}"
+
+
+def get_build_log(job_id: str) -> list[str]:
+    """Return the latest output lines of a running build."""
+    return get_redis_client().lrange(get_build_log_key(job_id), 0, -1)
+
+
+def exec_stream(
+    container: Container, command: list[str], build_log: BuildLog
+) -> tuple[int, bytes, bytes]:
+    """Run a command like `Container.exec_run`, logging output as it arrives.
+
+    podman-py does not report the exit code of streamed exec sessions, so
+    the session is created, started and inspected through its API client.
+
+    Returns:
+        tuple: exit code, stdout and stderr of the command
+    """
+    client = container.client
+    response = client.post(
+        f"/containers/{container.id}/exec",
+        data=json.dumps(
+            {
+                "AttachStdout": True,
+                "AttachStderr": True,
+                "Cmd": command,
+                "User": "buildbot",
+            }
+        ),
+    )
+    response.raise_for_status()
+    exec_id: str = response.json()["Id"]
+
+    response = client.post(
+        f"/exec/{exec_id}/start",
+        data=json.dumps({"Detach": False, "Tty": False}),
+        stream=True,
+    )
+    response.raise_for_status()
+
+    stdout: list[bytes] = []
+    stderr: list[bytes] = []
+    try:
+        for out, err in stream_frames(response, demux=True):
+            for data, chunks in [(out, stdout), (err, stderr)]:
+                if data:
+                    chunks.append(data)
+                    build_log.write(data)
+    finally:
+        build_log.close()
+
+    response = client.get(f"/exec/{exec_id}/json")
+    response.raise_for_status()
+    return response.json().get("ExitCode"), b"".join(stdout), b"".join(stderr)
+
+
 def run_cmd(
     container: Container,
     command: list[str],
     copy: list[str] = [],
     environment: dict[str, str] = {},
+    build_log: Optional[BuildLog] = None,
 ) -> tuple[int, str, str]:
-    returncode, output = container.exec_run(command, demux=True, user="buildbot")
+    if build_log is not None:
+        returncode, *output = exec_stream(container, command, build_log)
+    else:
+        returncode, output = container.exec_run(command, demux=True, user="buildbot")
 
     stdout: str = output[0].decode("utf-8") if output[0] else ""
     stderr: str = output[1].decode("utf-8") if output[1] else ""
@@ -314,27 +891,47 @@ def run_cmd(
     log.debug(f"stderr: {stderr}")
 
     if copy:
-        log.debug(f"Copying {copy[0]} from container to {copy[1]}")
-        container_tar, _ = container.get_archive(copy[0])
-
-        with TarFile(fileobj=BytesIO(b"".join(container_tar))) as tar_file:
-            uuid: int = getuid()
-            ugid: int = getgid()
-            for member in tar_file:
-                # Fix the owner of the copied files, change to "us".
-                member.uid = uuid
-                member.gid = ugid
-                member.mode = 0o755 if member.isdir() else 0o644
-            tar_file.extractall(copy[1], filter="data")
+        copy_from_container(container, copy[0], copy[1])
 
     return returncode, stdout, stderr
 
 
+def copy_from_container(container: Container, source: str, dest: Path) -> None:
+    """Extract a file or directory from a container below `dest`.
+
+    Args:
+        container: container to copy from
+        source: path inside the container
+        dest: host directory to extract into
+    """
+    log.debug(f"Copying {source} from container to {dest}")
+    container_tar, _ = container.get_archive(source)
+
+    uuid: int = getuid()
+    ugid: int = getgid()
+
+    def owned_by_us(member: TarInfo, dest_path: str) -> TarInfo:
+        # Fix the owner of the copied files, change to "us".
+        return data_filter(member, dest_path).replace(
+            uid=uuid,
+            gid=ugid,
+            mode=0o755 if member.isdir() else 0o644,
+            deep=False,
+        )
+
+    # Stream mode extracts member by member while the archive is still
+    # being downloaded, so memory use does not grow with the images.
+    with tarfile.open(
+        fileobj=BufferedReader(IterStream(container_tar)), mode="r|"
+    ) as tar_file:
+        tar_file.extractall(dest, filter=owned_by_us)
+
+
 def report_error(job: Job, msg: str) -> None:
     log.warning(f"Error: {msg}")
     job.meta["detail"] = f"Error: {msg}"
     job.meta["imagebuilder_status"] = "failed"
-    job.save_meta()
+    JobMeta(job).save(force=True)
     raise RuntimeError(msg)
 
 
@@ -355,6 +952,28 @@ def parse_manifest(manifest_content: str) -> dict[str, str]:
     return dict(map(lambda pv: pv.split(separator), manifest_content.splitlines()))
 
 
+def parse_info(info_content: str) -> dict:
+    """Parse the output of `make info` and return a dictionary
+
+    Args:
+        info_content (str): Output of `make info`
+
+    Returns:
+        dict: Revision, default packages and the packages of every profile
+    """
+    revision = search(r'Current Revision: "(r.+)"', info_content)
+    default_packages = search(r"Default Packages: (.*)\n", info_content)
+    profiles = findall(r"^(\S+):\n    .+\n    Packages: (.*)$", info_content, MULTILINE)
+
+    return {
+        "revision": revision.group(1) if revision else "",
+        "default_packages": default_packages.group(1).split()
+        if default_packages
+        else [],
+        "profiles": {profile: packages.split() for profile, packages in profiles},
+    }
+
+
 def check_manifest(
     manifest: dict[str, str], packages_versions: dict[str, str]
 ) -> Optional[str]:
@@ -421,6 +1040,14 @@ def check_package_errors(stderr: str) -> str:
         ERROR: APK-CONFLICT-3: trying to overwrite somefile owned by APK-CONFLICT-4.
     """
 
+    return format_package_errors(*parse_package_errors(stderr))
+
+
+def parse_package_errors(stderr: str) -> tuple[set[str], set[str]]:
+    """Return the missing and the conflicting packages of a failed build.
+
+    See `check_package_errors` for the error formats.
+    """
     # Grab the missing ones first, as that's easy.
     missing = set(
         findall(r"Cannot install package ([^ ]+)\.", stderr)  # Case opkg-1
@@ -445,6 +1072,10 @@ def check_package_errors(stderr: str) -> str:
     # If it's conflicting, remove it from missing...
     missing.difference_update(conflicts)
 
+    return missing, conflicts
+
+
+def format_package_errors(missing: set[str], conflicts: set[str]) -> str:
     pkg_list = ":" if missing or conflicts else ""
     if missing:
         pkg_list += " missing (" + ", ".join(sorted(missing)) + ")"
@@ -453,7 +1084,82 @@ def check_package_errors(stderr: str) -> str:
     return f"Impossible package selection{pkg_list}"
 
 
-def parse_packages_file(url: str) -> dict[str, str]:
+def get_package_errors_key(version: str, target: str) -> str:
+    return f"package-errors:{version}:{target}"
+
+
+def save_package_errors(
+    build_request: BuildRequest,
+    revision: str,
+    missing: set[str],
+    conflicts: set[str],
+) -> None:
+    """Remember packages that made a build of an ImageBuilder revision fail.
+
+    Missing packages are recorded one by one, conflicting packages as a
+    group that only fails when requested together.  Records are dropped
+    when the revision changes, and expire after `manifest_cache_ttl` since
+    package feeds of a release change within a revision.
+    """
+    if not (revision and (missing or conflicts)):
+        return
+
+    rc = get_redis_client()
+    key = get_package_errors_key(build_request.version, build_request.target)
+    fields = {f"missing:{package}": 1 for package in missing}
+    if conflicts:
+        fields["conflicts:" + ",".join(sorted(conflicts))] = 1
+
+    if rc.hget(key, "revision") != revision:
+        rc.delete(key)
+    pipeline = rc.pipeline()
+    pipeline.hset(key, mapping={"revision": revision, **fields})
+    pipeline.expire(key, parse_timeout(settings.manifest_cache_ttl))
+    pipeline.execute()
+
+
+async def get_package_errors(build_request: BuildRequest) -> str:
+    """Return why a request fails like an earlier build, if it does.
+
+    A request fails if it contains a package recorded as missing, or all
+    packages of a recorded conflict, as long as the upstream revision of
+    its target is still the one the failed build used.
+
+    Returns:
+        str: error message of `check_package_errors`, empty if none
+    """
+    if build_request.repositories:
+        return ""  # Custom repositories may provide the packages.
+
+    rc = get_redis_client()
+    key = get_package_errors_key(build_request.version, build_request.target)
+    record: dict[str, str] = await run_in_threadpool(rc.hgetall, key)
+    if not record:
+        return ""
+
+    requested = {p for p in build_request.packages if not p.startswith("-")}
+    missing: set[str] = set()
+    conflicts: set[str] = set()
+    for field in record:
+        kind, _, packages = field.partition(":")
+        if kind == "missing" and packages in requested:
+            missing.add(packages)
+        elif kind == "conflicts" and set(packages.split(",")) <= requested:
+            conflicts.update(packages.split(","))
+
+    if not (missing or conflicts):
+        return ""
+
+    revision = await async_get_revision(build_request.version, build_request.target)
+    if revision != record["revision"]:
+        if revision:  # Not when upstream could not be reached.
+            await run_in_threadpool(rc.delete, key)
+        return ""
+
+    return format_package_errors(missing, conflicts)
+
+
+async def parse_packages_file(url: str) -> dict[str, str]:
     """Any index.json without a "version" tag is assumed to be v1, containing
     ABI-versioned package names, which may cause issues for those packages.
     If index.json contains "version: 2", then the package names are ABI-free,
@@ -463,13 +1169,13 @@ def parse_packages_file(url: str) -> dict[str, str]:
     then fall back to trying opkg-based Packages.  If that fails on a 404,
     we'll just return the v1 index.json."""
 
-    res: Response = client_get(f"{url}/index.json")
+    res: Response = await async_client_get(f"{url}/index.json")
     json = res.json() if res.status_code == 200 else {}
     if json.get("version", 1) >= 2:
         del json["version"]
         return json
 
-    res = client_get(f"{url}/Packages")  # For pre-v2, opkg-based releases
+    res = await async_client_get(f"{url}/Packages")  # For pre-v2, opkg-based releases
     if res.status_code != 200:
         return json  # Bail out - probably with v1 index.json
 
@@ -494,8 +1200,8 @@ def parse_packages_file(url: str) -> dict[str, str]:
     return {"architecture": architecture, "packages": packages}
 
 
-def parse_feeds_conf(url: str) -> list[str]:
-    res: Response = client_get(f"{url}/feeds.conf")
+async def parse_feeds_conf(url: str) -> list[str]:
+    res: Response = await async_client_get(f"{url}/feeds.conf")
     return (
         [line.split()[1] for line in res.text.splitlines()]
         if res.status_code == 200
@@ -540,9 +1246,9 @@ def is_post_kmod_split_build(path: str) -> bool:
     return False
 
 
-def parse_kernel_version(url: str) -> str:
+async def parse_kernel_version(url: str) -> str:
     """Download a target's profiles.json and return the kernel version string."""
-    res: Response = client_get(url)
+    res: Response = await async_client_get(url)
     if res.status_code != 200:
         return ""
 
@@ -556,15 +1262,165 @@ def parse_kernel_version(url: str) -> str:
     return ""
 
 
-def reload_versions(app: FastAPI) -> bool:
+def get_profiles_url(version: str, target: str) -> str:
+    version_path = get_branch(version).get("path", "").format(version=version)
+    return f"{settings.upstream_url}/{version_path}/targets/{target}/profiles.json"
+
+
+def get_revision(version: str, target: str) -> str:
+    """Return the current upstream revision of a target
+
+    Args:
+        version (str): version or branch, e.g. SNAPSHOT
+        target (str): target/subtarget
+
+    Returns:
+        str: revision like r12345-abcdef1234, empty if it could not be found
+    """
+    try:
+        res: Response = client_get(get_profiles_url(version, target))
+    except httpx.HTTPError as e:
+        log.warning(f"Failed to fetch revision of {version}/{target}: {e}")
+        return ""
+
+    return res.json().get("version_code", "") if res.status_code == 200 else ""
+
+
+async def async_get_revision(version: str, target: str) -> str:
+    """Like `get_revision`, for the API."""
+    try:
+        res: Response = await async_client_get(get_profiles_url(version, target))
+    except httpx.HTTPError as e:
+        log.warning(f"Failed to fetch revision of {version}/{target}: {e}")
+        return ""
+
+    return res.json().get("version_code", "") if res.status_code == 200 else ""
+
+
+METADATA_PREFIX = "metadata"
+
+
+class SharedTable(dict):
+    """Local copy of metadata tables shared in Redis.
+
+    Entries are read from the Redis key `<prefix>:<key>` by `load`, in the
+    thread pool, so the event loop never waits on Redis.  Tables of
+    `depth` 2 hold tables of depth 1, keyed the same way, like
+    `app.profiles[version][target]`.  Entries not loaded, or absent in
+    Redis, read as `{}`.
+    """
+
+    def __init__(self, prefix: str, depth: int = 1):
+        super().__init__()
+        self.prefix = prefix
+        self.depth = depth
+
+    def __missing__(self, key: str) -> dict:
+        if self.depth == 1:
+            return {}
+        value = SharedTable(f"{self.prefix}:{key}", self.depth - 1)
+        self[key] = value
+        return value
+
+    async def load(self, *keys: str) -> dict:
+        """Return an entry, reading it from Redis unless it is held locally."""
+        table = self
+        for key in keys[:-1]:
+            table = table[key]
+        if keys[-1] not in table:
+            data = await run_in_threadpool(
+                get_redis_client().get, f"{table.prefix}:{keys[-1]}"
+            )
+            table[keys[-1]] = json.loads(data) if data else {}
+        return table[keys[-1]]
+
+
+def init_metadata(app: FastAPI) -> None:
+    """Set up the metadata tables of an app, see `sync_metadata`."""
+    app.latest = []
+    app.versions = []
+    app.targets = SharedTable(f"{METADATA_PREFIX}:targets")
+    app.profiles = SharedTable(f"{METADATA_PREFIX}:profiles", depth=2)
+    app.generation = 0
+    app.synced_at = 0.0
+
+
+async def load_versions(app: FastAPI) -> None:
+    data = await run_in_threadpool(
+        get_redis_client().get, f"{METADATA_PREFIX}:versions"
+    )
+    versions = json.loads(data) if data else {}
+    app.versions = versions.get("versions", [])
+    app.latest = versions.get("latest", [])
+
+
+async def sync_metadata(app: FastAPI, force: bool = False) -> None:
+    """Drop the local copy of the metadata if another process changed it.
+
+    Metadata parsed by any API process is stored in Redis, see
+    `publish_metadata`, and every change increments a generation counter.
+    The counter is checked at most once a second unless forced.  If it
+    moved, the versions are read again and the tables start over empty,
+    to be loaded from Redis again.
+    """
+    if not force and time() - app.synced_at < 1:
+        return
+    app.synced_at = time()
+
+    generation = await run_in_threadpool(
+        get_redis_client().get, f"{METADATA_PREFIX}:generation"
+    )
+    if int(generation or 0) == app.generation:
+        return
+
+    app.generation = int(generation or 0)
+    app.targets.clear()
+    app.profiles.clear()
+    await load_versions(app)
+
+
+async def publish_metadata(app: FastAPI, key: str, value, response: Response) -> None:
+    """Share metadata parsed from an upstream response with other processes."""
+    pipeline = get_redis_client().pipeline()
+    pipeline.set(f"{METADATA_PREFIX}:{key}", json.dumps(value))
+    pipeline.hset(
+        f"{METADATA_PREFIX}:parsed", str(response.url), get_validator(response)
+    )
+    pipeline.incr(f"{METADATA_PREFIX}:generation")
+    generation: int = (await run_in_threadpool(pipeline.execute))[-1]
+
+    # The local copy is current unless another process published meanwhile.
+    if generation == app.generation + 1:
+        app.generation = generation
+
+
+async def is_parsed(response: Response) -> bool:
+    """Check if the shared metadata was parsed from an upstream response.
+
+    Other functions fetching the same URL may have consumed a change, and
+    other processes may have parsed it, so the validator of the parsed
+    response is kept in Redis along with the metadata.
+    """
+    validator = get_validator(response)
+    if not validator:
+        return False
+    parsed = await run_in_threadpool(
+        get_redis_client().hget, f"{METADATA_PREFIX}:parsed", str(response.url)
+    )
+    return parsed is not None and as_text(parsed) == validator
+
+
+@single_flight
+async def reload_versions(app: FastAPI) -> bool:
     """Set the values of both `app.versions` and `app.latest` using the
     upstream `.versions.json` file.
 
-    We check for updates to the versions by examining the response's
-    `from_cache` attribute.  This is safe because `reload_versions` is the
-    only function that downloads that file, so no race conditions can exist.
+    The file is revalidated with upstream and only parsed again if it was
+    modified, see `HTTPCache` and `is_parsed`.  Parsed data is shared with
+    other API processes, see `sync_metadata`.
 
-    Returns `True` if data has changed, `False` when cache was used.
+    Returns `True` if data has changed, `False` if upstream was unmodified
+    or unreachable.
     """
 
     def in_supported_branch(version: str) -> bool:
@@ -582,10 +1438,13 @@ def reload_versions(app: FastAPI) -> bool:
             if in_supported_branch(version):
                 version_list.append(version)
 
-    response = client_get(settings.upstream_url + "/.versions.json")
+    response = await async_client_get(settings.upstream_url + "/.versions.json")
     if response.status_code != 200:
         log.info(f".versions.json: failed to download {response.status_code}")
         return False
+    if await is_parsed(response):
+        await load_versions(app)
+        return False
 
     versions_upstream = response.json()
     upcoming_version = versions_upstream["upcoming_version"]
@@ -613,55 +1472,159 @@ def reload_versions(app: FastAPI) -> bool:
 
     # Create a key that puts -rcN between -SNAPSHOT and releases.
     app.versions.sort(reverse=True, key=lambda v: v.replace(".0-rc", "-rc"))
+    await publish_metadata(
+        app, "versions", {"versions": app.versions, "latest": app.latest}, response
+    )
 
     return True
 
 
-def reload_targets(app: FastAPI, version: str) -> bool:
+@single_flight
+async def reload_targets(app: FastAPI, version: str) -> bool:
     """Set a specific target value in `app.targets` using data from the
     upstream `.targets.json` file.
 
-    No race conditions occur due to `reload_targets` being the sole user of
-    the `.targets.json` file.
+    The file is only parsed again if upstream modified it, and the targets
+    are only shared again if they changed.  Failed downloads keep the
+    previous targets.
 
-    Returns `True` if data has changed, `False` when cache was used.
+    Returns `True` if data has changed, `False` if upstream was unmodified
+    or unreachable.
     """
 
     branch_data = get_branch(version)
     version_path = branch_data["path"].format(version=version)
-    response = client_get(settings.upstream_url + f"/{version_path}/.targets.json")
+    response = await async_client_get(
+        settings.upstream_url + f"/{version_path}/.targets.json"
+    )
+    if response.status_code != 200:
+        log.info(f"{version}/.targets.json: failed to download {response.status_code}")
+        return False
+    if await is_parsed(response):
+        app.targets.pop(version, None)  # Load what was parsed.
+        await app.targets.load(version)
+        return False
+
+    targets = response.json()
+    # Responses without validators are only known unchanged by content.
+    if targets == await app.targets.load(version):
+        return False
 
-    app.targets[version] = response.json() if response.status_code == 200 else {}
+    app.targets[version] = targets
+    await publish_metadata(app, f"targets:{version}", targets, response)
 
     return True
 
 
-def reload_profiles(app: FastAPI, version: str, target: str) -> bool:
+@single_flight
+async def reload_profiles(app: FastAPI, version: str, target: str) -> bool:
     """Set the `app.profiles` for a specific version and target derived from
     the data in the corresponding `profiles.json` file.
 
-    This function is subject to race conditions as various other functions
-    also use the `profiles.json` files for other metadata, hence we do not
-    check for recaching and always recompute the profiles when requested.
+    The file is only parsed again if upstream modified it, see
+    `is_parsed`, and the profiles are only shared again if they changed.
+    Failed downloads keep the previous profiles.
 
-    Returns `True` indicating that we have reloaded the profile.
+    Returns `True` if data has changed, `False` if upstream was unmodified
+    or unreachable.
     """
 
     branch_data = get_branch(version)
     version_path = branch_data["path"].format(version=version)
-    response = client_get(
+    response = await async_client_get(
         settings.upstream_url + f"/{version_path}/targets/{target}/profiles.json"
     )
+    if response.status_code != 200:
+        log.info(
+            f"{version}/{target}/profiles.json: failed to download "
+            f"{response.status_code}"
+        )
+        return False
+    if await is_parsed(response):
+        app.profiles[version].pop(target, None)  # Load what was parsed.
+        await app.profiles.load(version, target)
+        return False
 
-    app.profiles[version][target] = {
+    profiles = {
         name.replace(",", "_"): profile
         for profile, data in response.json()["profiles"].items()
         for name in data.get("supported_devices", []) + [profile]
     }
+    # Responses without validators are only known unchanged by content.
+    if profiles == await app.profiles.load(version, target):
+        return False
+
+    app.profiles[version][target] = profiles
+    await publish_metadata(app, f"profiles:{version}:{target}", profiles, response)
 
     return True
 
 
+async def refresh_metadata(app: FastAPI, concurrency: int = 8) -> None:
+    """Load versions, the targets of every version and the profiles of the
+    newest version of each branch from upstream.
+
+    Files unmodified upstream are not parsed again, see `reload_versions`.
+    Failures are logged and leave the previous data in place.
+
+    Args:
+        app (FastAPI): app holding the metadata
+        concurrency (int): upstream requests in flight at once
+    """
+    slots = Semaphore(concurrency)
+
+    async def reload(reload_func, *args) -> None:
+        async with slots:
+            await reload_func(app, *args)
+
+    async def reload_all(calls: list[tuple]) -> None:
+        results = await gather(*[reload(*c) for c in calls], return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            log.warning(
+                f"Failed to refresh {len(failed)} of {len(calls)} upstream files: "
+                f"{failed[0]!r}"
+            )
+
+    await reload_versions(app)
+    await reload_all([(reload_targets, version) for version in app.versions])
+
+    newest: dict[str, str] = {}
+    for version in app.versions:  # Sorted newest first.
+        newest.setdefault(get_branch(version)["name"], version)
+    await reload_all(
+        [
+            (reload_profiles, version, target)
+            for version in newest.values()
+            for target in await app.targets.load(version)
+        ]
+    )
+
+
+async def refresh_metadata_forever(app: FastAPI) -> None:
+    """Refresh the metadata of the API every `metadata_refresh_interval`.
+
+    Of several API processes sharing a Redis, one refreshes per interval.
+    """
+    interval = parse_timeout(settings.metadata_refresh_interval)
+    key = f"{METADATA_PREFIX}:refreshing"
+    while True:
+        # One API process refreshes per interval, the others read from Redis.
+        if await run_in_threadpool(
+            get_redis_client().set, key, 1, nx=True, ex=interval
+        ):
+            started = perf_counter()
+            try:
+                await refresh_metadata(app)
+            except Exception as e:
+                log.warning(f"Failed to refresh upstream metadata: {e!r}")
+            else:
+                log.debug(
+                    f"Refreshed upstream metadata in {perf_counter() - started:.1f}s"
+                )
+        await async_sleep(interval)
+
+
 class ErrorLog:
     """Redis-backed error log for build failures.
 
@@ -0,0 +1,497 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+from typing import Optional
+
+from podman import errors
+from rq import Queue, Worker
+from rq.defaults import DEFAULT_WORKER_TTL
+from rq.job import Job
+from rq.timeouts import TimerDeathPenalty
+from rq.worker import WorkerStatus
+
+from asu.admission import Admission
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.pool import ContainerPool
+from asu.util import (
+    AFFINITY_TTL,
+    IMAGE_QUEUE_PREFIX,
+    JobMeta,
+    get_affinity_key,
+    get_image_queue_name,
+    get_image_tag,
+    get_podman,
+)
+
+log = logging.getLogger("rq.worker")
+
+
+class AffinityWorker(Worker):
+    """Worker that prefers builds for ImageBuilder images it already has.
+
+    Every `REFRESH_INTERVAL` seconds the worker lists the ImageBuilder
+    images on its podman host, listens on their image queues ahead of the
+    queues it was started with, and advertises them so the server routes
+    builds for those images to it, see `asu.util.get_build_queue`.
+
+    Builds of one image are run as a session: after dequeuing a build, the
+    worker claims up to `build_session_size - 1` more queued builds of the
+    same image from the shared queues, moves them to the image queue and
+    listens on that queue first.  The following builds then find the
+    image pulled and a set up container in the pool, so pulling, creating
+    and setting up a container is paid once per session.  Claimed builds
+    the worker did not run go back to the shared queue when the session
+    ends, a build is deferred or the worker stops.
+
+    Advertisements are renewed with every heartbeat, also while building.
+    Builds left in image queues nobody advertises, because the worker was
+    killed or lost the image, are moved back to the shared queue by idle
+    workers, see `requeue_orphaned_builds`.
+
+    Build containers left behind by killed workers are reaped on startup
+    and periodically while idle, see `asu.pool.ContainerPool.reap`.
+
+    Builds the podman host has no room for are put back on the shared
+    queue, for workers on other hosts or for later, see
+    `asu.admission.Admission`.  After `MAX_DEFERRALS` they fail.
+
+    Run with `rq worker --worker-class asu.worker.AffinityWorker`.
+    """
+
+    REFRESH_INTERVAL = 60
+
+    # Queued jobs looked at per shared queue when claiming a session.
+    SESSION_SCAN = 50
+
+    # Seconds to wait after deferring a build for lack of resources.
+    DEFER_BACKOFF = 5
+
+    # Deferrals after which a build fails instead, across all workers.
+    MAX_DEFERRALS = 120
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_queues: list[Queue] = self.queues[:]
+        self.image_tags: list[str] = []
+        self.session_tag: str = ""
+        self.session_jobs: set[str] = set()
+        self.refreshed_at: float = 0.0
+
+    def get_image_tags(self) -> list[str]:
+        """Return the tags of the ImageBuilder images on the podman host."""
+        prefix = f"{settings.base_container}:"
+        return sorted(
+            {
+                tag.removeprefix(prefix)
+                for image in get_podman().images.list()
+                for tag in image.tags or []
+                if tag.startswith(prefix)
+            }
+        )
+
+    def refresh_queues(self) -> None:
+        """Update the image queues and renew their advertisements."""
+        if time() - self.refreshed_at < self.REFRESH_INTERVAL:
+            return
+        self.refreshed_at = time()
+
+        try:
+            image_tags = self.get_image_tags()
+        except errors.APIError as e:
+            log.warning(f"Failed to list ImageBuilder images: {e}")
+            image_tags = self.image_tags
+
+        if image_tags != self.image_tags:
+            log.info(f"Listening for builds on {len(image_tags)} image queues")
+
+        advertised = set(self.advertised_tags())
+        self.image_tags = image_tags
+        pipeline = self.connection.pipeline()
+        for image_tag in advertised - set(self.advertised_tags()):
+            pipeline.zrem(get_affinity_key(image_tag), self.name)
+        self.advertise(pipeline)
+        pipeline.execute()
+        self.order_queues()
+
+    def advertised_tags(self) -> list[str]:
+        """Return the image tags of the image queues the worker serves."""
+        image_tags = set(self.image_tags)
+        if self.session_tag:
+            image_tags.add(self.session_tag)
+        return sorted(image_tags)
+
+    def advertise(self, pipeline) -> None:
+        """Renew the advertisements of the worker's image queues."""
+        now = time()
+        for image_tag in self.advertised_tags():
+            key = get_affinity_key(image_tag)
+            pipeline.zadd(key, {self.name: now})
+            pipeline.zremrangebyscore(key, "-inf", now - AFFINITY_TTL)
+            pipeline.expire(key, AFFINITY_TTL)
+
+    def heartbeat(self, timeout: Optional[int] = None, pipeline=None) -> None:
+        super().heartbeat(timeout, pipeline)
+        if pipeline is not None:
+            self.advertise(pipeline)
+            return
+        pipeline = self.connection.pipeline()
+        self.advertise(pipeline)
+        pipeline.execute()
+
+    def requeue_orphaned_builds(self, force: bool = False) -> int:
+        """Move builds out of image queues no live worker advertises.
+
+        At most one worker looks every `REFRESH_INTERVAL` unless forced.
+
+        Returns:
+            int: number of builds moved to the shared queue
+        """
+        key = f"{IMAGE_QUEUE_PREFIX}requeued"
+        if not force and not self.connection.set(
+            key, 1, nx=True, ex=self.REFRESH_INTERVAL
+        ):
+            return 0
+
+        moved: int = 0
+        for queue in Queue.all(
+            connection=self.connection,
+            job_class=self.job_class,
+            serializer=self.serializer,
+        ):
+            if not queue.name.startswith(IMAGE_QUEUE_PREFIX) or queue.is_empty():
+                continue
+            image_tag = queue.name.removeprefix(IMAGE_QUEUE_PREFIX)
+            if self.connection.zcount(
+                get_affinity_key(image_tag), time() - AFFINITY_TTL, "+inf"
+            ):
+                continue
+            moved += self.move_jobs(queue, queue.get_job_ids())
+
+        if moved:
+            log.info(f"Moved {moved} orphaned builds to the shared queue")
+        return moved
+
+    def move_jobs(self, queue: Queue, job_ids) -> int:
+        """Move queued jobs of `queue` to the shared queue."""
+        moved: int = 0
+        for job_id in job_ids:
+            job = queue.fetch_job(job_id)
+            # Whoever removes a job from its queue owns it.
+            if job is None or not queue.remove(job_id):
+                continue
+            self.base_queues[0].enqueue_job(job)
+            moved += 1
+        return moved
+
+    def reap_containers(self, force: bool = False) -> None:
+        """Remove build containers of jobs that are no longer running."""
+        try:
+            reaped = ContainerPool(get_podman()).reap(force)
+        except errors.APIError as e:
+            log.warning(f"Failed to reap build containers: {e}")
+            return
+
+        if reaped:
+            log.info(f"Reaped {reaped} orphaned build containers")
+
+    def bootstrap(self, *args, **kwargs) -> None:
+        super().bootstrap(*args, **kwargs)
+        self.reap_containers(force=True)
+
+    def get_image_queue(self, image_tag: str) -> Queue:
+        return Queue(
+            get_image_queue_name(image_tag),
+            connection=self.connection,
+            job_class=self.job_class,
+            serializer=self.serializer,
+        )
+
+    def order_queues(self) -> None:
+        """Listen on the session's queue, the image queues, then the rest."""
+        image_tags = [self.session_tag] if self.session_tag else []
+        image_tags += [t for t in self.image_tags if t != self.session_tag]
+        self.queues = [self.get_image_queue(t) for t in image_tags] + self.base_queues
+        self._ordered_queues = self.queues[:]
+        self.connection.hset(self.key, "queues", ",".join(self.queue_names()))
+
+    def claim_session(self, job: Job) -> None:
+        """Move queued builds using the image of `job` to its image queue."""
+        self.session_jobs.discard(job.id)
+        if settings.build_session_size <= 1:
+            return
+
+        build_request = self.get_build_request(job)
+        if build_request is None:
+            return
+        image_tag = get_image_tag(build_request.version, build_request.target)
+        image_queue = self.get_image_queue(image_tag)
+
+        if image_tag != self.session_tag:
+            self.end_session()
+            self.session_tag = image_tag
+            # Advertise before claiming, or idle workers requeue the claims.
+            self.heartbeat()
+            self.order_queues()
+
+        claimed: int = 0
+        for queue in self.base_queues:
+            for job_id in queue.get_job_ids(0, self.SESSION_SCAN - 1):
+                if claimed >= settings.build_session_size - 1:
+                    break
+
+                other = queue.fetch_job(job_id)
+                if other is None or not other.args:
+                    continue
+                other_request = other.args[0]
+                if not isinstance(other_request, BuildRequest) or image_tag != (
+                    get_image_tag(other_request.version, other_request.target)
+                ):
+                    continue
+
+                # Whoever removes a job from its queue owns it.
+                if not queue.remove(job_id):
+                    continue
+                image_queue.enqueue_job(other)
+                self.session_jobs.add(job_id)
+                claimed += 1
+
+        if claimed:
+            log.info(f"Claimed {claimed} queued builds for {image_tag}")
+
+    def end_session(self) -> None:
+        """Return the claimed builds the session did not run."""
+        if not self.session_tag:
+            return
+
+        image_queue = self.get_image_queue(self.session_tag)
+        returned = self.move_jobs(
+            image_queue,
+            [i for i in image_queue.get_job_ids() if i in self.session_jobs],
+        )
+        if returned:
+            log.info(f"Returned {returned} claimed builds to the shared queue")
+
+        if self.session_tag not in self.image_tags:
+            self.connection.zrem(get_affinity_key(self.session_tag), self.name)
+        self.session_tag = ""
+        self.session_jobs = set()
+        self.order_queues()
+
+    def get_build_request(self, job: Job) -> Optional[BuildRequest]:
+        build_request = job.args[0] if job.args else None
+        return build_request if isinstance(build_request, BuildRequest) else None
+
+    def admit(self, job: Job, queue: Queue) -> bool:
+        """Reserve host resources for a build, or defer it.
+
+        Returns:
+            bool: whether the job may run, otherwise it was requeued, or
+                failed after `MAX_DEFERRALS` deferrals
+        """
+        build_request = self.get_build_request(job)
+        if not settings.admission_control or build_request is None:
+            return True
+
+        try:
+            if Admission(get_podman()).admit(job.id, build_request):
+                return True
+        except errors.APIError as e:
+            log.warning(f"Failed to check host resources: {e}")
+            return True
+
+        # dequeue parked the job in the intermediate queue until it starts,
+        # which it never will from here.
+        queue.intermediate_queue.remove(job.id)
+        self.session_jobs.discard(job.id)
+        deferrals = self.connection.hincrby(job.key, "deferrals", 1)
+        if deferrals > self.MAX_DEFERRALS:
+            msg = "No build host had room for the build"
+            log.warning(f"Failing build {job.id}: {msg}")
+            job.meta["detail"] = f"Error: {msg}"
+            job.meta["imagebuilder_status"] = "failed"
+            JobMeta(job).save(force=True)
+            self.handle_job_failure(job, queue, exc_string=msg)
+            return False
+
+        log.info(f"Deferring build {job.id}")
+        self.end_session()
+        self.base_queues[0].enqueue_job(job)
+        sleep(self.DEFER_BACKOFF)
+        self.heartbeat()
+        return False
+
+    def release(self, job: Job) -> None:
+        """Release the host resources reserved by `admit`."""
+        if not settings.admission_control or self.get_build_request(job) is None:
+            return
+
+        try:
+            Admission(get_podman()).release(job.id)
+        except errors.APIError as e:
+            log.warning(f"Failed to release host resources: {e}")
+
+    def dequeue_job_and_maintain_ttl(
+        self, timeout: Optional[int], max_idle_time: Optional[int] = None
+    ):
+        """Dequeue like `Worker`, admit the job and claim its session."""
+        while True:
+            result = self.dequeue(timeout, max_idle_time)
+            if result is None:
+                return None
+            if self.admit(*result):
+                break
+            if timeout is None:  # Leave deferred builds to other workers.
+                return None
+
+        self.claim_session(result[0])
+        return result
+
+    def execute_job(self, job: Job, queue: Queue) -> None:
+        try:
+            super().execute_job(job, queue)
+        finally:
+            self.release(job)
+
+    def dequeue(self, timeout: Optional[int], max_idle_time: Optional[int]):
+        """Dequeue like `Worker`, refreshing the image queues while idle."""
+        if timeout is None:  # Burst mode does not block.
+            self.refresh_queues()
+            self.reap_containers()
+            self.requeue_orphaned_builds()
+            return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+
+        idle_since = time()
+        while True:
+            self.refresh_queues()
+            self.reap_containers()
+            self.requeue_orphaned_builds()
+            wait = self.REFRESH_INTERVAL
+            if max_idle_time is not None:
+                wait = min(wait, max_idle_time - int(time() - idle_since))
+                if wait <= 0:
+                    return None
+
+            result = super().dequeue_job_and_maintain_ttl(min(timeout, wait), wait)
+            if result is not None:
+                return result
+
+    def teardown(self) -> None:
+        self.end_session()
+        pipeline = self.connection.pipeline()
+        for image_tag in self.image_tags:
+            pipeline.zrem(get_affinity_key(image_tag), self.name)
+        pipeline.execute()
+        super().teardown()
+
+
+class ConcurrentWorker(AffinityWorker):
+    """Affinity worker running up to `worker_concurrency` builds at once.
+
+    A build mostly waits, on registry pulls, package downloads or uploads,
+    so one process runs several of them in threads instead of forking a
+    work horse per build.  How many builds are in network or CPU bound
+    stages at the same time is limited separately, see
+    `asu.util.stage_slot`.
+
+    A thread is claimed before a job is dequeued, so jobs never wait in
+    the worker for a free thread.  Job timeouts are enforced by raising in
+    the build thread and, as that can not interrupt a thread waiting for
+    podman, by killing the build container.  The worker is busy while any
+    thread builds, and a warm shutdown waits for running builds.
+
+    Run with `rq worker --worker-class asu.worker.ConcurrentWorker`.
+    """
+
+    death_penalty_class = TimerDeathPenalty
+
+    def __init__(self, *args, **kwargs):
+        # RQ keeps the execution of the current job on the worker.
+        self._local = threading.local()
+        self.active_jobs: int = 0
+        self.active_lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+        self.concurrency: int = max(settings.worker_concurrency, 1)
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.executor = ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix="asu-build"
+        )
+
+    @property
+    def execution(self):
+        return getattr(self._local, "execution", None)
+
+    @execution.setter
+    def execution(self, execution) -> None:
+        self._local.execution = execution
+
+    def get_heartbeat_ttl(self, job: Job) -> int:
+        # Nothing monitors the job while it runs, unlike a work horse.
+        if job.timeout == -1:
+            return DEFAULT_WORKER_TTL
+        return int(job.timeout or DEFAULT_WORKER_TTL) + 60
+
+    def dequeue_job_and_maintain_ttl(
+        self, timeout: Optional[int], max_idle_time: Optional[int] = None
+    ):
+        """Wait for a free thread, then dequeue like `AffinityWorker`."""
+        while not self.slots.acquire(timeout=self.REFRESH_INTERVAL):
+            self.heartbeat()
+
+        try:
+            result = super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        if result is None:
+            self.slots.release()
+        return result
+
+    def set_state(self, state: str, pipeline=None) -> None:
+        with self.active_lock:
+            # Dequeuing sets the worker idle while other threads build.
+            if state == WorkerStatus.IDLE and self.active_jobs:
+                state = WorkerStatus.BUSY
+            super().set_state(state, pipeline)
+
+    def execute_job(self, job: Job, queue: Queue) -> None:
+        with self.active_lock:
+            self.active_jobs += 1
+            self.set_state(WorkerStatus.BUSY)
+        self.executor.submit(self.perform_job_in_thread, job, queue)
+
+    def perform_job_in_thread(self, job: Job, queue: Queue) -> None:
+        timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+        watchdog = threading.Timer(timeout, self.kill_build, (job,))
+        watchdog.daemon = True
+        if timeout != -1:
+            watchdog.start()
+
+        try:
+            self.prepare_execution(job)
+            self.perform_job(job, queue)
+        except Exception:
+            log.exception(f"Failed to perform job {job.id}")
+        finally:
+            watchdog.cancel()
+            self.release(job)
+            self.execution = None
+            with self.active_lock:
+                self.active_jobs -= 1
+                if not self.active_jobs:
+                    self.set_state(WorkerStatus.IDLE)
+            self.slots.release()
+
+    def kill_build(self, job: Job) -> None:
+        """Kill the build container of a job that timed out."""
+        log.warning(f"Job {job.id} timed out, killing its build container")
+        try:
+            ContainerPool(get_podman()).kill(job.id)
+        except errors.APIError as e:
+            log.warning(f"Failed to kill build container of job {job.id}: {e}")
+
+    def teardown(self) -> None:
+        self.executor.shutdown(wait=True)
+        super().teardown()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from pathlib import Path
 
@@ -11,6 +12,42 @@ from asu.config import settings
 logger = logging.getLogger(__name__)
 
 
+class LoopGuard:
+    """Redis client failing when it is called from an event loop.
+
+    Pipelines only block on `execute`, queuing commands does not.
+    """
+
+    def __init__(self, redis, blocking: set[str] = None):
+        self.redis = redis
+        self.blocking = blocking
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.redis, name)
+        if not callable(attr):
+            return attr
+        if name == "pipeline":
+            return lambda *args, **kwargs: LoopGuard(
+                attr(*args, **kwargs), {"execute", "watch"}
+            )
+        if self.blocking is not None and name not in self.blocking:
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return attr(*args, **kwargs)
+            raise AssertionError(f"Blocking Redis call {name} on the event loop")
+
+        return call
+
+
+@pytest.fixture
+def loop_guard():
+    return LoopGuard
+
+
 def redis_load_mock_data(redis):
     return
     redis.sadd(
@@ -91,10 +128,10 @@ def test_path(tmp_path):
 @pytest.fixture
 def app(redis_server, test_path, monkeypatch, upstream):
     def mocked_redis_client(*args, **kwargs):
-        return redis_server
+        return LoopGuard(redis_server)
 
-    def mocked_redis_queue():
-        return Queue(connection=redis_server, is_async=settings.async_queue)
+    def mocked_redis_queue(name="default"):
+        return Queue(name, connection=redis_server, is_async=settings.async_queue)
 
     saved_upstream_url = settings.upstream_url
     saved_repository_allow_list = settings.repository_allow_list
@@ -112,7 +149,6 @@ def app(redis_server, test_path, monkeypatch, upstream):
             }
 
     monkeypatch.setattr("asu.util.get_queue", mocked_redis_queue)
-    monkeypatch.setattr("asu.routers.api.get_queue", mocked_redis_queue)
     monkeypatch.setattr("asu.util.get_redis_client", mocked_redis_client)
 
     from asu.main import app as real_app
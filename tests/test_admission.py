@@ -0,0 +1,102 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+from fakeredis import FakeStrictRedis
+
+from asu.admission import (
+    MB,
+    Admission,
+    get_workspace_estimate,
+    record_workspace_size,
+)
+from asu.build_request import BuildRequest
+from asu.config import settings
+
+build_request = BuildRequest(
+    version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+)
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.admission.get_redis_client", lambda: redis_server)
+    yield redis_server
+
+
+def _podman(mem_free: int) -> MagicMock:
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost", "memFree": mem_free}}
+    return podman
+
+
+def test_workspace_estimate(redis_server, monkeypatch):
+    monkeypatch.setattr(settings, "build_workspace_mb", 100)
+    assert get_workspace_estimate(build_request) == 100 * MB
+
+    record_workspace_size(build_request, 50 * MB)
+    assert get_workspace_estimate(build_request) == 50 * MB
+
+    # Larger builds raise the estimate at once, smaller ones slowly.
+    record_workspace_size(build_request, 80 * MB)
+    assert get_workspace_estimate(build_request) == 80 * MB
+    record_workspace_size(build_request, 30 * MB)
+    assert get_workspace_estimate(build_request) == 70 * MB
+
+
+def test_admission(redis_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "public_path", tmp_path / "public")
+    monkeypatch.setattr(settings, "build_workspace_mb", 100)
+    monkeypatch.setattr(settings, "build_memory_mb", 400)
+    monkeypatch.setattr(settings, "host_memory_reserve_mb", 500)
+    monkeypatch.setattr(settings, "host_disk_reserve_mb", 0)
+
+    # Every admission samples the host anew, like the worker does.
+    assert Admission(_podman(1400 * MB)).admit("job1", build_request)
+    assert Admission(_podman(1400 * MB)).reserved() == (1, 500 * MB, 100 * MB)
+
+    # Free memory does not show the first build yet, but its reservation
+    # leaves no room for a second one.
+    assert not Admission(_podman(1400 * MB)).admit("job2", build_request)
+
+    Admission(_podman(1400 * MB)).release("job1")
+    assert Admission(_podman(1400 * MB)).admit("job2", build_request)
+
+
+def test_admission_memory_ramp(redis_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "public_path", tmp_path)
+    monkeypatch.setattr(settings, "build_workspace_mb", 100)
+    monkeypatch.setattr(settings, "build_memory_mb", 400)
+    monkeypatch.setattr(settings, "host_memory_reserve_mb", 500)
+    monkeypatch.setattr(settings, "host_disk_reserve_mb", 0)
+    monkeypatch.setattr(settings, "build_memory_ramp", "2m")
+
+    assert Admission(_podman(1400 * MB)).admit("job1", build_request)
+    assert not Admission(_podman(1400 * MB)).admit("job2", build_request)
+
+    # After the ramp free memory accounts for job1 itself.
+    reservation = json.loads(redis_server.hget("admission:testhost", "job1"))
+    reservation["started"] -= 120
+    redis_server.hset("admission:testhost", "job1", json.dumps(reservation))
+    assert Admission(_podman(1000 * MB)).admit("job2", build_request)
+
+
+def test_admission_alone(redis_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "public_path", tmp_path)
+    monkeypatch.setattr(settings, "host_disk_reserve_mb", 1 << 40)
+
+    # Waiting frees nothing on a host without builds.
+    admission = Admission(_podman(0))
+    assert admission.admit("job1", build_request)
+    assert not admission.admit("job2", build_request)
+
+
+def test_admission_expired(redis_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "public_path", tmp_path)
+    redis_server.hset(
+        "admission:testhost", "job1", '{"memory": 1, "disk": 1, "expires": 0}'
+    )
+
+    assert Admission(_podman(1 << 40)).reserved() == (0, 0, 0)
+    assert not redis_server.hexists("admission:testhost", "job1")
@@ -302,6 +302,16 @@ def test_api_overview(client):
     assert response.status_code == 301
 
 
+def test_api_lifespan_refresher(app):
+    with TestClient(app) as client:
+        assert app.refresher is not None
+        assert "23.05.5" in app.versions
+        response = client.get("/json/v1/latest.json")
+        assert response.json()["latest"] == app.latest
+
+    assert app.refresher is None
+
+
 def test_api_build_mapping(client):
     response = client.post(
         "/api/v1/build",
@@ -486,6 +496,28 @@ def test_api_build_missing_package(app):
     assert "this-package-does-not-exist" in data["detail"]
 
 
+def test_api_build_known_package_error(client, monkeypatch):
+    async def get_package_errors(build_request):
+        return "Impossible package selection: missing not available"
+
+    monkeypatch.setattr("asu.routers.api.get_package_errors", get_package_errors)
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+            packages=["missing"],
+        ),
+    )
+
+    # Like the build that found the error.
+    assert response.status_code == 500
+    assert response.json()["detail"] == (
+        "Error: Impossible package selection: missing not available"
+    )
+
+
 def test_api_build_without_packages_list(client):
     response = client.post(
         "/api/v1/build",
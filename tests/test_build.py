@@ -54,3 +54,15 @@ def test_merge_apk_replace_mode():
         apk_mode=True,
     )
     assert "https://example.com/new" in merged
+
+
+def test_merge_cache_url():
+    merged = merge_repositories(
+        "src/gz base https://downloads.openwrt.org/base\n",
+        {"custom": "https://example.com/custom"},
+        apk_mode=False,
+        cache_url="http://cache:3128/",
+    )
+    assert "src/gz base http://cache:3128/downloads.openwrt.org/base" in merged
+    assert "src/gz custom http://cache:3128/example.com/custom" in merged
+    assert "https://" not in merged
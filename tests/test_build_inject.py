@@ -11,6 +11,7 @@ from unittest.mock import MagicMock, patch
 
 from asu.build import _make_tar, inject_files
 from asu.build_request import BuildRequest
+from asu.config import settings
 
 
 def _extract_tar(data: bytes) -> dict[str, str]:
@@ -66,8 +67,7 @@ def test_inject_files_no_extras():
     container.put_archive.assert_not_called()
 
 
-@patch("asu.build._detect_apk_mode", return_value=False)
-def test_inject_files_with_defaults(mock_detect):
+def test_inject_files_with_defaults():
     container = MagicMock()
     request = BuildRequest(
         version="1.2.3",
@@ -85,8 +85,8 @@ def test_inject_files_with_defaults(mock_detect):
     assert files["asu-files/etc/uci-defaults/99-asu-defaults"] == "echo hello"
 
 
-@patch("asu.build._detect_apk_mode", return_value=False)
-def test_inject_files_with_repositories(mock_detect):
+@patch("asu.build._read_repositories", return_value=(False, ""))
+def test_inject_files_with_repositories(mock_read):
     container = MagicMock()
     request = BuildRequest(
         version="1.2.3",
@@ -160,9 +160,8 @@ def test_inject_files_mixed_keys():
     assert len(files) == 2
 
 
-@patch("asu.build._detect_apk_mode", return_value=False)
-def test_inject_files_defaults_and_keys(mock_detect):
-    """Multiple inject types should result in multiple put_archive calls."""
+def test_inject_files_defaults_and_keys():
+    """Multiple inject types are uploaded in a single archive."""
     container = MagicMock()
     key_data = base64.b64encode(b"\x00" * 42).decode()
     request = BuildRequest(
@@ -173,4 +172,64 @@ def test_inject_files_defaults_and_keys(mock_detect):
         repository_keys=[key_data],
     )
     inject_files(container, request)
-    assert container.put_archive.call_count == 2
+    container.put_archive.assert_called_once()
+
+    files = _extract_tar(container.put_archive.call_args[0][1])
+    assert len(files) == 2
+    container.exec_run.assert_not_called()
+
+
+def _probe(container, output: str) -> None:
+    container.exec_run.return_value = (0, (output.encode(), b""))
+
+
+def test_inject_files_repositories_append(monkeypatch):
+    monkeypatch.setattr(settings, "cache_url", "")
+    monkeypatch.setattr(settings, "repository_allow_list", ["https://example.com/"])
+    container = MagicMock()
+    _probe(container, "apk\nhttps://downloads.openwrt.org/base\n")
+    request = BuildRequest(
+        version="25.12.2",
+        target="testtarget/testsubtarget",
+        profile="testprofile",
+        repositories={"custom": "https://example.com/custom"},
+        repositories_mode="append",
+        defaults="echo test",
+    )
+    inject_files(container, request)
+
+    container.exec_run.assert_called_once()
+    container.put_archive.assert_called_once()
+    files = _extract_tar(container.put_archive.call_args[0][1])
+    assert files["repositories"] == (
+        "https://downloads.openwrt.org/base\nhttps://example.com/custom\n"
+    )
+    assert "asu-files/etc/uci-defaults/99-asu-defaults" in files
+
+
+def test_inject_files_cache_url(monkeypatch):
+    monkeypatch.setattr(settings, "cache_url", "http://cache:3128/")
+    container = MagicMock()
+    _probe(
+        container,
+        "opkg\nsrc/gz base https://downloads.openwrt.org/base\n"
+        "src imagebuilder file:packages\noption check_signature\n",
+    )
+    request = BuildRequest(
+        version="1.2.3",
+        target="testtarget/testsubtarget",
+        profile="testprofile",
+    )
+    inject_files(container, request)
+
+    container.exec_run.assert_called_once()
+    files = _extract_tar(container.put_archive.call_args[0][1])
+    assert files["repositories.conf"].startswith(
+        "src/gz base http://cache:3128/downloads.openwrt.org/base\n"
+    )
+
+    # Nothing is written when the repositories can not be read.
+    container = MagicMock()
+    _probe(container, "")
+    inject_files(container, request)
+    container.put_archive.assert_not_called()
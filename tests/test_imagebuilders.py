@@ -0,0 +1,199 @@
+from itertools import count
+from time import time
+from unittest.mock import MagicMock
+
+import pytest
+from fakeredis import FakeStrictRedis
+from podman import errors
+
+from asu.config import settings
+from asu.imagebuilders import (
+    ImageBuilderCache,
+    get_image_key,
+    load_info,
+    load_manifest,
+    pull_image,
+    save_info,
+    save_manifest,
+)
+
+IMAGE = "ghcr.io/openwrt/imagebuilder:ath79-generic-master"
+
+
+def _image(created: int) -> MagicMock:
+    image = MagicMock()
+    image.attrs = {"Created": created}
+    return image
+
+
+def test_imagebuilder_cache_tag():
+    cache = ImageBuilderCache(MagicMock())
+    assert cache.tag(IMAGE, "r12345-abcdef") == "ath79-generic-master-r12345-abcdef"
+
+
+def test_imagebuilder_cache_get():
+    podman = MagicMock()
+    podman.images.exists.return_value = True
+    cache = ImageBuilderCache(podman)
+
+    assert (
+        cache.get(IMAGE, "r1-a")
+        == "localhost/asu-imagebuilder:ath79-generic-master-r1-a"
+    )
+    assert cache.get(IMAGE, "") is None
+
+    podman.images.exists.return_value = False
+    assert cache.get(IMAGE, "r1-a") is None
+
+
+def test_imagebuilder_cache_disabled(monkeypatch):
+    monkeypatch.setattr(settings, "imagebuilder_cache_revisions", 0)
+    podman = MagicMock()
+    container = MagicMock()
+    cache = ImageBuilderCache(podman)
+
+    assert cache.get(IMAGE, "r1-a") is None
+    cache.store(container, IMAGE, "r1-a")
+    container.commit.assert_not_called()
+
+
+def test_imagebuilder_cache_store_evicts(monkeypatch):
+    monkeypatch.setattr(settings, "imagebuilder_cache_revisions", 2)
+    images = [_image(1), _image(3), _image(2)]
+    podman = MagicMock()
+    podman.images.list.return_value = images
+    container = MagicMock()
+
+    ImageBuilderCache(podman).store(container, IMAGE, "r3-c")
+
+    container.commit.assert_called_once()
+    assert container.commit.call_args.kwargs["tag"] == "ath79-generic-master-r3-c"
+    images[0].remove.assert_called_once()
+    images[1].remove.assert_not_called()
+    images[2].remove.assert_not_called()
+
+
+def test_imagebuilder_image_key():
+    container = MagicMock()
+    container.attrs = {"Image": "abc123"}
+
+    assert get_image_key(container) == "abc123"
+    assert get_image_key(container, "r1-a") == "abc123:r1-a"
+
+
+def test_imagebuilder_info_cache(redis_server, monkeypatch):
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    info = {"revision": "r1-a", "default_packages": ["busybox"], "profiles": {}}
+
+    assert load_info("abc123") is None
+    save_info("abc123", info)
+    assert load_info("abc123") == info
+    assert load_info("abc123:r1-a") is None
+    assert redis_server.ttl("imagebuilder:info:abc123") > 0
+
+
+def test_imagebuilder_manifest_cache(redis_server, monkeypatch):
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    manifest = {"busybox": "1.36.1-r1", "vim": "9.1-r1"}
+
+    assert load_manifest("abc123", "generic", ["vim"]) is None
+    save_manifest("abc123", "generic", ["vim"], manifest)
+
+    assert load_manifest("abc123", "generic", ["vim"]) == manifest
+    assert load_manifest("abc123", "generic", ["vim", "-ppp"]) is None
+    assert load_manifest("abc123", "other", ["vim"]) is None
+    assert load_manifest("def456", "generic", ["vim"]) is None
+
+
+def test_pull_image_skips_fresh(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr(settings, "image_pull_ttl", "10m")
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+    podman.images.pull.return_value.id = "abc123"
+
+    pull_image(podman, IMAGE)
+    pull_image(podman, IMAGE)
+    podman.images.pull.assert_called_once_with(IMAGE)
+
+    key = f"image:pull:testhost:{IMAGE}"
+    assert redis_server.hget(key, "id") == "abc123"
+
+    # Image removed locally, e.g. by podman image prune.
+    podman.images.exists.return_value = False
+    pull_image(podman, IMAGE)
+    assert podman.images.pull.call_count == 2
+
+
+def test_pull_image_stale(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+
+    podman.images.pull.return_value.id = "def456"
+
+    redis_server.hset(f"image:pull:testhost:{IMAGE}", "pulled_at", time() - 3600)
+    pull_image(podman, IMAGE)
+    podman.images.pull.assert_called_once_with(IMAGE)
+
+
+def test_pull_image_not_found(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+    podman.images.pull.side_effect = errors.ImageNotFound("not found")
+
+    with pytest.raises(errors.ImageNotFound):
+        pull_image(podman, IMAGE)
+
+    assert not redis_server.exists(f"image:pull:testhost:{IMAGE}")
+    assert not redis_server.exists(f"image:pull:testhost:{IMAGE}:lock")
+
+
+def test_pull_image_waits_for_other_worker(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+    key = f"image:pull:testhost:{IMAGE}"
+    redis_server.set(f"{key}:lock", 1)
+
+    def other_worker_done(seconds):
+        redis_server.hset(key, "pulled_at", time())
+        redis_server.delete(f"{key}:lock")
+
+    monkeypatch.setattr("asu.imagebuilders.sleep", other_worker_done)
+
+    pull_image(podman, IMAGE)
+    podman.images.pull.assert_not_called()
+
+
+def test_pull_image_keeps_lock_of_other_worker(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.imagebuilders.get_redis_client", lambda: redis_server)
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+    lock = f"image:pull:testhost:{IMAGE}:lock"
+
+    # The lock expired during the pull and another worker took it.
+    def pull(image):
+        redis_server.set(lock, "other")
+        return MagicMock(id="abc123")
+
+    podman.images.pull.side_effect = pull
+    pull_image(podman, IMAGE)
+    assert redis_server.get(lock) == "other"
+
+    # A worker giving up on waiting pulls without the lock.
+    clock = count(time(), 3600)
+    monkeypatch.setattr("asu.imagebuilders.time", lambda: next(clock))
+    monkeypatch.setattr("asu.imagebuilders.sleep", lambda seconds: None)
+    podman.images.pull.side_effect = None
+    podman.images.pull.return_value.id = "abc123"
+    podman.images.exists.return_value = False
+    pull_image(podman, IMAGE)
+    assert podman.images.pull.call_count == 2
+    assert redis_server.get(lock) == "other"
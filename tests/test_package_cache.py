@@ -0,0 +1,152 @@
+import os
+import shutil
+import subprocess
+from unittest.mock import MagicMock
+
+import pytest
+from fakeredis import FakeStrictRedis
+
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.package_cache import (
+    EVICT_SCRIPT,
+    FETCH_SCRIPT,
+    STORE_SCRIPT,
+    PackageCache,
+)
+from asu.repositories import merge_repositories
+
+build_request = BuildRequest(
+    version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+)
+
+
+@pytest.fixture
+def package_cache(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.package_cache.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr(settings, "package_cache_volume", "asu-package-cache")
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+    return PackageCache(podman, build_request)
+
+
+def _sh(script: str, cwd) -> str:
+    return subprocess.run(
+        ["sh", "-c", script], cwd=cwd, capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def test_package_cache_disabled(monkeypatch):
+    monkeypatch.setattr(settings, "package_cache_volume", "")
+    package_cache = PackageCache(MagicMock(), build_request)
+    container = MagicMock()
+
+    assert package_cache.volumes() == {}
+    package_cache.fetch(container, "image:r1", {"busybox": "1.36.1-r1"})
+    package_cache.store(container, "image:r1")
+    container.exec_run.assert_not_called()
+
+
+def test_package_cache_fetch(package_cache):
+    container = MagicMock()
+    container.exec_run.return_value = (0, (b"", b""))
+
+    assert package_cache.volumes() == {
+        "asu-package-cache": {"bind": "/cache/packages", "mode": "rw"}
+    }
+    package_cache.fetch(container, "image:r1", {"busybox": "1.36.1-r1"})
+    script = container.exec_run.call_args[0][0][-1]
+    assert "dir=/cache/packages/image:r1" in script
+    assert "for package in busybox/1.36.1-r1; do" in script
+
+    # Records of snapshot ImageBuilders without a known revision are not shared.
+    container.reset_mock()
+    package_cache.fetch(container, "", {"busybox": "1.36.1-r1"})
+    package_cache.store(container, "")
+    container.exec_run.assert_not_called()
+
+
+def test_package_cache_bypassed_for_repositories(package_cache):
+    custom_request = build_request.model_copy(
+        update={"repositories": {"custom": "https://example.com/packages"}}
+    )
+    package_cache = PackageCache(package_cache.podman, custom_request)
+    container = MagicMock()
+
+    assert package_cache.volumes() == {}
+    package_cache.prepare(container)
+    package_cache.fetch(container, "image:r1", {"busybox": "1.36.1-r1"})
+    package_cache.store(container, "image:r1")
+    container.exec_run.assert_not_called()
+
+
+def test_package_cache_url_rewrite_only():
+    base = "src/gz base https://downloads.openwrt.org/base\n"
+    merged = merge_repositories(base, {}, apk_mode=False, cache_url="http://cache/")
+    assert merged == "src/gz base http://cache/downloads.openwrt.org/base\n"
+
+
+def test_package_cache_evicts_once_per_interval(package_cache):
+    container = MagicMock()
+    container.exec_run.return_value = (0, (b"", b""))
+
+    package_cache.store(container, "image:r1")
+    package_cache.store(container, "image:r1")
+
+    scripts = [c[0][0][-1] for c in container.exec_run.call_args_list]
+    assert len(scripts) == 3
+    assert "du -sk" in scripts[1]
+
+
+def test_package_cache_scripts(tmp_path):
+    cache = tmp_path / "cache"
+    builder = tmp_path / "builder"
+    lists = builder / "tmp" / "opkg-lists"
+    lists.mkdir(parents=True)
+    (lists / "Packages").write_text("Package: libubox20240329\n")
+    (builder / "dl").mkdir()
+    ipk = "libubox20240329_2024.03.29-r1_mips.ipk"
+
+    def fetch():
+        _sh(
+            FETCH_SCRIPT.format(
+                cache=cache, key="image", packages="libubox/2024.03.29-r1", ttl=60
+            ),
+            builder,
+        )
+        return sorted(f.name for f in (builder / "dl").iterdir())
+
+    assert fetch() == []
+
+    # Downloaded by make image, then stored and fetched by the next build
+    # under the ABI versioned name the manifest strips.
+    (builder / "dl" / ipk).write_bytes(b"x" * 4096)
+    _sh(STORE_SCRIPT.format(cache=cache, key="image"), builder)
+    (builder / "dl" / ipk).unlink()
+
+    assert fetch() == [ipk]
+    assert (builder / "dl" / ipk).read_bytes() == b"x" * 4096
+
+    # Without package indexes, e.g. after a cached manifest, the files are
+    # used until they are as old as cached manifests.
+    (builder / "dl" / ipk).unlink()
+    shutil.rmtree(builder / "tmp")
+    assert fetch() == [ipk]
+
+    (builder / "dl" / ipk).unlink()
+    os.utime(cache / "image" / ".index", (0, 0))
+    assert fetch() == []
+
+    # A changed package index does not match older files.
+    lists.mkdir(parents=True)
+    (lists / "Packages").write_text("Package: libubox20240329\n\n")
+    os.utime(cache / "image" / ".index")
+    assert fetch() == []
+
+    # And storing for it drops them.
+    _sh(STORE_SCRIPT.format(cache=cache, key="image"), builder)
+    assert sorted(f.name for f in (cache / "image").iterdir()) == [".index"]
+
+    _sh(EVICT_SCRIPT.format(cache=cache, limit=0), builder)
+    assert list(cache.iterdir()) == []
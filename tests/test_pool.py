@@ -0,0 +1,213 @@
+from time import time
+from unittest.mock import MagicMock
+
+import pytest
+from fakeredis import FakeStrictRedis
+from podman import errors
+
+from asu.config import settings
+from asu.pool import ContainerPool
+
+
+def _container(container_id: str, expires: int = None) -> MagicMock:
+    container = MagicMock()
+    container.id = container_id
+    container.status = "running"
+    container.labels = {ContainerPool.LABEL_EXPIRES: str(expires or int(time()) + 3600)}
+    container.exec_run.return_value = (0, (b"", b""))
+    return container
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.pool.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr(settings, "container_pool_size", 2)
+    monkeypatch.setattr(settings, "container_pool_idle", "15m")
+
+    containers = {}
+    podman = MagicMock()
+    podman.info.return_value = {"host": {"hostname": "testhost"}}
+
+    def get(container_id):
+        if container_id not in containers:
+            raise errors.NotFound(container_id)
+        return containers[container_id]
+
+    podman.containers.get.side_effect = get
+
+    pool = ContainerPool(podman)
+    pool.rc.flushall()
+    pool.containers = containers
+    yield pool
+
+
+def test_pool_ttl_covers_job_timeout(pool, monkeypatch):
+    monkeypatch.setattr(settings, "container_pool_ttl", "1m")
+    monkeypatch.setattr(settings, "job_timeout", "10m")
+
+    # Containers never stop sleeping before a build in them times out.
+    assert ContainerPool(pool.podman).ttl == 600
+
+
+def test_pool_acquire_empty(pool):
+    assert pool.acquire("image:a") is None
+
+
+def test_pool_release_and_acquire(pool):
+    container = _container("c1")
+    pool.containers["c1"] = container
+
+    pool.release(container, "image:a")
+    container.remove.assert_not_called()
+
+    assert pool.acquire("image:b") is None
+    assert pool.acquire("image:a") is container
+    assert pool.acquire("image:a") is None
+
+
+def test_pool_release_resets_workspace(pool):
+    container = _container("c1")
+    pool.release(container, "image:a")
+
+    command = container.exec_run.call_args[0][0]
+    assert "make clean" in command[-1]
+    assert "cp -a .asu-pristine/. ." in command[-1]
+
+
+def test_pool_release_failed_reset(pool):
+    container = _container("c1")
+    container.exec_run.return_value = (1, (b"", b"error"))
+
+    pool.release(container, "image:a")
+
+    container.remove.assert_called_once()
+    assert pool.acquire("image:a") is None
+
+
+def test_pool_release_disabled(pool):
+    pool.size = 0
+    container = _container("c1")
+
+    pool.release(container, "image:a")
+
+    container.remove.assert_called_once()
+    container.exec_run.assert_not_called()
+
+
+def test_pool_release_expiring(pool):
+    container = _container("c1", expires=int(time()) + 10)
+
+    pool.release(container, "image:a")
+
+    container.remove.assert_called_once()
+
+
+def test_pool_evicts_least_recently_used(pool):
+    for container_id in ["c1", "c2", "c3"]:
+        pool.containers[container_id] = _container(container_id)
+        pool.release(pool.containers[container_id], "image:a")
+
+    pool.containers["c1"].remove.assert_called_once()
+    pool.containers["c2"].remove.assert_not_called()
+    pool.containers["c3"].remove.assert_not_called()
+
+    assert pool.acquire("image:a") is pool.containers["c3"]
+
+
+def test_pool_evicts_idle(pool):
+    container = _container("c1")
+    pool.containers["c1"] = container
+    pool.rc.zadd(pool.key, {"image:a c1": time() - 3600})
+
+    assert pool.acquire("image:a") is None
+    container.remove.assert_called_once()
+
+
+def test_pool_acquire_removed_container(pool):
+    pool.rc.zadd(pool.key, {"image:a gone": time()})
+
+    assert pool.acquire("image:a") is None
+
+
+def _job(job_id: str, worker_name: str = "w1") -> MagicMock:
+    job = MagicMock()
+    job.id = job_id
+    job.worker_name = worker_name
+    return job
+
+
+def test_pool_acquire_records_owner(pool):
+    container = _container("c1")
+    pool.containers["c1"] = container
+    pool.release(container, "image:a")
+
+    assert pool.acquire("image:a", _job("j1")) is container
+    assert pool.rc.hget(pool.owners_key, "c1") == "j1 w1"
+
+    pool.release(container, "image:a")
+    assert pool.rc.hget(pool.owners_key, "c1") is None
+
+
+def test_pool_kill(pool):
+    def labeled(container_id, job_id):
+        container = _container(container_id)
+        container.labels[ContainerPool.LABEL_JOB] = job_id
+        return container
+
+    containers = [
+        labeled("created", "j1"),
+        labeled("acquired", "j0"),
+        labeled("reused", "j1"),
+        labeled("pooled", "j1"),
+        labeled("other", "j2"),
+    ]
+    pool.podman.containers.list.return_value = containers
+    pool.rc.zadd(pool.key, {"image:a pooled": time()})
+    pool.rc.hset(pool.owners_key, mapping={"acquired": "j1 w1", "reused": "j2 w1"})
+
+    assert pool.kill("j1") == 2
+    assert [c.id for c in containers if c.remove.called] == ["created", "acquired"]
+    assert pool.rc.hkeys(pool.owners_key) == ["reused"]
+
+
+def test_pool_reap(pool, monkeypatch):
+    jobs = {}
+    for job_id, status in [("j1", "started"), ("j2", "finished"), ("j3", "started")]:
+        jobs[job_id] = _job(job_id)
+        jobs[job_id].get_status.return_value = status
+        jobs[job_id].connection = pool.rc
+    monkeypatch.setattr("asu.pool.fetch_job", jobs.get)
+    pool.rc.set("rq:worker:w1", 1)
+
+    def labeled(container_id, job_id, worker_name="w1"):
+        container = _container(container_id)
+        container.labels.update(
+            {ContainerPool.LABEL_JOB: job_id, ContainerPool.LABEL_WORKER: worker_name}
+        )
+        return container
+
+    containers = [
+        labeled("running", "j1"),
+        labeled("finished", "j2"),
+        labeled("pooled", "j2"),
+        labeled("reused", "j2"),
+        labeled("dead-worker", "j3", "w2"),
+        labeled("no-job", "j4"),
+    ]
+    pool.podman.containers.list.return_value = containers
+    pool.rc.zadd(pool.key, {"image:a pooled": time()})
+    pool.rc.hset(pool.owners_key, mapping={"reused": "j1 w1", "gone": "j1 w1"})
+
+    assert pool.reap() == 3
+    assert [c.id for c in containers if c.remove.called] == [
+        "finished",
+        "dead-worker",
+        "no-job",
+    ]
+    assert pool.rc.hkeys(pool.owners_key) == ["reused"]
+
+    # Other workers of the host skip the sweep for a while.
+    pool.podman.containers.list.return_value = containers[:1] + containers[2:4]
+    assert pool.reap() == 0
+    assert pool.reap(force=True) == 0
@@ -0,0 +1,128 @@
+import base64
+import io
+import struct
+
+import nacl.signing
+
+from asu.signing import (
+    FWIMAGE_MAGIC,
+    FWIMAGE_SIGNATURE,
+    FWIMAGE_TRAILER,
+    fwtool_crc32,
+    fwtool_signature_block,
+    fwtool_strip_signature,
+    sign_images,
+)
+from asu.util import sign_usign, sign_usign_chunks, verify_usign
+
+KEYNUM = bytes.fromhex("0123456789abcdef")
+
+
+def _usign_keys() -> tuple[str, str]:
+    """Return an unencrypted usign secret and public key pair."""
+    signing_key = nacl.signing.SigningKey.generate()
+    pubkey = bytes(signing_key.verify_key)
+    seckey = struct.pack(
+        "!2s2sI16s8s8s64s",
+        b"Ed",
+        b"BK",
+        0,
+        b"\0" * 16,
+        b"\0" * 8,
+        KEYNUM,
+        bytes(signing_key) + pubkey,
+    )
+    pubkey = struct.pack("!2s8s32s", b"Ed", KEYNUM, pubkey)
+    return (
+        f"untrusted comment: private key\n{base64.b64encode(seckey).decode()}\n",
+        base64.b64encode(pubkey).decode(),
+    )
+
+
+def _parse_blobs(data: bytes) -> list[tuple[int, bytes]]:
+    blobs = []
+    while data:
+        (id_len,) = struct.unpack("!I", data[:4])
+        length = id_len & 0xFFFFFF
+        blobs.append((id_len >> 24, data[4:length]))
+        data = data[(length + 3) & ~3 :]
+    return blobs
+
+
+def test_sign_usign(tmp_path):
+    sec_key, pub_key = _usign_keys()
+
+    signature = sign_usign(b"firmware", sec_key)
+    assert signature.startswith("untrusted comment: signed by key 0123456789abcdef\n")
+
+    (tmp_path / "msg").write_bytes(b"firmware")
+    (tmp_path / "msg.sig").write_text(signature)
+    assert verify_usign(tmp_path / "msg.sig", tmp_path / "msg", pub_key)
+
+    (tmp_path / "msg").write_bytes(b"tampered")
+    assert not verify_usign(tmp_path / "msg.sig", tmp_path / "msg", pub_key)
+
+
+def test_sign_usign_chunks():
+    sec_key, _ = _usign_keys()
+    msg = b"firmware" * 1000
+
+    assert sign_usign_chunks(lambda: [msg[:100], msg[100:]], sec_key) == sign_usign(
+        msg, sec_key
+    )
+    assert sign_usign_chunks(lambda: [], sec_key) == sign_usign(b"", sec_key)
+
+
+def test_fwtool_append_and_strip_signature():
+    image = b"\x27\x05\x19\x56" + b"x" * 1000
+    assert fwtool_crc32(image[500:], fwtool_crc32(image[:500])) == fwtool_crc32(image)
+
+    signed = image + fwtool_signature_block(fwtool_crc32(image), b"certificate")
+
+    magic, crc32, data_type, size = FWIMAGE_TRAILER.unpack(signed[-16:])
+    assert magic == FWIMAGE_MAGIC
+    assert data_type == FWIMAGE_SIGNATURE
+    assert size == len(b"certificate") + 16
+    assert crc32 == fwtool_crc32(image + b"certificate")
+
+    assert fwtool_strip_signature(io.BytesIO(signed)) == len(image)
+    assert fwtool_strip_signature(io.BytesIO(image)) == len(image)
+
+
+def test_fwtool_strip_signature_bad_crc():
+    signed = bytearray(b"x" * 100)
+    signed += fwtool_signature_block(fwtool_crc32(signed), b"certificate")
+    signed[0] = ord("y")
+
+    assert fwtool_strip_signature(io.BytesIO(signed)) == len(signed)
+
+
+def test_sign_images(tmp_path, monkeypatch):
+    monkeypatch.setattr("asu.signing.CHUNK_SIZE", 1000)
+    sec_key, pub_key = _usign_keys()
+    (tmp_path / "key-build").write_text(sec_key)
+    (tmp_path / "key-build.ucert").write_bytes(b"")
+
+    image = tmp_path / "openwrt-sysupgrade.bin"
+    image.write_bytes(b"x" * 4096)
+
+    sign_images([image], tmp_path / "key-build")
+    # Signing again replaces the signature instead of stacking a second one.
+    sign_images([image], tmp_path / "key-build")
+
+    signed = image.read_bytes()
+    _, _, _, size = FWIMAGE_TRAILER.unpack(signed[-16:])
+    cert = signed[-size:-16]
+    assert signed[:-size] == b"x" * 4096
+    assert [p.name for p in tmp_path.glob(".*")] == []
+    assert cert == (tmp_path / "openwrt-sysupgrade.bin.ucert").read_bytes()
+
+    [(root_id, root)] = _parse_blobs(cert)
+    [(attr_id, signature)] = _parse_blobs(root)
+    assert root_id == 0 and attr_id == 0
+    assert signature.decode() == (tmp_path / "openwrt-sysupgrade.bin.sig").read_text()
+
+    (tmp_path / "msg").write_bytes(signed[:-size])
+    assert verify_usign(
+        tmp_path / "openwrt-sysupgrade.bin.sig", tmp_path / "msg", pub_key
+    )
@@ -0,0 +1,152 @@
+import os
+
+import pytest
+from podman import errors
+from rq import Queue
+
+from asu.build import build
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.simulated import SimulatedPodmanClient, get_stage, labels_match
+from asu.util import get_podman, run_cmd
+
+IMAGE = "ghcr.io/openwrt/imagebuilder:testtarget-testsubtarget-v1.2.3"
+
+
+@pytest.fixture
+def simulated(monkeypatch):
+    monkeypatch.setattr(settings, "builder_backend", "simulated")
+    monkeypatch.setattr(SimulatedPodmanClient, "_shared", None)
+    yield get_podman()
+
+
+def test_simulated_backend(simulated):
+    assert isinstance(simulated, SimulatedPodmanClient)
+    assert get_podman() is simulated
+
+    simulated.images.pull(IMAGE)
+    container = simulated.containers.create(IMAGE, labels={"asu.job": "1"})
+    container.start()
+    assert simulated.containers.list(filters={"label": "asu.job=1"}) == [container]
+    assert simulated.containers.list(filters={"label": "asu.job=2"}) == []
+
+    returncode, stdout, _ = run_cmd(container, ["make", "info"])
+    assert returncode == 0
+    assert 'Current Revision: "r12647-cb44ab4f5d"' in stdout
+
+    returncode, stdout, _ = run_cmd(
+        container, ["make", "manifest", "PROFILE=testprofile", "PACKAGES=vim -test2"]
+    )
+    assert "test1 - 1.0\n" in stdout
+    assert "vim - 1.0\n" in stdout
+    assert "test2 - " not in stdout
+
+
+def test_simulated_host(simulated, monkeypatch, tmp_path):
+    # Every process is a podman host of its own.
+    assert simulated.info()["host"]["hostname"].endswith(f"-{os.getpid()}")
+
+    simulated.images.pull(IMAGE)
+    container = simulated.containers.create(IMAGE)
+    container.files["/builder/file"] = b"data"
+    container.remove()
+    assert container.files == {}
+
+    monkeypatch.setattr(settings, "simulated_imagebuilder", tmp_path)
+    with pytest.raises(
+        FileNotFoundError, match="No \\*.info in simulated_imagebuilder"
+    ):
+        container.exec_run(["make", "info"])
+
+
+def test_simulated_image(simulated, tmp_path):
+    simulated.images.pull(IMAGE)
+    container = simulated.containers.create(IMAGE)
+
+    run_cmd(
+        container,
+        [
+            "make",
+            "image",
+            "PROFILE=testprofile",
+            "EXTRA_IMAGE_NAME=abc",
+            "BIN_DIR=/builder/workspace/hash",
+        ],
+        copy=["/builder/workspace/hash", tmp_path],
+    )
+
+    assert (tmp_path / "hash/profiles.json").is_file()
+    image = "openwrt-testtarget-testsubtarget-testprofile-abc-sysupgrade.bin"
+    assert (tmp_path / "hash" / image).is_file()
+
+
+def test_simulated_failures(simulated, monkeypatch):
+    monkeypatch.setattr(settings, "simulated_failure_rate", 1.0)
+    with pytest.raises(errors.ImageNotFound):
+        simulated.images.pull(IMAGE)
+
+    monkeypatch.setattr(settings, "simulated_failure_rate", 0.0)
+    simulated.images.pull(IMAGE)
+    container = simulated.containers.create(IMAGE)
+    monkeypatch.setattr(settings, "simulated_failure_rate", 1.0)
+
+    returncode, _, stderr = run_cmd(container, ["make", "image", "BIN_DIR=/x"])
+    assert returncode == 1
+    assert "Simulated failure of image" in stderr
+
+    # Commands outside the simulated stages never fail.
+    assert run_cmd(container, ["sh", "-c", "true"])[0] == 0
+
+
+def test_simulated_stage():
+    assert get_stage(["sh", "setup.sh"]) == "setup"
+    assert get_stage(["make", "image", "PROFILE=x"]) == "image"
+    assert get_stage(["make", "clean"]) == ""
+    assert labels_match({"a": "1", "b": "2"}, ["a", "b=2"])
+    assert not labels_match({"a": "1"}, ["a=2"])
+
+
+def test_simulated_api_build(client, simulated, redis_server, monkeypatch):
+    for module in ["admission", "imagebuilders", "package_cache", "pool", "store"]:
+        monkeypatch.setattr(f"asu.{module}.get_redis_client", lambda: redis_server)
+    # The shared Redis fixture returns bytes, which pooling does not expect.
+    monkeypatch.setattr(settings, "container_pool_size", 0)
+
+    response = client.post(
+        "/api/v1/build",
+        json=dict(
+            version="1.2.3",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+            packages=["test1", "vim"],
+        ),
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["manifest"]["vim"] == "1.0"
+    assert data["images"][0]["name"].endswith("-sysupgrade.bin")
+
+
+def test_simulated_build_revision_changed(client, simulated, redis_server, monkeypatch):
+    for module in ["admission", "imagebuilders", "package_cache", "pool", "store"]:
+        monkeypatch.setattr(f"asu.{module}.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr(settings, "container_pool_size", 0)
+    # Upstream moved on between the revision lookup and setup.sh.
+    monkeypatch.setattr("asu.build.get_revision", lambda *args: "r1-stale")
+
+    queue = Queue(connection=redis_server, is_async=False)
+    job = queue.enqueue(
+        build,
+        BuildRequest(
+            version="SNAPSHOT",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+            packages=["vim"],
+        ),
+    )
+    assert job.get_status() == "finished"
+
+    # Records are kept under the revision the ImageBuilder reported.
+    keys = [key.decode() for key in redis_server.keys("imagebuilder:manifest:*")]
+    assert len(keys) == 1
+    assert ":r12647-cb44ab4f5d:" in keys[0]
@@ -258,3 +258,23 @@ def test_build_error_log_respects_n_entries(client, redis_server):
     entries = error_log.get_entries(n_entries=3)
     assert len(entries) == 3
     assert "Error 9" in entries[0]
+
+
+def test_stats_build_stages(client, redis_server: FakeStrictRedis):
+    from asu.util import add_stage_timings
+
+    build_request = BuildRequest(**build_config_1)
+    add_stage_timings(build_request, {"pull": 1.5, "image": 30.0})
+    time.sleep(0.01)  # Ensure separate samples.
+    add_stage_timings(build_request, {"pull": 0.5, "image": 50.0})
+
+    response = client.get("/api/v1/build-stages")
+    assert response.status_code == 200
+
+    stages = response.json()["stages"]
+    assert stages["pull"] == {"average": 1.0, "builds": 2}
+    assert stages["image"] == {"average": 40.0, "builds": 2}
+
+    response = client.get("/api/v1/build-stages?target=other/target")
+    assert response.status_code == 200
+    assert response.json()["stages"] == {}
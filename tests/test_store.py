@@ -1,8 +1,12 @@
 import tempfile
 from pathlib import Path
+from unittest.mock import MagicMock
 
+from asu.build import _make_tar
 from asu.config import settings
-from asu.store import LocalStore
+from asu.build_request import BuildRequest
+from asu.store import LocalStore, get_artifact_hash, link_artifact, save_artifact
+from asu.util import copy_from_container
 
 
 def test_store_content_type_img(client):
@@ -89,3 +93,84 @@ def test_local_store_get_url():
         store = LocalStore()
 
         assert store.get_url("abc123/image.bin") == "/store/abc123/image.bin"
+
+
+def test_local_store_link_dir():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings.public_path = Path(tmpdir)
+        store = LocalStore()
+
+        src_dir = Path(tmpdir) / "store" / "abc123"
+        src_dir.mkdir(parents=True)
+        (src_dir / "image.bin").write_bytes(b"fw1")
+        (src_dir / "profiles.json").write_text("{}")
+
+        assert store.link_dir("abc123", "def456") == 2
+        assert store.exists("def456/image.bin")
+        assert store.exists("def456/profiles.json")
+        assert (src_dir / "image.bin").stat().st_nlink == 1
+
+        assert store.link_dir("gone", "ghi789") == 0
+
+
+def test_local_store_link_dir_rebuild():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings.public_path = Path(tmpdir)
+        store = LocalStore()
+
+        src_dir = Path(tmpdir) / "store" / "abc123"
+        src_dir.mkdir(parents=True)
+        (src_dir / "image.bin").write_bytes(b"fw1")
+        assert store.link_dir("abc123", "def456") == 1
+
+        # Rebuilding one request extracts over its files in place.
+        container = MagicMock()
+        container.get_archive.return_value = (
+            [_make_tar({"abc123/image.bin": b"fw2"})],
+            {},
+        )
+        copy_from_container(container, "/builder/abc123", src_dir.parent)
+
+        assert (src_dir / "image.bin").read_bytes() == b"fw2"
+        assert store.get_local_path("def456/image.bin").read_bytes() == b"fw1"
+
+
+def test_artifact_hash():
+    build_request = BuildRequest(
+        version="1.2.3", target="testtarget/testsubtarget", profile="testprofile"
+    )
+    manifest = {"busybox": "1.36.1-r1", "vim": "9.1-r1"}
+    artifact_hash = get_artifact_hash(build_request, "r1-a", manifest)
+
+    # Package order and selection syntax do not change the firmware.
+    build_request.packages = ["vim", "busybox"]
+    build_request.diff_packages = True
+    assert get_artifact_hash(
+        build_request, "r1-a", dict(reversed(manifest.items()))
+    ) == (artifact_hash)
+
+    assert get_artifact_hash(build_request, "r2-b", manifest) != artifact_hash
+    build_request.rootfs_size_mb = 256
+    assert get_artifact_hash(build_request, "r1-a", manifest) != artifact_hash
+
+
+def test_link_artifact(redis_server, monkeypatch):
+    monkeypatch.setattr("asu.store.get_redis_client", lambda: redis_server)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings.public_path = Path(tmpdir)
+        result = {"bin_dir": "abc123", "images": []}
+
+        assert link_artifact("x" * 64, "def456") is None
+
+        save_artifact("x" * 64, "abc123", result)
+        assert link_artifact("x" * 64, "def456") is None  # No artifacts stored.
+        assert not redis_server.exists("artifact:" + "x" * 64)
+
+        src_dir = Path(tmpdir) / "store" / "abc123"
+        src_dir.mkdir(parents=True)
+        (src_dir / "profiles.json").write_text("{}")
+
+        save_artifact("x" * 64, "abc123", result)
+        assert link_artifact("x" * 64, "def456") == result
+        assert (Path(tmpdir) / "store" / "def456" / "profiles.json").is_file()
+        assert link_artifact("x" * 64, "abc123") == result
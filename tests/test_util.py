@@ -1,36 +1,70 @@
+import asyncio
+import io
+import json
 import os
+import struct
 import tempfile
 from pathlib import Path
 
 import pytest
+from fakeredis import FakeStrictRedis
+from fastapi import FastAPI
+from werkzeug import Request, Response
 
 from podman import PodmanClient
 
-import asu.util
 from asu.repositories import is_repo_allowed
 from asu.build_request import BuildRequest
+from asu.config import settings
 from asu.util import (
+    BuildLog,
+    HTTPCache,
+    JobMeta,
+    StageTimer,
+    async_client_get,
     check_manifest,
     check_package_errors,
     diff_packages,
     fingerprint_pubkey_usign,
     get_container_version_tag,
+    get_build_log,
     get_file_hash,
+    get_job_meta,
+    get_package_errors,
     get_packages_hash,
+    client_get,
     get_podman,
     get_request_hash,
     get_str_hash,
+    init_metadata,
     is_post_kmod_split_build,
     is_snapshot_build,
     parse_feeds_conf,
+    parse_info,
     parse_kernel_version,
     parse_manifest,
     parse_packages_file,
+    refresh_metadata,
+    reload_profiles,
+    reload_targets,
+    reload_versions,
     run_cmd,
+    save_package_errors,
+    single_flight,
+    sync_metadata,
     verify_usign,
 )
 
 
+def mock_upstream(monkeypatch, get) -> None:
+    """Answer upstream requests of the API with `get(url)`."""
+
+    async def async_client_get(url):
+        return get(url)
+
+    monkeypatch.setattr("asu.util.async_client_get", async_client_get)
+
+
 def test_get_str_hash():
     assert (
         get_str_hash("test")
@@ -149,7 +183,7 @@ def test_get_version_container_tag():
     assert get_container_version_tag("SNAPP-SNAPSHOT") == "openwrt-SNAPP"
 
 
-def test_get_packages_versions():
+def test_get_packages_versions(monkeypatch):
     packages_with_abi = {
         "libusb-1.0-0": "1.2.3",
         "libpython-3.3-3": "1.2.3",
@@ -203,48 +237,50 @@ def test_get_packages_versions():
         )
 
     # Old opkg-style Packages format, no index.json
-    asu.util.client_get = lambda url: Response404() if "json" in url else ResponseText()
-    index = parse_packages_file("httpx://fake_url")
+    mock_upstream(
+        monkeypatch, lambda url: Response404() if "json" in url else ResponseText()
+    )
+    index = asyncio.run(parse_packages_file("httpx://fake_url"))
     packages = index["packages"]
 
     assert index["architecture"] == "x86_64"
     assert packages == packages_without_abi
 
     # Old opkg-style Packages format, but with v1 index.json
-    asu.util.client_get = lambda url: (
-        ResponseJson1() if "json" in url else ResponseText()
+    mock_upstream(
+        monkeypatch, lambda url: ResponseJson1() if "json" in url else ResponseText()
     )
-    index = parse_packages_file("httpx://fake_url")
+    index = asyncio.run(parse_packages_file("httpx://fake_url"))
     packages = index["packages"]
 
     assert index["architecture"] == "x86_64"
     assert packages == packages_without_abi
 
     # New apk-style without Packages, but old v1 index.json
-    asu.util.client_get = lambda url: (
-        ResponseJson1() if "json" in url else Response404()
+    mock_upstream(
+        monkeypatch, lambda url: ResponseJson1() if "json" in url else Response404()
     )
-    index = parse_packages_file("httpx://fake_url")
+    index = asyncio.run(parse_packages_file("httpx://fake_url"))
     packages = index["packages"]
 
     assert index["architecture"] == "aarch_generic"
     assert packages == packages_with_abi
 
     # New index.json v2 format
-    asu.util.client_get = lambda url: ResponseJson2()
-    index = parse_packages_file("httpx://fake_url")
+    mock_upstream(monkeypatch, lambda url: ResponseJson2())
+    index = asyncio.run(parse_packages_file("httpx://fake_url"))
     packages = index["packages"]
 
     assert index["architecture"] == "aarch_generic"
     assert packages == packages_without_abi
 
     # Everything fails
-    asu.util.client_get = lambda url: Response404()
-    index = parse_packages_file("abc://fake")
+    mock_upstream(monkeypatch, lambda url: Response404())
+    index = asyncio.run(parse_packages_file("abc://fake"))
     assert index == {}
 
 
-def test_get_kernel_version():
+def test_get_kernel_version(monkeypatch):
     class Response:
         status_code = 200
 
@@ -259,13 +295,12 @@ def test_get_kernel_version():
         def json(self):
             return Response.json_data
 
-    asu.util.client_get = lambda url: Response()
-
-    version = parse_kernel_version("httpx://fake_url")
+    mock_upstream(monkeypatch, lambda url: Response())
+    version = asyncio.run(parse_kernel_version("httpx://fake_url"))
     assert version == "6.6.63-1-ed1b0ea64b60bcea5dd4112f33d0dcbe"
 
     Response.json_data = {}
-    version = parse_kernel_version("httpx://fake_url")
+    version = asyncio.run(parse_kernel_version("httpx://fake_url"))
     assert version == ""
 
 
@@ -310,7 +345,7 @@ def test_check_snapshot_versions():
         assert result == expected
 
 
-def test_get_feeds():
+def test_get_feeds(monkeypatch):
     class Response:
         status_code = 200
         text = (
@@ -318,15 +353,14 @@ def test_get_feeds():
             "src-git luci https://git.openwrt.org/project/luci.git^63d8b79\n"
         )
 
-    asu.util.client_get = lambda url: Response()
-
-    feeds = parse_feeds_conf("httpx://fake_url")
+    mock_upstream(monkeypatch, lambda url: Response())
+    feeds = asyncio.run(parse_feeds_conf("httpx://fake_url"))
     assert len(feeds) == 2
     assert feeds[0] == "packages"
     assert feeds[1] == "luci"
 
     Response.status_code = 404
-    feeds = parse_feeds_conf("httpx://fake_url")
+    feeds = asyncio.run(parse_feeds_conf("httpx://fake_url"))
     assert feeds == []
 
 
@@ -342,6 +376,51 @@ def test_check_manifest():
     )
 
 
+def test_package_errors_cache(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+    revision = "r1-a"
+
+    async def get_revision(version, target):
+        return revision
+
+    monkeypatch.setattr("asu.util.async_get_revision", get_revision)
+
+    def errors(build_request: BuildRequest) -> str:
+        return asyncio.run(get_package_errors(build_request))
+
+    def request(*packages: str, **kwargs) -> BuildRequest:
+        return BuildRequest(
+            version="1.2.3",
+            target="testtarget/testsubtarget",
+            profile="testprofile",
+            packages=list(packages),
+            **kwargs,
+        )
+
+    save_package_errors(request(), "r1-a", {"missing"}, {"a", "b"})
+
+    assert errors(request("vim")) == ""
+    assert errors(request("vim", "missing")) == (
+        "Impossible package selection: missing (missing)"
+    )
+    assert errors(request("a")) == ""
+    assert errors(request("a", "b", "-missing")) == (
+        "Impossible package selection: conflicts (a, b)"
+    )
+    assert errors(request("missing", repositories={"x": "https://example.com/x"})) == ""
+
+    # Upstream unreachable, the record is kept.
+    revision = ""
+    assert errors(request("missing")) == ""
+    assert redis_server.exists("package-errors:1.2.3:testtarget/testsubtarget")
+
+    # A new revision may have the packages.
+    revision = "r2-b"
+    assert errors(request("missing")) == ""
+    assert not redis_server.exists("package-errors:1.2.3:testtarget/testsubtarget")
+
+
 def test_check_package_errors():
     assert check_package_errors("hello world") == "Impossible package selection"
     assert (
@@ -418,6 +497,35 @@ def test_run_cmd_rejects_tar_path_traversal(tmp_path, monkeypatch):
     assert not (tmp_path / "etc" / "malicious").exists()
 
 
+def test_run_cmd_copy_streams_archive(tmp_path):
+    import io
+    import tarfile
+    from unittest.mock import MagicMock
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, size in [("abc/image.bin", 300_000), ("abc/profiles.json", 2)]:
+            info = tarfile.TarInfo(name=name)
+            info.size = size
+            info.mode = 0o600
+            tar.addfile(info, io.BytesIO(b"x" * size))
+    data = buf.getvalue()
+
+    # Deliver the archive in small, unaligned chunks like an HTTP stream.
+    chunks = (data[i : i + 1000] for i in range(0, len(data), 1000))
+
+    mock_container = MagicMock()
+    mock_container.exec_run.return_value = (0, (b"ok", b""))
+    mock_container.get_archive.return_value = (chunks, None)
+
+    run_cmd(mock_container, ["echo"], copy=["/fake/abc", str(tmp_path)])
+
+    image = tmp_path / "abc" / "image.bin"
+    assert image.read_bytes() == b"x" * 300_000
+    assert image.stat().st_mode & 0o777 == 0o644
+    assert (tmp_path / "abc" / "profiles.json").read_bytes() == b"xx"
+
+
 def test_parse_manifest_opkg():
     manifest = parse_manifest("test - 1.0\ntest2 - 2.0\ntest3 - 3.0\ntest4 - 3.0\n")
 
@@ -471,3 +579,384 @@ def test_parse_manifest_apk():
         "test3": "3.0",
         "test4": "3.0",
     }
+
+
+def test_parse_info():
+    info = parse_info(
+        (
+            Path("tests/upstream/snapshots/targets/testtarget/testsubtarget")
+            / "openwrt-imagebuilder-testtarget-testsubtarget.Linux-x86_64"
+            / "openwrt-testtarget-testsubtarget-testprofile.info"
+        ).read_text()
+    )
+
+    assert info["revision"] == "r12647-cb44ab4f5d"
+    assert info["default_packages"][:3] == ["base-files", "libc", "libgcc"]
+    assert info["profiles"] == {
+        "Default": ["iwinfo"],
+        "8dev_carambola2": ["kmod-usb2", "kmod-usb-chipidea2"],
+        "testprofile": [
+            "kmod-usb2",
+            "kmod-usb-chipidea2",
+            "kmod-usb-storage",
+            "-swconfig",
+        ],
+    }
+
+
+def test_parse_info_empty():
+    assert parse_info("") == {"revision": "", "default_packages": [], "profiles": {}}
+
+
+def test_stage_timer():
+    timer = StageTimer()
+
+    with timer("pull"):
+        pass
+    with pytest.raises(RuntimeError):
+        with timer("image"):
+            raise RuntimeError("failed")
+    with timer("pull"):
+        pass
+
+    assert set(timer.durations) == {"pull", "image"}
+    assert all(d >= 0 for d in timer.durations.values())
+    assert timer.rounded() == {
+        stage: round(d, 3) for stage, d in timer.durations.items()
+    }
+
+
+def _frame(stream: int, data: bytes) -> bytes:
+    return struct.pack(">BxxxL", stream, len(data)) + data
+
+
+def test_build_log(monkeypatch):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr(settings, "build_log_lines", 3)
+
+    build_log = BuildLog("abc123")
+    build_log.write(b"line 1\nline 2\nli")
+    build_log.flush()
+    assert get_build_log("abc123") == ["line 1", "line 2"]
+
+    build_log.write(b"ne 3\nline 4\nline 5")
+    build_log.close()
+    assert get_build_log("abc123") == ["line 3", "line 4", "line 5"]
+    assert redis_server.ttl("build-log:abc123") > 0
+
+    build_log.clear()
+    assert get_build_log("abc123") == []
+
+
+def test_run_cmd_build_log(monkeypatch):
+    from unittest.mock import MagicMock
+
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+
+    container = MagicMock()
+    container.id = "c1"
+    container.client.post.return_value.json.return_value = {"Id": "e1"}
+    container.client.post.return_value.raw = io.BytesIO(
+        _frame(1, b"Building images...\n")
+        + _frame(2, b"warning\n")
+        + _frame(1, b"done\n")
+    )
+    container.client.get.return_value.json.return_value = {"ExitCode": 0}
+
+    returncode, stdout, stderr = run_cmd(
+        container, ["make", "image"], build_log=BuildLog("abc123")
+    )
+
+    assert returncode == 0
+    assert stdout == "Building images...\ndone\n"
+    assert stderr == "warning\n"
+    assert get_build_log("abc123") == ["Building images...", "warning", "done"]
+    container.client.get.assert_called_once_with("/exec/e1/json")
+    container.exec_run.assert_not_called()
+
+
+def test_job_meta():
+    from rq.job import Job
+
+    redis_server = FakeStrictRedis()
+    job = Job.create(print, connection=redis_server, id="abc123")
+    job.save()
+
+    meta = JobMeta(job)
+    job.meta.update(imagebuilder_status="init", build_cmd=["make", "image"])
+    meta.save()
+    assert get_job_meta(Job.fetch("abc123", connection=redis_server)) == {
+        "imagebuilder_status": "init",
+        "build_cmd": ["make", "image"],
+    }
+
+    # Output is held back until the next status change.
+    job.meta["stdout"] = "output"
+    job.meta["build_cmd"].append("PROFILE=generic")
+    meta.save()
+    assert redis_server.hget(job.key, "meta:stdout") is None
+
+    job.meta["imagebuilder_status"] = "validate_manifest"
+    meta.save()
+    assert redis_server.hget(job.key, "meta:stdout")
+
+    # Unchanged fields are not written again.
+    redis_server.hdel(job.key, "meta:stdout")
+    job.meta["imagebuilder_status"] = "building_image"
+    meta.save()
+    assert redis_server.hget(job.key, "meta:stdout") is None
+    job.meta["stdout"] = "more output"
+    meta.save(force=True)
+
+    # RQ's own meta is kept, fields written by JobMeta take precedence.
+    job.meta = {"imagebuilder_status": "stale", "other": 1}
+    job.save_meta()
+    assert get_job_meta(job) == {
+        "imagebuilder_status": "building_image",
+        "build_cmd": ["make", "image", "PROFILE=generic"],
+        "stdout": "more output",
+        "other": 1,
+    }
+
+
+def test_http_cache(httpserver, monkeypatch):
+    monkeypatch.setattr("asu.util.http_cache", HTTPCache())
+    etag = '"v1"'
+
+    def handler(request: Request) -> Response:
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status=304)
+        return Response(f'{{"etag": {etag}}}', headers={"ETag": etag})
+
+    httpserver.expect_request("/meta.json").respond_with_handler(handler)
+    url = httpserver.url_for("/meta.json")
+
+    response = client_get(url)
+    assert not response.from_cache
+    assert response.json() == {"etag": "v1"}
+
+    response = client_get(url)
+    assert response.from_cache
+    assert response.json() == {"etag": "v1"}
+
+    etag = '"v2"'
+    response = asyncio.run(async_client_get(url))
+    assert not response.from_cache
+    assert response.json() == {"etag": "v2"}
+
+    # Nothing is kept without room for it.
+    monkeypatch.setattr(settings, "upstream_cache_mb", 0)
+    assert client_get(url).from_cache
+    assert not client_get(url).from_cache
+    assert not client_get(url).from_cache
+
+
+def test_reload_skips_unmodified(httpserver, monkeypatch):
+    monkeypatch.setattr("asu.util.http_cache", HTTPCache())
+    monkeypatch.setattr(settings, "upstream_url", httpserver.url_for("").rstrip("/"))
+    upstream = Path("tests/upstream")
+
+    def serve(path: str):
+        body = (upstream / path).read_bytes()
+
+        def handler(request: Request) -> Response:
+            if request.headers.get("If-None-Match") == '"1"':
+                return Response(status=304)
+            return Response(body, headers={"ETag": '"1"'})
+
+        httpserver.expect_request(f"/{path}").respond_with_handler(handler)
+
+    serve(".versions.json")
+    profiles = "snapshots/targets/testtarget/testsubtarget/profiles.json"
+    serve(profiles)
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+    app = FastAPI()
+    init_metadata(app)
+
+    assert asyncio.run(reload_versions(app))
+    assert app.versions
+    assert not asyncio.run(reload_versions(app))
+
+    assert asyncio.run(reload_profiles(app, "SNAPSHOT", "testtarget/testsubtarget"))
+    assert not asyncio.run(reload_profiles(app, "SNAPSHOT", "testtarget/testsubtarget"))
+
+    # Profiles not parsed from the kept response are parsed again, but only
+    # shared again if they changed.
+    redis_server.hdel("metadata:parsed", httpserver.url_for(profiles))
+    generation = redis_server.get("metadata:generation")
+    assert not asyncio.run(reload_profiles(app, "SNAPSHOT", "testtarget/testsubtarget"))
+    assert redis_server.get("metadata:generation") == generation
+
+
+def test_reload_keeps_metadata_on_failure(httpserver, monkeypatch):
+    monkeypatch.setattr("asu.util.http_cache", HTTPCache())
+    monkeypatch.setattr(settings, "upstream_url", httpserver.url_for("").rstrip("/"))
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+    app = FastAPI()
+    init_metadata(app)
+    targets = {"ath79/generic": "mips_24kc"}
+
+    httpserver.expect_oneshot_request("/snapshots/.targets.json").respond_with_json(
+        targets
+    )
+    assert asyncio.run(reload_targets(app, "SNAPSHOT"))
+    assert redis_server.get("metadata:generation") == "1"
+
+    # Upstream errors neither replace the targets nor bump the generation.
+    httpserver.expect_request("/snapshots/.targets.json").respond_with_data(
+        "", status=503
+    )
+    assert not asyncio.run(reload_targets(app, "SNAPSHOT"))
+    assert app.targets["SNAPSHOT"] == targets
+    assert json.loads(redis_server.get("metadata:targets:SNAPSHOT")) == targets
+    assert redis_server.get("metadata:generation") == "1"
+
+
+def test_single_flight():
+    calls = []
+
+    @single_flight
+    async def fetch(url: str) -> str:
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        if url == "broken":
+            raise ValueError(url)
+        return url.upper()
+
+    async def main():
+        results = await asyncio.gather(fetch("a"), fetch("a"), fetch("b"))
+        assert results == ["A", "A", "B"]
+        assert calls == ["a", "b"]
+
+        # Finished runs are not reused.
+        assert await fetch("a") == "A"
+        assert calls == ["a", "b", "a"]
+
+        results = await asyncio.gather(
+            fetch("broken"), fetch("broken"), return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+        assert calls.count("broken") == 1
+
+        # Cancelling one caller leaves the run to the others.
+        first = asyncio.ensure_future(fetch("c"))
+        second = asyncio.ensure_future(fetch("c"))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "C"
+
+    asyncio.run(main())
+
+
+def test_reload_single_flight(monkeypatch):
+    fetched = []
+
+    class Response:
+        status_code = 200
+        from_cache = False
+        headers = {}
+        url = "http://upstream/profiles.json"
+
+        def json(self):
+            return {"profiles": {"testprofile": {}}}
+
+    async def async_client_get(url):
+        fetched.append(url)
+        await asyncio.sleep(0.01)
+        return Response()
+
+    monkeypatch.setattr("asu.util.async_client_get", async_client_get)
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+    app = FastAPI()
+    init_metadata(app)
+
+    async def main():
+        return await asyncio.gather(
+            *[reload_profiles(app, "SNAPSHOT", "ath79/generic") for _ in range(10)]
+        )
+
+    assert asyncio.run(main()) == [True] * 10
+    assert len(fetched) == 1
+    assert app.profiles["SNAPSHOT"]["ath79/generic"] == {"testprofile": "testprofile"}
+
+
+def test_refresh_metadata(upstream, monkeypatch):
+    monkeypatch.setattr("asu.util.http_cache", HTTPCache())
+    monkeypatch.setattr(settings, "upstream_url", "http://localhost:8123")
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: redis_server)
+    app = FastAPI()
+    init_metadata(app)
+
+    # Most profiles.json files are missing upstream, the others are loaded.
+    asyncio.run(refresh_metadata(app))
+
+    assert "23.05.5" in app.versions
+    assert "ath79/generic" in app.targets["23.05.5"]
+    assert app.targets["SNAPSHOT"] == {"testtarget/testsubtarget": "testarch"}
+    assert app.profiles["23.05.5"]["ath79/generic"]
+    assert app.profiles["23.05.5"]["x86/64"]
+    assert app.profiles["SNAPSHOT"]["testtarget/testsubtarget"] == {
+        "generic": "generic"
+    }
+
+
+def test_shared_metadata(monkeypatch, loop_guard):
+    redis_server = FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr("asu.util.get_redis_client", lambda: loop_guard(redis_server))
+
+    class Response:
+        status_code = 200
+        from_cache = False
+        headers = {"etag": '"1"'}
+        url = "http://upstream/snapshots/.targets.json"
+
+        def json(self):
+            return {"ath79/generic": "mips_24kc"}
+
+    async def async_client_get(url):
+        return Response()
+
+    monkeypatch.setattr("asu.util.async_client_get", async_client_get)
+
+    async def processes():
+        # Two API processes.
+        first, second = FastAPI(), FastAPI()
+        init_metadata(first)
+        init_metadata(second)
+        await sync_metadata(second)
+        assert await second.targets.load("SNAPSHOT") == {}
+
+        assert await reload_targets(first, "SNAPSHOT")
+        assert first.generation == 1
+        await sync_metadata(first, force=True)
+        assert first.targets["SNAPSHOT"] == {"ath79/generic": "mips_24kc"}
+
+        # The other process checks the generation at most once a second,
+        # then drops its local copy and loads it again.
+        await sync_metadata(second)
+        assert second.targets["SNAPSHOT"] == {}
+        await sync_metadata(second, force=True)
+        assert second.generation == 1
+        assert second.targets["SNAPSHOT"] == {}
+        assert await second.targets.load("SNAPSHOT") == {"ath79/generic": "mips_24kc"}
+
+        # What one process parsed is not parsed again by the other.
+        second.targets.clear()
+        assert not await reload_targets(second, "SNAPSHOT")
+        assert second.targets["SNAPSHOT"] == {"ath79/generic": "mips_24kc"}
+
+    # Redis is only called from the thread pool, never the event loop.
+    asyncio.run(processes())
+    assert redis_server.get("metadata:generation") == "1"
+
+    async def blocking():
+        loop_guard(redis_server).get("metadata:generation")
+
+    with pytest.raises(AssertionError, match="on the event loop"):
+        asyncio.run(blocking())
@@ -0,0 +1,287 @@
+import json
+import threading
+from time import time
+from unittest.mock import MagicMock
+
+import pytest
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from rq.registry import clean_registries
+
+from asu.build_request import BuildRequest
+from asu.config import settings
+from asu.pool import ContainerPool
+from asu.util import AFFINITY_TTL, get_build_queue, get_job_meta, stage_slot
+from asu.worker import AffinityWorker, ConcurrentWorker
+
+barrier = threading.Barrier(2, timeout=5)
+
+
+def _image(*tags: str) -> MagicMock:
+    image = MagicMock()
+    image.tags = list(tags)
+    return image
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    redis_server = FakeStrictRedis()
+    monkeypatch.setattr("asu.util.get_redis_client", lambda *args: redis_server)
+    monkeypatch.setattr("asu.pool.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr("asu.admission.get_redis_client", lambda: redis_server)
+    monkeypatch.setattr(
+        "asu.util.get_queue",
+        lambda name="default": Queue(name, connection=redis_server),
+    )
+    yield redis_server
+    redis_server.flushall()
+
+
+@pytest.fixture
+def podman(monkeypatch):
+    podman = MagicMock()
+    podman.images.list.return_value = [
+        _image(f"{settings.base_container}:ath79-generic-v23.05.5"),
+        _image(f"{settings.base_container}:x86-64-master", "localhost/other:latest"),
+        _image("docker.io/library/redis:latest"),
+    ]
+    monkeypatch.setattr("asu.worker.get_podman", lambda: podman)
+    return podman
+
+
+def test_worker_listens_on_image_queues(redis_server, podman):
+    worker = AffinityWorker(["default"], connection=redis_server)
+    worker.refresh_queues()
+
+    assert worker.queue_names() == [
+        "build:ath79-generic-v23.05.5",
+        "build:x86-64-master",
+        "default",
+    ]
+    assert redis_server.zscore("affinity:x86-64-master", worker.name)
+
+
+def test_worker_drops_removed_images(redis_server, podman):
+    worker = AffinityWorker(["default"], connection=redis_server)
+    worker.refresh_queues()
+
+    podman.images.list.return_value = []
+    worker.refreshed_at = 0
+    worker.refresh_queues()
+
+    assert worker.queue_names() == ["default"]
+    assert not redis_server.zscore("affinity:x86-64-master", worker.name)
+
+
+def test_build_queue_routing(redis_server, podman):
+    assert get_build_queue("x86-64-master").name == "default"
+
+    worker = AffinityWorker(["default"], connection=redis_server)
+    worker.refresh_queues()
+
+    queue = get_build_queue("x86-64-master")
+    assert queue.name == "build:x86-64-master"
+    assert get_build_queue("ramips-mt7621-master").name == "default"
+
+    # With one warm worker, a second build goes to the shared queue.
+    queue.enqueue(print, "build")
+    assert get_build_queue("x86-64-master").name == "default"
+
+    worker.teardown()
+    assert get_build_queue("ath79-generic-v23.05.5").name == "default"
+
+
+def test_worker_claims_session(redis_server, podman, monkeypatch):
+    monkeypatch.setattr(settings, "build_session_size", 3)
+    podman.images.list.return_value = []
+    queue = Queue(connection=redis_server)
+
+    def build_request(target: str, profile: str) -> BuildRequest:
+        return BuildRequest(version="1.2.3", target=target, profile=profile)
+
+    jobs = [
+        queue.enqueue(print, build_request("ath79/generic", f"profile{i}"))
+        for i in range(3)
+    ]
+    other = queue.enqueue(print, build_request("x86/64", "generic"))
+    last = queue.enqueue(print, build_request("ath79/generic", "profile3"))
+
+    worker = AffinityWorker([queue], connection=redis_server)
+    job, _ = worker.dequeue_job_and_maintain_ttl(None)
+    assert job.id == jobs[0].id
+
+    # Two more builds of the same image are claimed, the rest stays.
+    image_queue = Queue("build:ath79-generic-v1.2.3", connection=redis_server)
+    assert image_queue.get_job_ids() == [jobs[1].id, jobs[2].id]
+    assert queue.get_job_ids() == [other.id, last.id]
+    assert worker.queue_names() == ["build:ath79-generic-v1.2.3", "default"]
+
+    job, _ = worker.dequeue_job_and_maintain_ttl(None)
+    assert job.id == jobs[1].id
+    assert image_queue.get_job_ids() == [jobs[2].id, last.id]
+
+
+def wait_for_other_build(value: int) -> int:
+    barrier.wait()  # Times out unless both builds run at once.
+    return value * 2
+
+
+def test_worker_returns_claimed_builds(redis_server, podman, monkeypatch):
+    monkeypatch.setattr(settings, "build_session_size", 3)
+    podman.images.list.return_value = []
+    queue = Queue(connection=redis_server)
+    jobs = [
+        queue.enqueue(
+            print, BuildRequest(version="1.2.3", target="ath79/generic", profile=p)
+        )
+        for p in ["a", "b", "c"]
+    ]
+
+    worker = AffinityWorker([queue], connection=redis_server)
+    worker.dequeue_job_and_maintain_ttl(None)
+    assert queue.get_job_ids() == []
+    assert redis_server.zscore("affinity:ath79-generic-v1.2.3", worker.name)
+
+    # Builds the session did not run go back when the worker stops.
+    worker.teardown()
+    assert queue.get_job_ids() == [jobs[1].id, jobs[2].id]
+    assert not redis_server.zscore("affinity:ath79-generic-v1.2.3", worker.name)
+
+
+def test_worker_requeues_orphaned_builds(redis_server, podman):
+    dead = AffinityWorker(["default"], connection=redis_server)
+    dead.refresh_queues()
+    image_queue = get_build_queue("x86-64-master")
+    assert image_queue.name == "build:x86-64-master"
+    job = image_queue.enqueue(print, "build")
+
+    podman.images.list.return_value = []
+    worker = AffinityWorker(["default"], connection=redis_server)
+    assert worker.requeue_orphaned_builds(force=True) == 0
+
+    # The advertising worker was killed and stopped renewing.
+    redis_server.zadd("affinity:x86-64-master", {dead.name: time() - AFFINITY_TTL - 1})
+    assert worker.requeue_orphaned_builds() == 1
+    assert image_queue.get_job_ids() == []
+    assert Queue(connection=redis_server).get_job_ids() == [job.id]
+
+    # Looked at once per interval by all workers.
+    image_queue.enqueue_job(job)
+    assert worker.requeue_orphaned_builds() == 0
+
+
+def test_concurrent_worker(redis_server, podman, monkeypatch):
+    monkeypatch.setattr(settings, "worker_concurrency", 2)
+    queue = Queue(connection=redis_server)
+    jobs = [queue.enqueue(wait_for_other_build, i) for i in [1, 2]]
+
+    worker = ConcurrentWorker([queue], connection=redis_server)
+    worker.work(burst=True)
+
+    assert [job.latest_result().return_value for job in jobs] == [2, 4]
+
+
+killed = threading.Event()
+
+
+def wait_for_kill() -> None:
+    killed.wait(5)  # Blocks like an exec into the build container.
+
+
+def test_concurrent_worker_timeout(redis_server, podman, monkeypatch):
+    monkeypatch.setattr(
+        ConcurrentWorker, "reap_containers", lambda *args, **kwargs: None
+    )
+    killed.clear()
+    queue = Queue(connection=redis_server)
+    job = queue.enqueue(wait_for_kill, job_timeout=1)
+    worker = ConcurrentWorker([queue], connection=redis_server)
+
+    states = []
+
+    def kill():
+        states.append(redis_server.hget(worker.key, "state"))
+        killed.set()
+
+    container = MagicMock()
+    container.id = "c1"
+    container.labels = {ContainerPool.LABEL_JOB: job.id}
+    container.kill.side_effect = kill
+    podman.containers.list.return_value = [container]
+
+    started = time()
+    worker.work(burst=True)
+
+    # The timeout kills the build container of the blocked thread, while
+    # the worker kept showing as busy.
+    assert time() - started < 5
+    assert states == [b"busy"]
+    container.remove.assert_called_once()
+    assert job.get_status() == "failed"
+    assert redis_server.hget(worker.key, "state") == b"idle"
+
+
+def test_stage_slot(monkeypatch):
+    slots = {}
+    monkeypatch.setattr("asu.util._stage_slots", slots)
+    monkeypatch.setattr(settings, "worker_cpu_slots", 1)
+
+    acquired = []
+    with stage_slot("cpu"):
+        thread = threading.Thread(
+            target=lambda: acquired.append(slots["cpu"].acquire(timeout=0.1))
+        )
+        thread.start()
+        thread.join()
+    assert acquired == [False]
+
+    with stage_slot("cpu"), stage_slot("network"):
+        pass
+
+
+def test_worker_defers_builds(redis_server, podman, monkeypatch):
+    monkeypatch.setattr(AffinityWorker, "DEFER_BACKOFF", 0)
+    monkeypatch.setattr(settings, "host_memory_reserve_mb", 1 << 30)
+    podman.info.return_value = {"host": {"hostname": "testhost", "memFree": 1}}
+    redis_server.hset(
+        "admission:testhost",
+        "running",
+        json.dumps({"memory": 0, "disk": 0, "expires": time() + 60}),
+    )
+    image_queue = Queue("build:ath79-generic-v1.2.3", connection=redis_server)
+    queue = Queue(connection=redis_server)
+    job = image_queue.enqueue(
+        print, BuildRequest(version="1.2.3", target="ath79/generic", profile="p")
+    )
+
+    worker = AffinityWorker([queue], connection=redis_server)
+    worker.image_tags = ["ath79-generic-v1.2.3"]
+    worker.refreshed_at = time()
+    worker.order_queues()
+
+    # Deferred builds move to the shared queue for workers on other hosts.
+    assert worker.dequeue_job_and_maintain_ttl(None) is None
+    assert queue.get_job_ids() == [job.id]
+    assert image_queue.get_job_ids() == []
+
+    # Maintenance doesn't take the deferred build for a stuck one. Single
+    # queue dequeues park jobs in the intermediate queue on Redis >= 6.2,
+    # which fakeredis can't report.
+    setattr(redis_server, "__rq_redis_server_version", (7, 0, 0))
+    worker.image_tags = []
+    worker.order_queues()
+    assert worker.dequeue_job_and_maintain_ttl(None) is None
+    intermediate = queue.intermediate_queue
+    assert intermediate.get_job_ids() == []
+    redis_server.set(intermediate.get_first_seen_key(job.id), time() - 120)
+    clean_registries(queue)
+    intermediate.cleanup(worker, queue)
+    assert job.get_status() == "queued"
+    assert queue.get_job_ids() == [job.id]
+
+    # Builds no host has room for fail eventually.
+    monkeypatch.setattr(AffinityWorker, "MAX_DEFERRALS", 2)
+    assert worker.dequeue_job_and_maintain_ttl(None) is None
+    assert queue.get_job_ids() == []
+    assert job.get_status() == "failed"
+    assert get_job_meta(job)["imagebuilder_status"] == "failed"